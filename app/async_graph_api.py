@@ -0,0 +1,306 @@
+"""
+Asynchronous Microsoft Graph API client (httpx) với giới hạn concurrency toàn cục và theo mailbox
+"""
+import asyncio
+import httpx
+from urllib.parse import quote
+from typing import Dict, Any, List, AsyncIterator, Tuple, Optional
+from fastapi import HTTPException
+
+from .config import (
+    GRAPH_API_BASE,
+    EMAIL_PAGE_SIZE,
+    DELTA_SYNC_FOLDER,
+    GRAPH_BATCH_SIZE,
+    HTTP_POOL_MAXSIZE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    ASYNC_GRAPH_MAX_CONCURRENCY,
+    ASYNC_GRAPH_MAILBOX_CONCURRENCY,
+    GRAPH_MAX_RETRIES,
+    THROTTLE_STATUS_CODES,
+    RETRYABLE_STATUS_CODES
+)
+from .graph_scheduler import graph_scheduler, compute_retry_delay
+from .request_budget import request_budget
+from .immutable_ids import with_immutable_id_prefer
+from .json_stream import aiter_json_items
+from .email_utils import (
+    EMAIL_SELECT_FIELDS,
+    TEXT_BODY_PREFER,
+    build_email_filter,
+    build_meta_receipt_filters,
+    get_email_api_params,
+    get_email_delta_params,
+    get_message_request_url
+)
+
+
+class AsyncGraphClient:
+    """
+    Client bất đồng bộ cho các thao tác trong graph_api.py.
+    Access token được truyền vào từ bên ngoài để client không phải chạm vào database.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = ASYNC_GRAPH_MAX_CONCURRENCY,
+        mailbox_concurrency: int = ASYNC_GRAPH_MAILBOX_CONCURRENCY
+    ):
+        self.max_concurrency = max_concurrency
+        self.mailbox_concurrency = mailbox_concurrency
+        self._client = None
+        self._global_semaphore = None
+        self._mailbox_semaphores: Dict[Any, asyncio.Semaphore] = {}
+        # Mức filter Meta receipt đã dùng được cho từng mailbox (xem build_meta_receipt_filters)
+        self._meta_filter_levels: Dict[Any, int] = {}
+
+    async def __aenter__(self):
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_concurrency,
+                max_keepalive_connections=HTTP_POOL_MAXSIZE
+            ),
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            headers={"Accept-Encoding": "gzip, deflate"}
+        )
+        self._global_semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._client.aclose()
+        self._client = None
+
+    def _mailbox_semaphore(self, mailbox_key) -> asyncio.Semaphore:
+        """Semaphore riêng cho từng mailbox (Graph giới hạn số request đồng thời mỗi mailbox)"""
+        semaphore = self._mailbox_semaphores.get(mailbox_key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.mailbox_concurrency)
+            self._mailbox_semaphores[mailbox_key] = semaphore
+        return semaphore
+
+    async def _request(
+        self, mailbox_key, method: str, url: str, cost: int = 1, stream: bool = False, **kwargs
+    ) -> httpx.Response:
+        """
+        Gửi request trong giới hạn concurrency toàn cục và của mailbox, cost được tính vào request budget.
+        Mỗi request lấy một token từ token bucket của mailbox trong graph_scheduler (chung với client sync),
+        nên tốc độ mỗi mailbox bị giới hạn và giảm khi bị throttle như đường sync.
+        Khi gặp 429/5xx thì chờ theo Retry-After (hoặc backoff) rồi thử lại, không giữ semaphore trong lúc chờ.
+        """
+        kwargs["headers"] = with_immutable_id_prefer(kwargs.get("headers"), mailbox_key)
+        bucket = graph_scheduler.get_bucket(mailbox_key) if mailbox_key is not None else None
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            waited = await bucket.acquire_async() if bucket else 0.0
+            graph_scheduler.record_request(waited)
+            async with self._mailbox_semaphore(mailbox_key):
+                async with self._global_semaphore:
+                    response = await self._client.send(
+                        self._client.build_request(method, url, **kwargs), stream=stream
+                    )
+            request_budget.record(mailbox_key, response.status_code, cost)
+
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                if bucket:
+                    bucket.on_success()
+                return response
+
+            if attempt == GRAPH_MAX_RETRIES:
+                graph_scheduler.record_gave_up()
+                return response
+
+            delay = compute_retry_delay(response.headers, attempt)
+            graph_scheduler.record_retry(mailbox_key, response.status_code, delay)
+            # Trả connection về pool (cần thiết với stream=True)
+            await response.aclose()
+            await asyncio.sleep(delay)
+
+        return response
+
+    @staticmethod
+    async def _raise_for_status(response: httpx.Response, message: str):
+        """Response lỗi (có thể đang stream): đọc body rồi raise HTTPException"""
+        await response.aread()
+        await response.aclose()
+        raise HTTPException(status_code=response.status_code, detail=f"{message}: {response.text}")
+
+    async def get_email_pages(
+        self,
+        mailbox_key,
+        access_token: str,
+        top: int = EMAIL_PAGE_SIZE,
+        received_from: str = None,
+        received_to: str = None,
+        meta_only: bool = False,
+        select: str = EMAIL_SELECT_FIELDS,
+        text_body: bool = False,
+        folder_id: str = None
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Lấy emails theo từng trang (đi theo @odata.nextLink), giống get_email_pages_from_graph.
+        folder_id: chỉ lấy một mail folder, None thì quét /me/messages
+        """
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+        if text_body:
+            headers["Prefer"] = TEXT_BODY_PREFER
+
+        if meta_only:
+            filter_candidates = build_meta_receipt_filters(received_from, received_to)
+            level = min(self._meta_filter_levels.get(mailbox_key, 0), len(filter_candidates) - 1)
+        else:
+            filter_candidates = [build_email_filter(received_from, received_to)]
+            level = 0
+        params = get_email_api_params(top, filter_candidates[level], select)
+        if folder_id:
+            url = f"{GRAPH_API_BASE}/me/mailFolders/{quote(folder_id, safe='=-_')}/messages"
+        else:
+            url = f"{GRAPH_API_BASE}/me/messages"
+
+        while url:
+            response = await self._request(mailbox_key, "GET", url, stream=True, headers=headers, params=params)
+
+            # Filter không được hỗ trợ: thử filter lỏng hơn
+            if response.status_code == 400 and params and level + 1 < len(filter_candidates):
+                await response.aclose()
+                level += 1
+                self._meta_filter_levels[mailbox_key] = level
+                params = get_email_api_params(top, filter_candidates[level], select)
+                continue
+
+            if response.status_code != 200:
+                await self._raise_for_status(response, "Failed to fetch emails from Microsoft Graph")
+
+            page_info = {}
+            yield [email async for email in aiter_json_items(response, "value.item", page_info)]
+
+            url = page_info.get("@odata.nextLink")
+            params = None
+
+    async def get_messages_batch(
+        self,
+        mailbox_key,
+        access_token: str,
+        message_ids: List[str],
+        select: str = EMAIL_SELECT_FIELDS,
+        text_body: bool = False
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Lấy đầy đủ nội dung nhiều email qua JSON $batch, các batch chạy song song trong giới hạn concurrency
+        """
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+        request_headers = with_immutable_id_prefer({"Prefer": TEXT_BODY_PREFER} if text_body else None, mailbox_key)
+
+        async def fetch_chunk(chunk: List[str]) -> Dict[str, Dict[str, Any]]:
+            chunk_messages = {}
+            # Request con bị throttle được gửi lại sau Retry-After, tối đa GRAPH_MAX_RETRIES lần
+            attempt = 0
+            while chunk:
+                batch_requests = []
+                for index, message_id in enumerate(chunk):
+                    batch_request = {
+                        "id": str(index),
+                        "method": "GET",
+                        "url": get_message_request_url(message_id, select)
+                    }
+                    if request_headers:
+                        batch_request["headers"] = request_headers
+                    batch_requests.append(batch_request)
+                response = await self._request(
+                    mailbox_key, "POST", f"{GRAPH_API_BASE}/$batch", cost=len(batch_requests), stream=True,
+                    headers=headers, json={"requests": batch_requests}
+                )
+                if response.status_code != 200:
+                    await self._raise_for_status(response, "Failed to fetch email batch from Microsoft Graph")
+
+                # Decode từng response con ngay khi đọc xong, không giữ cả body $batch trong bộ nhớ
+                throttled_ids = []
+                retry_delay = 0.0
+                async for item in aiter_json_items(response, "responses.item"):
+                    message_id = chunk[int(item.get("id"))]
+                    if item.get("status") == 200:
+                        chunk_messages[message_id] = item.get("body", {})
+                    elif item.get("status") in THROTTLE_STATUS_CODES and attempt < GRAPH_MAX_RETRIES:
+                        throttled_ids.append(message_id)
+                        retry_delay = max(retry_delay, compute_retry_delay(item.get("headers"), attempt))
+                    else:
+                        print(f"⚠️ Batch request for message {message_id} failed with status {item.get('status')}")
+
+                if throttled_ids:
+                    graph_scheduler.record_retry(mailbox_key, 429, retry_delay)
+                    await asyncio.sleep(retry_delay)
+                    attempt += 1
+                chunk = throttled_ids
+            return chunk_messages
+
+        chunks = [
+            message_ids[start:start + GRAPH_BATCH_SIZE]
+            for start in range(0, len(message_ids), GRAPH_BATCH_SIZE)
+        ]
+        messages = {}
+        for chunk_messages in await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks)):
+            messages.update(chunk_messages)
+        return messages
+
+    async def get_email_delta_pages(
+        self,
+        mailbox_key,
+        access_token: str,
+        delta_link: str = None,
+        folder_id: str = DELTA_SYNC_FOLDER,
+        received_from: str = None,
+        page_size: int = EMAIL_PAGE_SIZE,
+        text_body: bool = False
+    ) -> AsyncIterator[Tuple[List[Dict[str, Any]], Optional[str]]]:
+        """
+        Lấy thay đổi của mail folder qua delta query, giống get_email_delta_pages_from_graph
+        """
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "Prefer": f"odata.maxpagesize={page_size}"
+        }
+        if text_body:
+            headers["Prefer"] += f", {TEXT_BODY_PREFER}"
+
+        if delta_link:
+            url = delta_link
+            params = None
+        else:
+            url = f"{GRAPH_API_BASE}/me/mailFolders/{quote(folder_id, safe='=-_')}/messages/delta"
+            params = get_email_delta_params(build_email_filter(received_from))
+
+        while url:
+            response = await self._request(mailbox_key, "GET", url, stream=True, headers=headers, params=params)
+
+            if response.status_code != 200:
+                await self._raise_for_status(response, "Failed to fetch email delta from Microsoft Graph")
+
+            page_info = {}
+            page = [email async for email in aiter_json_items(response, "value.item", page_info)]
+            url = page_info.get("@odata.nextLink")
+            params = None
+            yield page, page_info.get("@odata.deltaLink")
+
+    async def get_attachments(self, mailbox_key, access_token: str, message_id: str) -> Dict[str, Any]:
+        """
+        Lấy attachments của một email
+        """
+        headers = {"Authorization": f"Bearer {access_token}"}
+        response = await self._request(
+            mailbox_key, "GET", f"{GRAPH_API_BASE}/me/messages/{message_id}/attachments",
+            headers=headers
+        )
+
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail="Failed to fetch attachments"
+            )
+
+        return response.json()
@@ -0,0 +1,168 @@
+"""
+Content-addressed store cho file đính kèm: nội dung được stream từ Graph ($value) xuống đĩa theo từng chunk,
+đặt tên theo SHA-256 nên các file trùng nội dung chỉ lưu một lần. Database chỉ giữ đường dẫn và hash.
+"""
+import base64
+import hashlib
+import os
+import tempfile
+from typing import Dict, Any, Iterable, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from .config import ATTACHMENT_STORE_DIR, ATTACHMENT_CHUNK_SIZE
+from .auth import get_valid_access_token
+from .graph_api import get_attachments_metadata, get_attachment_metadata, open_attachment_stream
+from crud import (
+    save_email_attachment,
+    get_email_attachment,
+    get_email_attachments,
+    get_email_by_message_id,
+    save_attachments_metadata
+)
+from models import Email, EmailAttachment
+
+
+def attachment_to_dict(db_attachment: EmailAttachment) -> Dict[str, Any]:
+    """Metadata của attachment theo định dạng của Graph (không kèm nội dung)"""
+    return {
+        "id": db_attachment.attachment_id,
+        "name": db_attachment.name,
+        "contentType": db_attachment.content_type,
+        "size": db_attachment.size,
+        "isInline": db_attachment.is_inline,
+        "contentHash": db_attachment.content_hash
+    }
+
+
+def get_attachment_path(content_hash: str) -> str:
+    """Đường dẫn của một hash trong store: <store>/ab/cd/<hash>"""
+    return os.path.join(ATTACHMENT_STORE_DIR, content_hash[:2], content_hash[2:4], content_hash)
+
+
+def store_chunks(chunks: Iterable[bytes]) -> Tuple[str, str, int]:
+    """
+    Ghi các chunk vào file tạm đồng thời tính SHA-256, sau đó chuyển vào vị trí theo hash.
+    Nếu hash đã có trong store thì bỏ file tạm (dedup). Trả về (content_hash, file_path, size).
+    """
+    os.makedirs(ATTACHMENT_STORE_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=ATTACHMENT_STORE_DIR, prefix=".download-")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                digest.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+
+        content_hash = digest.hexdigest()
+        file_path = get_attachment_path(content_hash)
+        if os.path.exists(file_path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(temp_path, file_path)
+        return content_hash, file_path, size
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def download_attachment(access_token: str, message_id: str, attachment_id: str, account_id: int = None) -> Tuple[str, str, int]:
+    """Stream một attachment từ Graph vào store"""
+    response = open_attachment_stream(access_token, message_id, attachment_id, account_id)
+    try:
+        return store_chunks(response.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE))
+    finally:
+        response.close()
+
+
+def download_message_attachments(db: Session, account_id: int, email: Email) -> List[Dict[str, Any]]:
+    """
+    Tải tất cả file đính kèm (không phải item attachment) của một email vào store
+    và ghi đường dẫn + hash vào bảng email_attachments
+    """
+    access_token = get_valid_access_token(db, account_id)
+    stored = []
+
+    for attachment in get_attachments_metadata(access_token, email.message_id, account_id):
+        # itemAttachment / referenceAttachment không có $value dạng file
+        odata_type = attachment.get("@odata.type", "#microsoft.graph.fileAttachment")
+        if odata_type != "#microsoft.graph.fileAttachment":
+            continue
+
+        existing = get_email_attachment(db, email.id, attachment.get("id"))
+        if existing and existing.content_hash and os.path.exists(get_attachment_path(existing.content_hash)):
+            content_hash, file_path = existing.content_hash, existing.file_path
+        else:
+            content_hash, file_path, _ = download_attachment(
+                access_token, email.message_id, attachment.get("id"), account_id
+            )
+
+        db_attachment = save_email_attachment(db, email.id, attachment, file_path, content_hash)
+        stored.append(attachment_to_dict(db_attachment))
+
+    print(f"📎 Stored {len(stored)} attachments for message {email.message_id}")
+    return stored
+
+
+def get_attachments_list(db: Session, account_id: int, message_id: str) -> List[Dict[str, Any]]:
+    """
+    Danh sách attachments của email: lấy từ database (metadata đã lưu lúc sync),
+    chỉ gọi Graph khi email chưa có metadata attachments
+    """
+    email = get_email_by_message_id(db, account_id, message_id)
+    if email and (email.attachments is not None or not email.has_attachments):
+        return [attachment_to_dict(a) for a in get_email_attachments(db, email.id)]
+
+    access_token = get_valid_access_token(db, account_id)
+    attachments = get_attachments_metadata(access_token, message_id, account_id)
+    if not email:
+        return attachments
+
+    print(f"📎 Cached metadata of {len(attachments)} attachments for message {message_id}")
+    return [attachment_to_dict(a) for a in save_attachments_metadata(db, email, attachments)]
+
+
+def get_cached_attachment(db: Session, account_id: int, email: Email, attachment_id: str) -> EmailAttachment:
+    """
+    Trả về attachment đã có trong store; lần truy cập đầu tiên thì tải từ Graph về store trước
+    """
+    db_attachment = get_email_attachment(db, email.id, attachment_id)
+    if db_attachment and db_attachment.content_hash and os.path.exists(get_attachment_path(db_attachment.content_hash)):
+        return db_attachment
+
+    access_token = get_valid_access_token(db, account_id)
+    attachment = get_attachment_metadata(access_token, email.message_id, attachment_id, account_id)
+    content_hash, file_path, _ = download_attachment(access_token, email.message_id, attachment_id, account_id)
+    print(f"📥 Cached attachment {attachment_id} as {content_hash[:12]}")
+    return save_email_attachment(db, email.id, attachment, file_path, content_hash)
+
+
+def migrate_base64_attachments(db: Session, batch_size: int = 100) -> int:
+    """
+    Chuyển các attachment cũ còn lưu base64 trong content_bytes sang store, sau đó xóa content_bytes
+    """
+    migrated = 0
+    while True:
+        attachments = db.query(EmailAttachment).filter(
+            EmailAttachment.content_bytes.isnot(None)
+        ).limit(batch_size).all()
+        if not attachments:
+            break
+
+        for attachment in attachments:
+            content_hash, file_path, _ = store_chunks([base64.b64decode(attachment.content_bytes)])
+            attachment.content_hash = content_hash
+            attachment.file_path = file_path
+            attachment.content_bytes = None
+            migrated += 1
+
+        db.commit()
+        print(f"📦 Migrated {migrated} attachments to store")
+
+    return migrated
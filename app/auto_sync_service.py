@@ -10,8 +10,25 @@ from sqlalchemy.orm import Session
 from sqlalchemy import and_
 
 from .services import EmailSyncService
+from .concurrent_sync_service import ConcurrentSyncService
 from .meta_receipt_service import MetaReceiptService
+from .circuit_breaker import AccountCircuitBreakerService
+from .webhook_service import webhook_service, ensure_subscription
 from .auth import refresh_access_token
+from .token_refresher import refresh_tokens
+from .request_budget import request_budget
+from .sync_registry import sync_registry
+from .backfill_planner import format_window_time
+from .config import (
+    DELTA_SYNC_ENABLED,
+    CONCURRENT_SYNC_ENABLED,
+    PROGRESSIVE_INITIAL_SYNC_ENABLED,
+    INITIAL_SYNC_RECENT_HOURS,
+    INITIAL_SYNC_DAYS,
+    INITIAL_SYNC_CHUNK_DAYS,
+    TOKEN_REFRESH_AHEAD_SECONDS
+)
+from crud import update_account, get_backfill_accounts
 from database import get_db
 from models import Account, AuthToken
 
@@ -25,6 +42,10 @@ class AutoSyncService:
         self.sync_interval = 60  # 1 minute - check for new day
         self.new_accounts = set()  # Track new accounts that need initial sync
         self.last_daily_sync_date = None  # Track last daily sync date
+        self.deferred_accounts = set()  # Accounts bị hoãn daily sync vì gần hết Graph request budget
+        self.processing_accounts = set()  # Accounts đang chạy initial sync (thread riêng hoặc sync loop)
+        self.lock = threading.Lock()
+        self.wake_event = threading.Event()
     
     def start_auto_sync(self):
         """Start the auto sync service"""
@@ -40,14 +61,23 @@ class AutoSyncService:
     def stop_auto_sync(self):
         """Stop the auto sync service"""
         self.is_running = False
+        self.wake_event.set()
         if self.sync_thread:
             self.sync_thread.join()
         print("Auto sync service stopped")
     
     def add_new_account(self, account_id: int):
-        """Add a new account to the sync queue"""
+        """
+        Add a new account to the sync queue.
+        Với progressive initial sync, phần gần nhất được sync ngay trên thread riêng thay vì chờ chu kỳ sync loop kế tiếp.
+        """
         self.new_accounts.add(account_id)
         print(f"Added account {account_id} to auto sync queue")
+        
+        if self.is_running and PROGRESSIVE_INITIAL_SYNC_ENABLED:
+            threading.Thread(target=self._process_new_accounts, args=([account_id],), daemon=True).start()
+        else:
+            self.wake_event.set()
     
     def _sync_loop(self):
         """Main sync loop that runs in background thread"""
@@ -55,20 +85,41 @@ class AutoSyncService:
             try:
                 self._process_new_accounts()
                 self._check_and_process_daily_sync()
-                time.sleep(self.sync_interval)
+                self._process_deferred_accounts()
+                # Còn chunk backfill thì chạy tiếp ngay, không chờ hết sync_interval
+                has_more_backfill = self._process_initial_backfill()
+                self.wake_event.wait(0 if has_more_backfill else self.sync_interval)
+                self.wake_event.clear()
             except Exception as e:
                 print(f"Error in auto sync loop: {str(e)}")
                 time.sleep(60)  # Wait 1 minute before retrying
     
-    def _process_new_accounts(self):
-        """Process new accounts that need initial sync"""
+    def _process_new_accounts(self, account_ids: List[int] = None):
+        """Process new accounts that need initial sync (hoặc chỉ account_ids)"""
         if not self.new_accounts:
             return
         
         db = next(get_db())
         try:
-            for account_id in list(self.new_accounts):
+            circuit_breaker = AccountCircuitBreakerService(db)
+            for account_id in account_ids or list(self.new_accounts):
+                # Account đang được xử lý ở thread khác
+                with self.lock:
+                    if account_id not in self.new_accounts or account_id in self.processing_accounts:
+                        continue
+                    self.processing_accounts.add(account_id)
+                
                 try:
+                    if not circuit_breaker.allow(account_id):
+                        continue
+                    
+                    # Initial sync tốn nhiều request: để chu kỳ sau nếu account gần hết budget.
+                    # Progressive: phần gần nhất ít request và người dùng đang chờ nên ưu tiên cao
+                    priority = "high" if PROGRESSIVE_INITIAL_SYNC_ENABLED else "low"
+                    if request_budget.should_defer(account_id, priority):
+                        print(f"⏸️ Deferring initial sync for account {account_id} (near Graph request budget)")
+                        continue
+                    
                     print(f"Processing initial sync for account {account_id}")
                     
                     # Check if account exists and has valid token
@@ -99,34 +150,136 @@ class AutoSyncService:
                             print(f"✅ Token refreshed for account {account_id}")
                         except Exception as e:
                             print(f"❌ Failed to refresh token for account {account_id}: {str(e)}")
+                            circuit_breaker.record_failure(account_id, e)
                             self.new_accounts.discard(account_id)
                             continue
                     
-                    # Perform initial monthly sync
-                    sync_service = EmailSyncService(db, account_id)
-                    result = sync_service.sync_monthly_emails()
-                    
-                    print(f"Initial sync completed for account {account_id}: {result['total_synced']} emails synced")
-                    
-                    # Process meta receipts
-                    meta_service = MetaReceiptService(db)
-                    meta_result = meta_service.process_account_emails(account_id)
+                    if PROGRESSIVE_INITIAL_SYNC_ENABLED:
+                        self._initial_recent_sync(db, account_id)
+                    else:
+                        # Perform initial monthly sync
+                        sync_service = EmailSyncService(db, account_id)
+                        result = sync_registry.run(
+                            account_id, "monthly", sync_service.sync_monthly_emails,
+                            datetime.utcnow().strftime('%Y-%m-%d')
+                        )
+                        
+                        print(f"Initial sync completed for account {account_id}: {result['total_synced']} emails synced")
+                        
+                        # Process meta receipts
+                        meta_service = MetaReceiptService(db)
+                        meta_result = meta_service.process_account_emails(account_id)
+                        
+                        print(f"Meta receipts processed for account {account_id}: {meta_result['processed_count']} receipts")
                     
-                    print(f"Meta receipts processed for account {account_id}: {meta_result['processed_count']} receipts")
+                    # Đăng ký change notifications để nhận email mới mà không chờ daily sync
+                    if webhook_service.enabled:
+                        try:
+                            ensure_subscription(db, account_id)
+                        except Exception as e:
+                            print(f"⚠️ Failed to create subscription for account {account_id}: {str(e)}")
                     
                     # Remove from new accounts set
                     self.new_accounts.discard(account_id)
+                    circuit_breaker.record_success(account_id)
                     
                 except Exception as e:
                     print(f"Error processing account {account_id}: {str(e)}")
-                    # Keep in new_accounts set for retry
+                    # Keep in new_accounts set for retry (circuit breaker sẽ bỏ qua nếu lỗi liên tục)
+                    circuit_breaker.record_failure(account_id, e)
                     continue
+                finally:
+                    with self.lock:
+                        self.processing_accounts.discard(account_id)
                     
         except Exception as e:
             print(f"Error in _process_new_accounts: {str(e)}")
         finally:
             db.close()
     
+    def _initial_recent_sync(self, db: Session, account_id: int):
+        """
+        Bước đầu của progressive initial sync: sync và tạo meta receipts cho INITIAL_SYNC_RECENT_HOURS gần nhất,
+        phần còn lại của INITIAL_SYNC_DAYS được backfill dần (cursor lưu trong accounts.backfill_cursor)
+        """
+        started = time.monotonic()
+        now = datetime.utcnow()
+        recent_from = now - timedelta(hours=INITIAL_SYNC_RECENT_HOURS)
+        
+        sync_service = EmailSyncService(db, account_id)
+        result = sync_registry.run(
+            account_id, "initial-recent",
+            lambda: sync_service.sync_emails_by_date_range(format_window_time(recent_from)),
+            format_window_time(recent_from)
+        )
+        meta_result = MetaReceiptService(db).process_new_emails(account_id, recent_from)
+        
+        print(f"⚡ Initial sync of last {INITIAL_SYNC_RECENT_HOURS}h for account {account_id}: "
+              f"{result['synced_count']} emails, {meta_result['created_count']} receipts in {time.monotonic() - started:.1f}s")
+        
+        update_account(
+            db, account_id,
+            backfill_cursor=recent_from,
+            backfill_stop_at=now - timedelta(days=INITIAL_SYNC_DAYS)
+        )
+    
+    def _process_initial_backfill(self) -> bool:
+        """
+        Backfill một chunk (INITIAL_SYNC_CHUNK_DAYS, mới trước cũ sau) cho mỗi account còn backfill_cursor.
+        Cursor chỉ lùi khi mọi window của chunk sync thành công, window lỗi thì cả chunk được chạy lại chu kỳ sau.
+        Việc ưu tiên thấp: account gần hết budget được để chu kỳ sau. Trả về True nếu đã chạy chunk và còn chunk khác.
+        """
+        processed = False
+        remaining = False
+        db = next(get_db())
+        try:
+            backfill_accounts = [
+                (account.id, account.backfill_cursor, account.backfill_stop_at) for account in get_backfill_accounts(db)
+            ]
+            if not backfill_accounts:
+                return False
+            
+            circuit_breaker = AccountCircuitBreakerService(db)
+            for account_id, chunk_end, backfill_from in backfill_accounts:
+                if not circuit_breaker.allow(account_id) or request_budget.should_defer(account_id, "low"):
+                    remaining = True
+                    continue
+                
+                chunk_start = max(backfill_from, chunk_end - timedelta(days=INITIAL_SYNC_CHUNK_DAYS))
+                try:
+                    sync_service = EmailSyncService(db, account_id)
+                    result = sync_registry.run(
+                        account_id, "initial-backfill",
+                        lambda: sync_service.sync_time_range(chunk_start, chunk_end),
+                        f"{format_window_time(chunk_start)}:{format_window_time(chunk_end)}"
+                    )
+                    meta_result = MetaReceiptService(db).process_new_emails(account_id, chunk_start, chunk_end)
+                    print(f"📥 Initial backfill {chunk_start.date()} → {chunk_end.date()} for account {account_id}: "
+                          f"{result['total_synced']} emails, {meta_result['created_count']} receipts")
+                    
+                    failed = [detail for detail in result["details"] if "error" in detail]
+                    if failed:
+                        remaining = True
+                        raise RuntimeError(
+                            f"{len(failed)}/{len(result['details'])} windows failed, chunk will be retried: {failed[0]['error']}"
+                        )
+                    
+                    if chunk_start <= backfill_from:
+                        update_account(db, account_id, backfill_cursor=None, backfill_stop_at=None)
+                        print(f"✅ Initial backfill completed for account {account_id}")
+                    else:
+                        update_account(db, account_id, backfill_cursor=chunk_start)
+                        remaining = True
+                    processed = True
+                    circuit_breaker.record_success(account_id)
+                except Exception as e:
+                    print(f"❌ Error in initial backfill for account {account_id}: {str(e)}")
+                    circuit_breaker.record_failure(account_id, e)
+        finally:
+            db.close()
+        
+        return processed and remaining
+    
     def _check_and_process_daily_sync(self):
         """Check if it's a new day and process daily sync once per day"""
         current_date = datetime.utcnow().date()
@@ -134,12 +287,35 @@ class AutoSyncService:
         # If we haven't done daily sync today, do it
         if self.last_daily_sync_date != current_date:
             print(f"🔄 Starting daily sync for date: {current_date}")
+            self.deferred_accounts.clear()
             self._process_daily_sync()
             self.last_daily_sync_date = current_date
             print(f"✅ Daily sync completed for date: {current_date}")
     
-    def _process_daily_sync(self):
-        """Process daily sync for all active accounts (runs once per day)"""
+    def _process_deferred_accounts(self):
+        """Chạy lại daily sync cho các account đã bị hoãn khi budget cho phép"""
+        if not self.deferred_accounts:
+            return
+        
+        ready = [
+            account_id for account_id in self.deferred_accounts
+            if not request_budget.should_defer(account_id, "normal")
+        ]
+        if ready:
+            print(f"▶️ Resuming deferred daily sync for accounts {ready}")
+            self._process_daily_sync(ready)
+    
+    def _defer_if_over_budget(self, account_id: int) -> bool:
+        """Hoãn daily sync của account nếu gần hết budget (chạy lại ở _process_deferred_accounts)"""
+        if request_budget.should_defer(account_id, "normal"):
+            self.deferred_accounts.add(account_id)
+            print(f"⏸️ Deferring daily sync for account {account_id} (near Graph request budget)")
+            return True
+        self.deferred_accounts.discard(account_id)
+        return False
+    
+    def _process_daily_sync(self, account_ids: List[int] = None):
+        """Process daily sync for all active accounts (runs once per day), hoặc chỉ các account_ids đã bị hoãn"""
         db = next(get_db())
         try:
             # Get all active accounts with tokens (we'll refresh expired ones)
@@ -150,6 +326,11 @@ class AutoSyncService:
                 )
             ).all()
             
+            if account_ids is not None:
+                # Account không còn active thì bỏ khỏi danh sách hoãn
+                self.deferred_accounts.intersection_update(account.id for account in active_accounts)
+                active_accounts = [account for account in active_accounts if account.id in account_ids]
+            
             total_accounts = len(active_accounts)
             processed_accounts = 0
             total_emails_synced = 0
@@ -157,6 +338,23 @@ class AutoSyncService:
             
             print(f"📊 Processing daily sync for {total_accounts} active accounts")
             
+            circuit_breaker = AccountCircuitBreakerService(db)
+            
+            # Refresh song song token đã / sắp hết hạn trước khi sync (account lỗi được refresh lại từng cái bên dưới)
+            try:
+                refresh_tokens(
+                    db,
+                    [account.id for account in active_accounts if circuit_breaker.allow(account.id)],
+                    within_seconds=TOKEN_REFRESH_AHEAD_SECONDS,
+                    circuit_breaker=circuit_breaker
+                )
+            except Exception as e:
+                print(f"❌ Bulk token refresh failed: {str(e)}")
+            
+            if CONCURRENT_SYNC_ENABLED:
+                self._process_daily_sync_concurrent(db, active_accounts, circuit_breaker)
+                return
+            
             for account in active_accounts:
                 try:
                     # Check if account needs daily sync (not in new_accounts)
@@ -164,6 +362,13 @@ class AutoSyncService:
                         print(f"⏭️ Skipping account {account.id} (in new accounts queue)")
                         continue
                     
+                    if not circuit_breaker.allow(account.id):
+                        print(f"⏭️ Skipping account {account.id} (circuit open)")
+                        continue
+                    
+                    if self._defer_if_over_budget(account.id):
+                        continue
+                    
                     print(f"📧 Processing daily sync for account {account.id} ({account.email})")
                     
                     # Check if token is expired and refresh if needed
@@ -181,11 +386,18 @@ class AutoSyncService:
                             print(f"✅ Token refreshed for account {account.id}")
                         except Exception as e:
                             print(f"❌ Failed to refresh token for account {account.id}: {str(e)}")
+                            circuit_breaker.record_failure(account.id, e)
                             continue
                     
-                    # Perform daily sync with max 999 emails
+                    # Perform daily sync (delta query nếu bật, ngược lại lấy cửa sổ hôm qua - hôm nay)
                     sync_service = EmailSyncService(db, account.id)
-                    result = sync_service.sync_daily_emails()
+                    if DELTA_SYNC_ENABLED:
+                        result = sync_registry.run(account.id, "delta", sync_service.sync_delta_emails)
+                    else:
+                        result = sync_registry.run(
+                            account.id, "daily", sync_service.sync_daily_emails,
+                            datetime.utcnow().strftime('%Y-%m-%d')
+                        )
                     
                     emails_synced = result['total_synced']
                     total_emails_synced += emails_synced
@@ -206,9 +418,11 @@ class AutoSyncService:
                         print(f"ℹ️ No new emails for account {account.id}")
                     
                     processed_accounts += 1
+                    circuit_breaker.record_success(account.id)
                     
                 except Exception as e:
                     print(f"❌ Error processing daily sync for account {account.id}: {str(e)}")
+                    circuit_breaker.record_failure(account.id, e)
                     continue
             
             print(f"📈 Daily sync summary: {processed_accounts}/{total_accounts} accounts processed")
@@ -220,14 +434,113 @@ class AutoSyncService:
         finally:
             db.close()
     
+    def _process_daily_sync_concurrent(
+        self,
+        db: Session,
+        active_accounts: List[Account],
+        circuit_breaker: AccountCircuitBreakerService
+    ):
+        """Daily sync với Graph requests của các account chạy song song"""
+        account_ids = []
+        for account in active_accounts:
+            if account.id in self.new_accounts:
+                print(f"⏭️ Skipping account {account.id} (in new accounts queue)")
+                continue
+            
+            if not circuit_breaker.allow(account.id):
+                print(f"⏭️ Skipping account {account.id} (circuit open)")
+                continue
+            
+            if self._defer_if_over_budget(account.id):
+                continue
+            
+            # Check if token is expired and refresh if needed
+            auth_token = db.query(AuthToken).filter(
+                and_(
+                    AuthToken.account_id == account.id,
+                    AuthToken.is_active == True
+                )
+            ).first()
+            
+            if auth_token and auth_token.expires_at <= datetime.utcnow():
+                print(f"🔄 Token expired for account {account.id}, refreshing...")
+                try:
+                    refresh_access_token(db, account.id)
+                    print(f"✅ Token refreshed for account {account.id}")
+                except Exception as e:
+                    print(f"❌ Failed to refresh token for account {account.id}: {str(e)}")
+                    circuit_breaker.record_failure(account.id, e)
+                    continue
+            
+            account_ids.append(account.id)
+        
+        concurrent_service = ConcurrentSyncService(db)
+        if DELTA_SYNC_ENABLED:
+            results = concurrent_service.sync_accounts_delta(account_ids)
+        else:
+            today = datetime.utcnow().date()
+            results = concurrent_service.sync_accounts_by_date_range(
+                account_ids,
+                (today - timedelta(days=1)).strftime('%Y-%m-%d'),
+                today.strftime('%Y-%m-%d')
+            )
+        
+        processed_accounts = 0
+        total_emails_synced = 0
+        total_receipts_processed = 0
+        
+        for account_id, result in results.items():
+            if "error" in result:
+                print(f"❌ Error processing daily sync for account {account_id}: {result['error']}")
+                circuit_breaker.record_failure(account_id, Exception(result['error']))
+                continue
+            
+            emails_synced = result['total_synced']
+            total_emails_synced += emails_synced
+            processed_accounts += 1
+            circuit_breaker.record_success(account_id)
+            
+            if emails_synced > 0:
+                print(f"✅ Daily sync completed for account {account_id}: {emails_synced} new emails")
+                
+                # Process new meta receipts
+                meta_result = MetaReceiptService(db).process_account_emails(account_id)
+                receipts_processed = meta_result.get('processed_count', 0)
+                total_receipts_processed += receipts_processed
+                
+                if receipts_processed > 0:
+                    print(f"📄 Meta receipts processed for account {account_id}: {receipts_processed} receipts")
+            else:
+                print(f"ℹ️ No new emails for account {account_id}")
+        
+        print(f"📈 Daily sync summary: {processed_accounts}/{len(active_accounts)} accounts processed")
+        print(f"📧 Total emails synced: {total_emails_synced}")
+        print(f"📄 Total receipts processed: {total_receipts_processed}")
+    
     def get_sync_status(self) -> Dict[str, Any]:
         """Get current sync service status"""
         return {
             "is_running": self.is_running,
             "sync_interval": self.sync_interval,
             "new_accounts_count": len(self.new_accounts),
-            "new_accounts": list(self.new_accounts)
+            "new_accounts": list(self.new_accounts),
+            "deferred_accounts": list(self.deferred_accounts),
+            "backfill_accounts": self._get_backfill_status()
         }
+    
+    def _get_backfill_status(self) -> Dict[int, Dict[str, str]]:
+        """Cursor backfill của các account còn progressive initial backfill"""
+        db = next(get_db())
+        try:
+            return {
+                account.id: {
+                    "backfilled_until": account.backfill_cursor.isoformat(),
+                    "backfill_from": account.backfill_stop_at.isoformat()
+                }
+                for account in get_backfill_accounts(db)
+            }
+        finally:
+            db.close()
 
 
 # Global instance
@@ -0,0 +1,103 @@
+"""
+Backfill planner: chia khoảng thời gian cần đồng bộ thành các window theo số email ($count)
+thay vì theo ngày. Window dày được chia đôi, window thưa được gộp lại, window rỗng bị bỏ qua,
+nên số request tỉ lệ với lượng email chứ không phải số ngày.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from .config import (
+    BACKFILL_TARGET_WINDOW_SIZE,
+    BACKFILL_MIN_WINDOW_MINUTES,
+    BACKFILL_MAX_WORKERS
+)
+from .graph_api import count_emails_in_graph
+
+# (bắt đầu, kết thúc, số email) - khoảng [bắt đầu, kết thúc)
+Window = Tuple[datetime, datetime, int]
+
+
+def format_window_time(value: datetime) -> str:
+    """Thời điểm dạng dùng được trong $filter của build_email_filter"""
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class BackfillPlanner:
+    """Lập kế hoạch window cho một account"""
+
+    def __init__(
+        self,
+        access_token: str,
+        account_id: int,
+        target_size: int = BACKFILL_TARGET_WINDOW_SIZE,
+        max_workers: int = BACKFILL_MAX_WORKERS,
+        folder_ids: List[str] = None
+    ):
+        self.access_token = access_token
+        self.account_id = account_id
+        self.folder_ids = folder_ids  # Đếm trong các folder được sync (None: /me/messages)
+        self.target_size = target_size
+        self.max_workers = max_workers
+        self.count_requests = 0
+
+    def _count(self, window: Tuple[datetime, datetime]) -> int:
+        self.count_requests += len(self.folder_ids) if self.folder_ids is not None else 1
+        return count_emails_in_graph(
+            self.access_token,
+            self.account_id,
+            format_window_time(window[0]),
+            format_window_time(window[1]),
+            folder_ids=self.folder_ids
+        )
+
+    def _count_all(self, windows: List[Tuple[datetime, datetime]]) -> List[int]:
+        """Đếm nhiều window song song (graph_scheduler giới hạn theo mailbox)"""
+        if len(windows) <= 1 or self.max_workers <= 1:
+            return [self._count(window) for window in windows]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self._count, windows))
+
+    def plan(self, start: datetime, end: datetime) -> List[Window]:
+        """
+        Trả về các window không rỗng, mỗi window khoảng target_size email (trừ window
+        đã nhỏ tới BACKFILL_MIN_WINDOW_MINUTES), sắp xếp theo thời gian
+        """
+        # Bắt đầu từ cả khoảng rồi chia đôi dần: nửa không có email bị bỏ ngay, không tốn thêm request
+        pending = [(start, end, self._count((start, end)))]
+        min_split = timedelta(minutes=BACKFILL_MIN_WINDOW_MINUTES) * 2
+        planned = []
+
+        while pending:
+            to_split = []
+            for window in pending:
+                window_start, window_end, count = window
+                if count > self.target_size and window_end - window_start >= min_split:
+                    to_split.append(window)
+                elif count > 0:
+                    planned.append(window)
+
+            # Chỉ cần đếm nửa đầu, nửa sau = tổng - nửa đầu
+            halves = []
+            for window_start, window_end, _ in to_split:
+                middle = window_start + (window_end - window_start) / 2
+                halves.append((window_start, middle.replace(second=0, microsecond=0)))
+            first_counts = self._count_all(halves)
+
+            pending = []
+            for (window_start, window_end, count), (_, middle), first_count in zip(to_split, halves, first_counts):
+                pending.append((window_start, middle, first_count))
+                pending.append((middle, window_end, max(count - first_count, 0)))
+
+        return self._merge(sorted(planned))
+
+    def _merge(self, windows: List[Window]) -> List[Window]:
+        """Gộp các window liền nhau (khoảng trống giữa chúng không có email) khi tổng không vượt target_size"""
+        merged: List[Window] = []
+        for window_start, window_end, count in windows:
+            if merged and merged[-1][2] + count <= self.target_size:
+                previous_start, _, previous_count = merged[-1]
+                merged[-1] = (previous_start, window_end, previous_count + count)
+            else:
+                merged.append((window_start, window_end, count))
+        return merged
@@ -0,0 +1,169 @@
+"""
+Circuit breaker theo account cho auto sync: bỏ qua các account liên tục lỗi
+(refresh token bị thu hồi, mailbox trả về 403, ...) thay vì gọi lại Microsoft mỗi chu kỳ
+"""
+import re
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Set, Tuple
+from sqlalchemy.orm import Session
+
+from .config import (
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+    CIRCUIT_BREAKER_FATAL_CLASSES,
+    CIRCUIT_BREAKER_BASE_COOLDOWN,
+    CIRCUIT_BREAKER_MAX_COOLDOWN,
+    THROTTLE_STATUS_CODES
+)
+from crud import (
+    get_circuit_breaker,
+    get_tripped_circuit_breakers,
+    get_failing_account_ids,
+    save_circuit_breaker,
+    reset_circuit_breaker
+)
+
+
+# Graph error code (error.code) / OAuth error (error) -> failure class
+INVALID_GRANT_ERRORS = {"invalid_grant", "interaction_required"}
+FORBIDDEN_ERROR_CODES = {"ErrorAccessDenied", "MailboxNotEnabledForRESTAPI", "ErrorMailboxNotEnabledForRESTAPI", "AccessDenied"}
+UNAUTHORIZED_ERROR_CODES = {"InvalidAuthenticationToken", "CompactToken.ParsingFailure"}
+THROTTLED_ERROR_CODES = {"TooManyRequests", "ApplicationThrottled", "ErrorServerBusy"}
+
+# HTTPException bị bọc lại: "500: 403" / "500: 401: Failed to refresh token ...", status trong cùng là lỗi gốc
+_STATUS_PREFIX = re.compile(r"^\d{3}(?:: \d{3})*(?=: |$)")
+_ERROR_CODE = re.compile(r'"(?:code|error)"\s*:\s*"([^"]+)"')
+
+
+def _failure_status_and_codes(error: Exception) -> Tuple[Optional[int], Set[str]]:
+    """Status code gốc và các error code (Graph / OAuth) trong body lỗi"""
+    detail = getattr(error, "detail", None)
+    message = f"{error.status_code}: {detail}" if hasattr(error, "status_code") else str(error)
+    status_code = None
+    prefix = _STATUS_PREFIX.match(message)
+    if prefix:
+        status_code = int(prefix.group(0).split(": ")[-1])
+    return status_code, set(_ERROR_CODE.findall(message))
+
+
+def classify_failure(error: Exception) -> str:
+    """
+    Phân loại lỗi theo status code và error code của Graph / OAuth (không tìm chuỗi "403" trong cả message,
+    vì request-id / GUID trong body có thể chứa các số này): invalid_grant, forbidden, unauthorized, throttled, transient
+    """
+    status_code, codes = _failure_status_and_codes(error)
+    
+    if codes & INVALID_GRANT_ERRORS:
+        return "invalid_grant"
+    if status_code == 403 or codes & FORBIDDEN_ERROR_CODES:
+        return "forbidden"
+    if status_code == 401 or codes & UNAUTHORIZED_ERROR_CODES:
+        return "unauthorized"
+    if status_code in THROTTLE_STATUS_CODES or codes & THROTTLED_ERROR_CODES:
+        return "throttled"
+    return "transient"
+
+
+class AccountCircuitBreakerService:
+    """
+    Trạng thái của các account đang open / half-open (và account closed còn lỗi liên tiếp) được load một lần
+    khi khởi tạo, nên allow() / record_success() là O(1) và không tốn query với các account bình thường
+    """
+    
+    def __init__(self, db: Session):
+        self.db = db
+        self.tripped: Dict[int, Any] = {
+            breaker.account_id: breaker for breaker in get_tripped_circuit_breakers(db)
+        }
+        self.failing = set(get_failing_account_ids(db))
+    
+    def allow(self, account_id: int) -> bool:
+        """Account có được sync ở chu kỳ này không (open và chưa tới giờ probe thì bỏ qua)"""
+        breaker = self.tripped.get(account_id)
+        if not breaker:
+            return True
+        
+        if breaker.state == "open":
+            if breaker.next_probe_at and datetime.utcnow() < breaker.next_probe_at:
+                return False
+            # Hết thời gian chờ: cho phép 1 lần probe
+            breaker = save_circuit_breaker(self.db, account_id, state="half_open")
+            self.tripped[account_id] = breaker
+            print(f"🔌 Circuit half-open for account {account_id}, probing")
+        
+        return True
+    
+    def record_success(self, account_id: int):
+        """Sync thành công: đóng circuit nếu đang open / half-open"""
+        if account_id in self.tripped:
+            reset_circuit_breaker(self.db, account_id)
+            del self.tripped[account_id]
+            print(f"🔌 Circuit closed for account {account_id}")
+            return
+        
+        # Circuit vẫn closed nhưng đã có lỗi trước đó: reset bộ đếm lỗi liên tiếp
+        if account_id in self.failing:
+            reset_circuit_breaker(self.db, account_id)
+            self.failing.discard(account_id)
+    
+    def record_failure(self, account_id: int, error: Exception) -> str:
+        """Ghi nhận lỗi, open circuit khi vượt ngưỡng. Trả về failure class"""
+        failure_class = classify_failure(error)
+        breaker = self.tripped.get(account_id) or get_circuit_breaker(self.db, account_id)
+        
+        failure_count = (breaker.failure_count if breaker else 0) + 1
+        open_count = breaker.open_count if breaker else 0
+        half_open = breaker is not None and breaker.state == "half_open"
+        
+        should_open = (
+            half_open
+            or failure_count >= CIRCUIT_BREAKER_FAILURE_THRESHOLD
+            or failure_class in CIRCUIT_BREAKER_FATAL_CLASSES
+        )
+        
+        if not should_open:
+            save_circuit_breaker(
+                self.db, account_id,
+                state="closed",
+                failure_count=failure_count,
+                failure_class=failure_class,
+                last_error=str(error)
+            )
+            self.failing.add(account_id)
+            return failure_class
+        
+        open_count += 1
+        cooldown = min(
+            CIRCUIT_BREAKER_MAX_COOLDOWN,
+            CIRCUIT_BREAKER_BASE_COOLDOWN * (2 ** (open_count - 1))
+        )
+        now = datetime.utcnow()
+        breaker = save_circuit_breaker(
+            self.db, account_id,
+            state="open",
+            failure_count=failure_count,
+            open_count=open_count,
+            failure_class=failure_class,
+            last_error=str(error),
+            opened_at=now,
+            next_probe_at=now + timedelta(seconds=cooldown)
+        )
+        self.tripped[account_id] = breaker
+        print(f"🔌 Circuit opened for account {account_id} ({failure_class}), next probe at {breaker.next_probe_at}")
+        return failure_class
+
+
+def get_circuit_breaker_status(db: Session) -> List[Dict[str, Any]]:
+    """Danh sách các account đang bị open / half-open"""
+    return [
+        {
+            "account_id": breaker.account_id,
+            "state": breaker.state,
+            "failure_count": breaker.failure_count,
+            "open_count": breaker.open_count,
+            "failure_class": breaker.failure_class,
+            "last_error": breaker.last_error,
+            "opened_at": breaker.opened_at.isoformat() if breaker.opened_at else None,
+            "next_probe_at": breaker.next_probe_at.isoformat() if breaker.next_probe_at else None
+        }
+        for breaker in get_tripped_circuit_breakers(db)
+    ]
@@ -0,0 +1,236 @@
+"""
+Concurrent sync service - fetch nhiều account song song bằng AsyncGraphClient, ghi database theo batch.
+Delta sync chạy mỗi account một job (session riêng), áp dụng từng trang ngay khi nhận được.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from .async_graph_api import AsyncGraphClient
+from .auth import get_valid_access_token
+from .config import EMAIL_PAGE_SIZE, MULTI_FOLDER_SYNC_ENABLED, CONCURRENT_DELTA_MAX_WORKERS
+from .email_utils import is_meta_receipt_email, is_text_body_account, EMAIL_HEADER_SELECT_FIELDS
+from .meta_receipt_service import MetaReceiptService
+from .mail_folders import get_sync_folder_ids, invalidate_sync_folders
+from .services import EmailSyncService
+from .sync_registry import sync_registry
+from crud import (
+    bulk_create_emails,
+    bulk_update_emails_from_graph,
+    get_email_change_keys,
+    is_email_changed
+)
+from database import get_db
+
+
+class ConcurrentSyncService:
+    """
+    Đồng bộ nhiều account cùng lúc.
+    Sync theo ngày: network I/O chạy song song trong event loop (giới hạn bởi semaphore của AsyncGraphClient),
+    thao tác database chạy tuần tự trên session hiện tại, mỗi account ghi ngay khi body của account đó về đủ.
+    Delta sync: mỗi account một job trong thread pool, các trang được áp dụng ngay khi đọc xong.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def _get_access_tokens(self, account_ids: List[int], results: Dict[int, Dict[str, Any]]) -> Dict[int, str]:
+        """Lấy access token cho từng account trước khi vào event loop"""
+        tokens = {}
+        for account_id in account_ids:
+            try:
+                tokens[account_id] = get_valid_access_token(self.db, account_id)
+            except Exception as e:
+                results[account_id] = {"error": str(e)}
+        return tokens
+
+    def _get_sync_folders(self, tokens: Dict[int, str], results: Dict[int, Dict[str, Any]]) -> Dict[int, List[str]]:
+        """Folder cần sync của từng account (cache trong mail_folders), account lỗi bị bỏ khỏi tokens"""
+        folders = {}
+        for account_id in list(tokens):
+            try:
+                folders[account_id] = get_sync_folder_ids(self.db, account_id)
+            except Exception as e:
+                results[account_id] = {"error": str(e)}
+                tokens.pop(account_id)
+        return folders
+
+    def sync_accounts_by_date_range(
+        self,
+        account_ids: List[int],
+        received_from: str = None,
+        received_to: str = None,
+        top: int = EMAIL_PAGE_SIZE
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        Đồng bộ Meta receipt emails trong khoảng thời gian cho nhiều account song song.
+        Trả về dict account_id -> {"total_synced", "total_fetched"} hoặc {"error"}.
+        """
+        results: Dict[int, Dict[str, Any]] = {}
+        tokens = self._get_access_tokens(account_ids, results)
+        folders = self._get_sync_folders(tokens, results) if MULTI_FOLDER_SYNC_ENABLED else {}
+
+        # Phase 1: lấy header của tất cả account (và mọi folder của mỗi account) song song
+        headers_by_account = asyncio.run(
+            self._fetch_headers(tokens, received_from, received_to, top, folders)
+        )
+
+        # Chọn các receipt mới hoặc có changeKey khác với database (một query mỗi account)
+        candidates_by_account: Dict[int, List[str]] = {}
+        for account_id, fetched in headers_by_account.items():
+            if isinstance(fetched, Exception):
+                results[account_id] = {"error": str(fetched)}
+                continue
+
+            total_fetched, receipt_headers = fetched
+            change_keys = get_email_change_keys(
+                self.db, account_id, [email_header.get("id") for email_header in receipt_headers]
+            )
+            candidates_by_account[account_id] = [
+                email_header.get("id") for email_header in receipt_headers
+                if email_header.get("id") not in change_keys or is_email_changed(change_keys, email_header)
+            ]
+            results[account_id] = {"total_synced": 0, "total_fetched": total_fetched}
+
+        # Phase 2: lấy body song song, account nào về đủ body thì ghi database ngay
+        def write_account(account_id: int, messages: Dict[str, Dict[str, Any]]):
+            # Không ghi đồng thời với job sync khác của account (unique message_id).
+            # changeKey được đọc lại khi đã giữ lock: job khác có thể vừa ghi các email này
+            with sync_registry.account_lock(account_id):
+                fetched = [messages[message_id] for message_id in candidates_by_account[account_id] if message_id in messages]
+                change_keys = get_email_change_keys(self.db, account_id, [email_data.get("id") for email_data in fetched])
+                new_emails = [email_data for email_data in fetched if email_data.get("id") not in change_keys]
+                changed_emails = [
+                    email_data for email_data in fetched
+                    if email_data.get("id") in change_keys and is_email_changed(change_keys, email_data)
+                ]
+                if new_emails:
+                    bulk_create_emails(self.db, account_id, new_emails)
+                if changed_emails:
+                    updated_emails = bulk_update_emails_from_graph(self.db, account_id, changed_emails)
+                    MetaReceiptService(self.db).refresh_emails_receipts(account_id, updated_emails)
+            results[account_id]["total_synced"] = len(new_emails)
+            results[account_id]["updated_count"] = len(changed_emails)
+            print(f"✅ Synced {len(new_emails)} emails for account {account_id} ({len(changed_emails)} updated)")
+
+        errors = asyncio.run(
+            self._fetch_and_write_bodies({
+                account_id: (tokens[account_id], message_ids)
+                for account_id, message_ids in candidates_by_account.items()
+                if message_ids
+            }, write_account)
+        )
+        for account_id, error in errors.items():
+            if error is not None:
+                results[account_id]["error"] = str(error)
+
+        return results
+
+    def sync_accounts_delta(
+        self,
+        account_ids: List[int],
+        folder_id: str = None,
+        max_workers: int = CONCURRENT_DELTA_MAX_WORKERS
+    ) -> Dict[int, Dict[str, Any]]:
+        """
+        Delta sync cho nhiều account song song: mỗi account một job với session riêng,
+        đọc trang delta theo kiểu streaming và áp dụng từng trang vào database ngay khi nhận được.
+        folder_id None: mọi folder cần sync của account (xem EmailSyncService.sync_delta_emails)
+        """
+        results: Dict[int, Dict[str, Any]] = {}
+        if not account_ids:
+            return results
+
+        def sync_account(account_id: int) -> Dict[str, Any]:
+            db = next(get_db())
+            try:
+                # Job delta chung với các request khác của account: deltaLink được đọc khi đã giữ lock
+                service = EmailSyncService(db, account_id)
+                return sync_registry.run(account_id, "delta", lambda: service.sync_delta_emails(folder_id), folder_id or "")
+            finally:
+                db.close()
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(account_ids)))) as executor:
+            futures = {executor.submit(sync_account, account_id): account_id for account_id in account_ids}
+            for future in as_completed(futures):
+                account_id = futures[future]
+                try:
+                    results[account_id] = future.result()
+                except Exception as e:
+                    results[account_id] = {"error": str(e)}
+
+        return results
+
+    async def _fetch_headers(
+        self,
+        tokens: Dict[int, str],
+        received_from: str,
+        received_to: str,
+        top: int,
+        folders: Dict[int, List[str]]
+    ) -> Dict[int, Any]:
+        async with AsyncGraphClient() as client:
+            async def fetch_folder(account_id: int, access_token: str, folder_id: str = None):
+                pages = []
+                try:
+                    async for page in client.get_email_pages(
+                        account_id, access_token, top, received_from, received_to,
+                        meta_only=True, select=EMAIL_HEADER_SELECT_FIELDS, folder_id=folder_id
+                    ):
+                        pages.append(page)
+                except HTTPException as e:
+                    # Folder đã bị xóa: bỏ qua, lần sync sau liệt kê lại folder
+                    if e.status_code != 404 or folder_id is None:
+                        raise
+                    print(f"⚠️ Mail folder {folder_id} not found for account {account_id}, skipping")
+                    invalidate_sync_folders(account_id)
+                return pages
+
+            async def fetch_account(account_id: int, access_token: str):
+                folder_pages = await asyncio.gather(*(
+                    fetch_folder(account_id, access_token, folder_id)
+                    for folder_id in folders.get(account_id) or [None]
+                ))
+
+                # Cùng một email có thể xuất hiện ở hai folder nếu bị chuyển trong lúc đang quét
+                total_fetched = 0
+                receipt_headers = {}
+                for page in (page for pages in folder_pages for page in pages):
+                    total_fetched += len(page)
+                    for email_header in page:
+                        if is_meta_receipt_email(email_header.get("subject") or ""):
+                            receipt_headers.setdefault(email_header.get("id"), email_header)
+                return total_fetched, list(receipt_headers.values())
+
+            return await self._gather_by_account({
+                account_id: fetch_account(account_id, access_token)
+                for account_id, access_token in tokens.items()
+            })
+
+    async def _fetch_and_write_bodies(self, requests_by_account: Dict[int, Any], write_account) -> Dict[int, Any]:
+        """Lấy body từng account song song, ghi database (tuần tự giữa các account) ngay khi account đó xong"""
+        write_lock = asyncio.Lock()
+
+        async with AsyncGraphClient() as client:
+            async def fetch_account(account_id: int, access_token: str, message_ids: List[str]):
+                messages = await client.get_messages_batch(
+                    account_id, access_token, message_ids,
+                    text_body=is_text_body_account(account_id)
+                )
+                # Session dùng chung: chỉ một account ghi tại một thời điểm, ngoài event loop
+                async with write_lock:
+                    await asyncio.to_thread(write_account, account_id, messages)
+
+            return await self._gather_by_account({
+                account_id: fetch_account(account_id, access_token, message_ids)
+                for account_id, (access_token, message_ids) in requests_by_account.items()
+            })
+
+    @staticmethod
+    async def _gather_by_account(coroutines: Dict[int, Any]) -> Dict[int, Any]:
+        """Chạy song song, lỗi của một account không ảnh hưởng các account khác"""
+        account_ids = list(coroutines.keys())
+        outcomes = await asyncio.gather(*coroutines.values(), return_exceptions=True)
+        return dict(zip(account_ids, outcomes))
@@ -2,8 +2,27 @@
 Email processing utilities
 """
 import re
-from typing import Dict, Any
-from .config import META_RECEIPT_SUBJECTS
+from urllib.parse import quote
+from typing import Dict, Any, List
+from .config import (
+    META_RECEIPT_SUBJECTS,
+    META_RECEIPT_SENDERS,
+    TEXT_BODY_SYNC_ENABLED,
+    TEXT_BODY_ACCOUNT_IDS
+)
+
+# Các trường lấy về khi cần đầy đủ nội dung email
+EMAIL_SELECT_FIELDS = "id,subject,from,toRecipients,ccRecipients,bccRecipients,receivedDateTime,sentDateTime,isRead,hasAttachments,body,bodyPreview,importance,conversationId,conversationIndex,flag,categories,changeKey"
+# Các trường đủ để quyết định có cần tải body hay không (phase 1 của two-phase fetch)
+EMAIL_HEADER_SELECT_FIELDS = "id,subject,from,receivedDateTime,changeKey"
+# Thông tin mail folder dùng khi liệt kê folder cần sync
+MAIL_FOLDER_SELECT_FIELDS = "id,displayName,parentFolderId,childFolderCount,totalItemCount"
+# Metadata của attachment (không có contentBytes, nội dung được stream qua $value)
+ATTACHMENT_SELECT_FIELDS = "id,name,contentType,size,isInline,lastModifiedDateTime"
+# attachments là navigation property nên phải lấy qua $expand, kèm theo khi lấy đầy đủ email
+ATTACHMENT_EXPAND = f"attachments($select={ATTACHMENT_SELECT_FIELDS})"
+# Prefer header để Graph trả body dạng plain text thay vì HTML
+TEXT_BODY_PREFER = 'outlook.body-content-type="text"'
 
 
 def extract_meta_receipt_info(body_html: str) -> Dict[str, Any]:
@@ -56,30 +75,116 @@ def is_meta_receipt_email(subject: str) -> bool:
     return any(subject.startswith(pattern) for pattern in META_RECEIPT_SUBJECTS)
 
 
-def build_email_filter(received_from: str = None, received_to: str = None) -> str:
+def _odata_quote(value: str) -> str:
+    """
+    Đặt giá trị string vào dấu nháy đơn theo cú pháp OData (nháy đơn được nhân đôi)
+    """
+    return "'" + value.replace("'", "''") + "'"
+
+
+def build_email_filter(
+    received_from: str = None, 
+    received_to: str = None,
+    subjects: List[str] = None,
+    senders: List[str] = None
+) -> str:
     """
-    Xây dựng filter string cho Microsoft Graph API
+    Xây dựng filter string cho Microsoft Graph API.
+    received_from / received_to: ngày (YYYY-MM-DD, lấy cả ngày received_to)
+    hoặc thời điểm ISO 8601 (YYYY-MM-DDTHH:MM:SSZ, khoảng [received_from, received_to))
+    subjects: chỉ lấy email có tiêu đề bắt đầu bằng một trong các pattern
+    senders: chỉ lấy email gửi từ một trong các địa chỉ
     """
     filters = []
     
     if received_from:
-        filters.append(f"receivedDateTime ge {received_from}T00:00:00Z")
+        filters.append(f"receivedDateTime ge {received_from if 'T' in received_from else received_from + 'T00:00:00Z'}")
     if received_to:
-        filters.append(f"receivedDateTime le {received_to}T23:59:59Z")
+        if "T" in received_to:
+            filters.append(f"receivedDateTime lt {received_to}")
+        else:
+            filters.append(f"receivedDateTime le {received_to}T23:59:59Z")
+    if senders:
+        sender_filters = [f"from/emailAddress/address eq {_odata_quote(sender)}" for sender in senders]
+        filters.append(f"({' or '.join(sender_filters)})")
+    if subjects:
+        subject_filters = [f"startswith(subject,{_odata_quote(subject)})" for subject in subjects]
+        filters.append(f"({' or '.join(subject_filters)})")
     
     return ' and '.join(filters) if filters else None
 
 
-def get_email_api_params(top: int = 999, filter_str: str = None) -> Dict[str, Any]:
+def build_meta_receipt_filters(received_from: str = None, received_to: str = None) -> List[str]:
+    """
+    Tạo danh sách filter cho Meta receipt, từ chặt nhất tới lỏng nhất.
+    Một số tenant không hỗ trợ kết hợp subject + sender, khi đó dùng filter kế tiếp
+    và is_meta_receipt_email vẫn lọc lại phía client.
+    """
+    candidates = [
+        build_email_filter(received_from, received_to, META_RECEIPT_SUBJECTS, META_RECEIPT_SENDERS),
+        build_email_filter(received_from, received_to, senders=META_RECEIPT_SENDERS),
+        build_email_filter(received_from, received_to)
+    ]
+    
+    filters = []
+    for candidate in candidates:
+        if candidate not in filters:
+            filters.append(candidate)
+    return filters
+
+
+def get_email_api_params(top: int = 999, filter_str: str = None, select: str = EMAIL_SELECT_FIELDS) -> Dict[str, Any]:
     """
     Tạo parameters cho Microsoft Graph API email request
     """
     params = {
         "$top": top,
-        "$select": "id,subject,from,toRecipients,ccRecipients,bccRecipients,receivedDateTime,sentDateTime,isRead,hasAttachments,body,bodyPreview,importance,conversationId,conversationIndex,flag,categories,attachments",
+        "$select": select,
     }
+    if select == EMAIL_SELECT_FIELDS:
+        params["$expand"] = ATTACHMENT_EXPAND
     
     if filter_str:
         params["$filter"] = filter_str
     
-    return params 
\ No newline at end of file
+    return params
+
+
+def get_message_request_url(message_id: str, select: str = EMAIL_SELECT_FIELDS) -> str:
+    """
+    URL tương đối của một message cho request con trong JSON $batch
+    """
+    url = f"/me/messages/{quote(message_id, safe='=-_')}?$select={select}"
+    if select == EMAIL_SELECT_FIELDS:
+        url += f"&$expand={ATTACHMENT_EXPAND}"
+    return url
+
+
+def get_email_delta_params(filter_str: str = None) -> Dict[str, Any]:
+    """
+    Tạo parameters cho request delta đầu tiên (delta query không hỗ trợ $top và navigation property attachments)
+    """
+    params = {
+        "$select": EMAIL_SELECT_FIELDS,
+    }
+    
+    if filter_str:
+        params["$filter"] = filter_str
+    
+    return params
+
+
+def is_text_body_account(account_id: int) -> bool:
+    """
+    Account có sync ở text body mode không (xem TEXT_BODY_SYNC_ENABLED)
+    """
+    if not TEXT_BODY_SYNC_ENABLED:
+        return False
+    return not TEXT_BODY_ACCOUNT_IDS or account_id in TEXT_BODY_ACCOUNT_IDS
+
+
+def is_html_body(body: str) -> bool:
+    """
+    Kiểm tra body là HTML hay plain text (text body mode), chỉ xét phần đầu body
+    """
+    return bool(body) and re.search(r'<(html|head|body|div|table|td|p|br|span)\b', body[:4096], re.IGNORECASE) is not None
@@ -4,6 +4,7 @@ Email processing utilities using BeautifulSoup
 from typing import Dict, Any
 from bs4 import BeautifulSoup
 from .config import META_RECEIPT_SUBJECTS
+from .email_utils import is_html_body
 
 
 def convert_vietnamese_date_to_english(date_text: str) -> str:
@@ -305,11 +306,96 @@ def extract_meta_receipt_info_from_preview(body_preview: str) -> Dict[str, Any]:
     return meta_info
 
 
+def _value_after_label(lines: list, index: int, label: str) -> str:
+    """
+    Giá trị đi kèm label: phần còn lại của dòng sau label, nếu trống thì lấy dòng kế tiếp
+    """
+    line = lines[index]
+    rest = line[line.find(label) + len(label):].strip(' :\t')
+    if rest:
+        return rest
+    return lines[index + 1] if index + 1 < len(lines) else ''
+
+
+def extract_meta_receipt_info_from_text(body_text: str) -> Dict[str, Any]:
+    """
+    Trích xuất thông tin từ body dạng plain text (text body mode, Prefer: outlook.body-content-type="text").
+    Lấy đủ các trường MetaReceipt cần (account_id, transaction_id, payment, card_number, reference_number)
+    mà không cần parse HTML.
+    """
+    import re
+    
+    meta_info = {}
+    
+    if not body_text:
+        return meta_info
+    
+    lines = [line.strip() for line in body_text.split('\n') if line.strip()]
+    
+    # Pattern ngày tháng để tránh lấy nhầm làm transaction ID
+    vi_date_pattern = r'\d{1,2}:\d{2}\s+\d{1,2}\s+tháng\s+\d{1,2}'
+    en_date_pattern = r'\d{1,2}\s+(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s+\d{4}'
+    
+    for i, line in enumerate(lines):
+        # Account ID
+        label = next((k for k in ['Transaction for', 'Receipt for', 'Biên lai của', 'Giao dịch của'] if k in line), None)
+        if label and 'account_id' not in meta_info:
+            account_id_match = re.search(r'\((\d{10,})\)', _value_after_label(lines, i, label))
+            if account_id_match:
+                meta_info['account_id'] = account_id_match.group(1)
+            continue
+        
+        # Transaction ID
+        label = next((k for k in ['Transaction ID', 'ID giao dịch'] if k in line), None)
+        if label and 'transaction_id' not in meta_info:
+            transaction_id = _value_after_label(lines, i, label)
+            if (transaction_id and '-' in transaction_id and
+                not re.search(vi_date_pattern, transaction_id) and
+                not re.search(en_date_pattern, transaction_id)):
+                meta_info['transaction_id'] = transaction_id
+            continue
+        
+        # Card number
+        label = next((k for k in ['PAYMENT METHOD', 'Payment method', 'PHƯƠNG THỨC THANH TOÁN', 'Phương thức thanh toán'] if k in line), None)
+        if label and 'card_number' not in meta_info:
+            card_text = _value_after_label(lines, i, label)
+            if '·' in card_text:
+                meta_info.update(extract_card_info(card_text))
+            continue
+        
+        # Reference number
+        label = next((k for k in ['Reference number', 'Số tham chiếu'] if k in line), None)
+        if label and 'reference_number' not in meta_info:
+            meta_info['reference_number'] = _value_after_label(lines, i, label)
+            continue
+        
+        # Dòng thẻ không có label đi kèm (vd: "Visa · 1582")
+        if 'card_number' not in meta_info and re.search(r'·\s*\d+', line):
+            meta_info.update(extract_card_info(line))
+    
+    # Payment amount - cùng các pattern với extract_meta_receipt_info_by_css_selectors
+    payment_patterns = [
+        r'\$([\d,]+\.?\d*)\s*USD',  # $76.00 USD
+        r'([\d,]+\.?\d*)\s*US\$',   # 1,87 US$
+        r'([\d,]+\.?\d*)\s*USD',    # 1,87 USD
+        r'\$([\d,]+\.?\d*)',        # $76.00
+    ]
+    
+    for pattern in payment_patterns:
+        amount_match = re.search(pattern, body_text)
+        if amount_match:
+            meta_info['payment'] = amount_match.group(1).replace(',', '')
+            break
+    
+    return meta_info
+
+
 def extract_meta_receipt_info_combined(body_html: str = None, body_preview: str = None) -> Dict[str, Any]:
     """
     Trích xuất thông tin kết hợp từ cả body_html và body_preview.
     - body_preview: chỉ lấy account_id và transaction_id
     - body_html: lấy payment, card_number, reference_number và các thông tin khác
+      (body dạng plain text của text body mode được xử lý bằng extract_meta_receipt_info_from_text)
     """
     meta_info = {}
     
@@ -319,7 +405,9 @@ def extract_meta_receipt_info_combined(body_html: str = None, body_preview: str
         meta_info.update(preview_info)
     
     # Luôn lấy thông tin từ body_html cho payment, card_number, reference_number
-    if body_html:
+    if body_html and not is_html_body(body_html):
+        meta_info.update(extract_meta_receipt_info_from_text(body_html))
+    elif body_html:
         html_info = extract_meta_receipt_info_by_css_selectors(body_html)
         # Cập nhật tất cả thông tin từ body_html
         meta_info.update(html_info)
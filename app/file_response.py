@@ -0,0 +1,154 @@
+"""
+Response trả file từ đĩa có hỗ trợ Range, If-None-Match / If-Range và strong ETag.
+Dùng zero-copy sendfile (ASGI extension "http.response.zerocopysend") khi server hỗ trợ,
+ngược lại đọc file theo chunk trong threadpool.
+"""
+import os
+import re
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from .config import ATTACHMENT_CHUNK_SIZE
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+ZERO_COPY_EXTENSION = "http.response.zerocopysend"
+
+
+def parse_range(range_header: Optional[str], file_size: int) -> Tuple[Optional[Tuple[int, int]], bool]:
+    """
+    Parse header Range (chỉ hỗ trợ một khoảng). Trả về ((start, end), satisfiable).
+    Range không hợp lệ hoặc nhiều khoảng: (None, True) → trả cả file.
+    """
+    if not range_header:
+        return None, True
+
+    match = RANGE_PATTERN.match(range_header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None, True
+
+    start, end = match.group(1), match.group(2)
+    if not start:
+        # bytes=-N: N byte cuối
+        length = int(end)
+        if length == 0 or file_size == 0:
+            return None, False
+        return (max(file_size - length, 0), file_size - 1), True
+
+    start = int(start)
+    if start >= file_size:
+        return None, False
+    end = int(end) if end else file_size - 1
+    if start > end:
+        return None, True
+    return (start, min(end, file_size - 1)), True
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """So sánh If-None-Match / If-Range với ETag (bỏ qua tiền tố weak W/)"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in header.split(",")]
+    return etag in tags or f"W/{etag}" in tags
+
+
+class RangeFileResponse(Response):
+    """File response có Range/ETag, gửi bằng sendfile nếu ASGI server hỗ trợ"""
+
+    def __init__(
+        self,
+        path: str,
+        etag: str,
+        request_headers,
+        media_type: str = None,
+        filename: str = None,
+        cache_control: str = "private, max-age=31536000, immutable"
+    ):
+        self.path = path
+        self.file_size = os.stat(path).st_size
+        self.background = None
+        self.media_type = media_type or "application/octet-stream"
+        self.body = b""
+        self.range = None
+
+        headers = {
+            "etag": etag,
+            "accept-ranges": "bytes",
+            "cache-control": cache_control
+        }
+        if filename:
+            headers["content-disposition"] = f"attachment; filename*=utf-8''{quote(filename)}"
+
+        if etag_matches(request_headers.get("if-none-match"), etag):
+            self.status_code = 304
+            self.init_headers(headers)
+            return
+
+        range_header = request_headers.get("range")
+        # If-Range không khớp ETag hiện tại: bỏ qua Range, trả cả file
+        if range_header and request_headers.get("if-range") and request_headers.get("if-range").strip() != etag:
+            range_header = None
+
+        byte_range, satisfiable = parse_range(range_header, self.file_size)
+        if not satisfiable:
+            self.status_code = 416
+            headers["content-range"] = f"bytes */{self.file_size}"
+            headers["content-length"] = "0"
+            self.init_headers(headers)
+            return
+
+        if byte_range:
+            start, end = byte_range
+            self.status_code = 206
+            self.range = (start, end - start + 1)
+            headers["content-range"] = f"bytes {start}-{end}/{self.file_size}"
+        else:
+            self.status_code = 200
+            self.range = (0, self.file_size)
+
+        headers["content-type"] = self.media_type
+        headers["content-length"] = str(self.range[1])
+        self.init_headers(headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers
+        })
+
+        if self.range is None or scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        offset, count = self.range
+        with open(self.path, "rb") as file:
+            if ZERO_COPY_EXTENSION in scope.get("extensions", {}):
+                await send({
+                    "type": ZERO_COPY_EXTENSION,
+                    "file": file,
+                    "offset": offset,
+                    "count": count,
+                    "more_body": False
+                })
+                return
+
+            file.seek(offset)
+            remaining = count
+            more_body = True
+            while remaining > 0:
+                chunk = await anyio.to_thread.run_sync(file.read, min(ATTACHMENT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                more_body = remaining > 0
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        # File rỗng (chưa gửi chunk nào) hoặc file bị cắt ngắn: vẫn phải gửi message kết thúc body
+        if more_body:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
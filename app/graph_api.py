@@ -1,25 +1,89 @@
 """
 Microsoft Graph API functions
 """
-import requests
-from typing import Dict, Any, List
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from typing import Dict, Any, List, Iterator, Tuple, Optional, Callable
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
 
-from .config import GRAPH_API_BASE
+from .config import (
+    GRAPH_API_BASE,
+    EMAIL_PAGE_SIZE,
+    DELTA_SYNC_FOLDER,
+    GRAPH_BATCH_SIZE,
+    GRAPH_MAX_RETRIES,
+    IMMUTABLE_ID_TRANSLATE_BATCH_SIZE,
+    FOLDER_FETCH_MAX_WORKERS,
+    THROTTLE_STATUS_CODES
+)
 from .auth import get_valid_access_token
-from .email_utils import build_email_filter, get_email_api_params
+from .http_client import http_get, http_post, http_patch, http_delete
+from .graph_scheduler import graph_scheduler, compute_retry_delay
+from .json_stream import iter_json_items
+from .immutable_ids import with_immutable_id_prefer
+from .email_utils import (
+    get_message_request_url,
+    EMAIL_SELECT_FIELDS,
+    ATTACHMENT_SELECT_FIELDS,
+    MAIL_FOLDER_SELECT_FIELDS,
+    TEXT_BODY_PREFER,
+    build_email_filter,
+    build_meta_receipt_filters,
+    get_email_api_params,
+    get_email_delta_params
+)
 
+# Mức filter Meta receipt đã dùng được cho từng account (index trong build_meta_receipt_filters)
+_meta_filter_level_by_account: Dict[int, int] = {}
 
-def get_emails_from_graph(
-    db: Session, 
-    account_id: int, 
-    top: int = 999,
+
+_HTTP_METHODS = {
+    "GET": http_get,
+    "POST": http_post,
+    "PATCH": http_patch,
+    "DELETE": http_delete
+}
+
+
+def _graph_request(mailbox_key, method: str, url: str, cost: int = 1, **kwargs):
+    """Request tới Graph qua scheduler (rate limit theo mailbox, retry khi 429/5xx), kèm Prefer immutable ID nếu account dùng"""
+    kwargs["headers"] = with_immutable_id_prefer(kwargs.get("headers"), mailbox_key)
+    send = _HTTP_METHODS[method]
+    return graph_scheduler.execute(mailbox_key, lambda: send(url, **kwargs), cost=cost)
+
+
+def _graph_get(mailbox_key, url: str, **kwargs):
+    return _graph_request(mailbox_key, "GET", url, **kwargs)
+
+
+def _graph_post(mailbox_key, url: str, cost: int = 1, **kwargs):
+    return _graph_request(mailbox_key, "POST", url, cost=cost, **kwargs)
+
+
+def get_email_pages_from_graph(
+    db: Session,
+    account_id: int,
+    top: int = EMAIL_PAGE_SIZE,
     received_from: str = None,
-    received_to: str = None
-) -> Dict[str, Any]:
+    received_to: str = None,
+    meta_only: bool = False,
+    select: str = EMAIL_SELECT_FIELDS,
+    text_body: bool = False,
+    folder_ids: List[str] = None,
+    on_folder_missing: Callable[[str], None] = None
+) -> Iterator[List[Dict[str, Any]]]:
     """
-    Lấy emails từ Microsoft Graph API
+    Lấy emails từ Microsoft Graph API theo từng trang (đi theo @odata.nextLink).
+    Mỗi lần yield một trang, nên bộ nhớ chỉ phụ thuộc vào kích thước trang.
+    meta_only: lọc Meta receipt ngay phía server (subject + sender), tự lùi về
+    filter lỏng hơn nếu tenant trả về 400 cho filter kết hợp.
+    text_body: yêu cầu Graph trả body dạng plain text.
+    folder_ids: lấy song song từng mail folder (mỗi folder một nextLink riêng) và trộn các trang thành một luồng,
+    None thì quét /me/messages. on_folder_missing được gọi với folder trả về 404 (folder đã bị xóa).
     """
     try:
         access_token = get_valid_access_token(db, account_id)
@@ -28,16 +92,53 @@ def get_emails_from_graph(
             "Authorization": f"Bearer {access_token}",
             "Content-Type": "application/json"
         }
+        if text_body:
+            headers["Prefer"] = TEXT_BODY_PREFER
         
-        # Build filter và parameters
-        filter_str = build_email_filter(received_from, received_to)
-        params = get_email_api_params(top, filter_str)
-        
-        response = requests.get(
-            f"{GRAPH_API_BASE}/me/messages",
-            headers=headers,
-            params=params
+        fetch_pages = lambda folder_id: _iter_email_pages(
+            account_id, headers, top, received_from, received_to, meta_only, select, folder_id
         )
+        if folder_ids is None:
+            yield from fetch_pages(None)
+        else:
+            yield from _merge_folder_pages(account_id, folder_ids, fetch_pages, on_folder_missing)
+        
+    except Exception as e:
+        print(f"🔍 DEBUG: Error fetching email pages from Graph API: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _iter_email_pages(
+    account_id: int,
+    headers: Dict[str, str],
+    top: int,
+    received_from: str,
+    received_to: str,
+    meta_only: bool,
+    select: str,
+    folder_id: str = None
+) -> Iterator[List[Dict[str, Any]]]:
+    """Các trang email của một folder (hoặc /me/messages khi folder_id là None)"""
+    # Build filter và parameters cho trang đầu tiên
+    if meta_only:
+        filter_candidates = build_meta_receipt_filters(received_from, received_to)
+        level = min(_meta_filter_level_by_account.get(account_id, 0), len(filter_candidates) - 1)
+    else:
+        filter_candidates = [build_email_filter(received_from, received_to)]
+        level = 0
+    params = get_email_api_params(top, filter_candidates[level], select)
+    url = _messages_url(folder_id)
+    
+    while url:
+        response = _graph_get(account_id, url, headers=headers, params=params)
+        
+        # Filter không được hỗ trợ: thử filter lỏng hơn và ghi nhớ cho account này
+        if response.status_code == 400 and params and level + 1 < len(filter_candidates):
+            print(f"⚠️ Filter not supported for account {account_id}, falling back: {response.text}")
+            level += 1
+            _meta_filter_level_by_account[account_id] = level
+            params = get_email_api_params(top, filter_candidates[level], select)
+            continue
         
         if response.status_code != 200:
             raise HTTPException(
@@ -45,10 +146,302 @@ def get_emails_from_graph(
                 detail=f"Failed to fetch emails from Microsoft Graph: {response.text}"
             )
         
-        return response.json()
+        page = response.json()
+        yield page.get("value", [])
+        
+        # nextLink đã chứa sẵn toàn bộ query string
+        url = page.get("@odata.nextLink")
+        params = None
+
+
+def _messages_url(folder_id: str = None) -> str:
+    """URL collection message của folder, hoặc /me/messages khi folder_id là None"""
+    if folder_id:
+        return f"{GRAPH_API_BASE}/me/mailFolders/{quote(folder_id, safe='=-_')}/messages"
+    return f"{GRAPH_API_BASE}/me/messages"
+
+
+def _merge_folder_pages(
+    account_id: int,
+    folder_ids: List[str],
+    fetch_pages: Callable[[str], Iterator[List[Dict[str, Any]]]],
+    on_folder_missing: Callable[[str], None] = None
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Lấy các folder song song (tối đa FOLDER_FETCH_MAX_WORKERS thread), yield trang theo thứ tự về tới.
+    Hàng đợi có giới hạn nên folder nhanh phải chờ bên gọi xử lý xong trang trước; bên gọi giữ DB session
+    nên mọi thao tác ghi vẫn chạy trên một thread. Folder không còn tồn tại (404) bị bỏ qua.
+    """
+    pages = queue.Queue(maxsize=2 * FOLDER_FETCH_MAX_WORKERS)
+    stopped = threading.Event()
+    done = object()
+    
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def fetch_folder(folder_id: str):
+        try:
+            for page in fetch_pages(folder_id):
+                if not put(page):
+                    return
+            put(done)
+        except HTTPException as e:
+            if e.status_code == 404:
+                print(f"⚠️ Mail folder {folder_id} not found for account {account_id}, skipping")
+                if on_folder_missing:
+                    on_folder_missing(folder_id)
+                put(done)
+            else:
+                put(e)
+        except Exception as e:
+            put(e)
+    
+    executor = ThreadPoolExecutor(max_workers=max(1, min(FOLDER_FETCH_MAX_WORKERS, len(folder_ids))))
+    try:
+        for folder_id in folder_ids:
+            executor.submit(fetch_folder, folder_id)
+        
+        # Cùng một email có thể xuất hiện ở hai folder nếu bị chuyển trong lúc đang quét
+        seen_ids = set()
+        remaining = len(folder_ids)
+        while remaining:
+            item = pages.get()
+            if item is done:
+                remaining -= 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            page = [email for email in item if email.get("id") not in seen_ids]
+            seen_ids.update(email.get("id") for email in page)
+            yield page
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True)
+
+
+def count_emails_in_graph(
+    access_token: str,
+    account_id: int,
+    received_from: str = None,
+    received_to: str = None,
+    meta_only: bool = True,
+    folder_ids: List[str] = None
+) -> int:
+    """
+    Đếm số email trong khoảng thời gian bằng $count=true (chỉ lấy 1 id), dùng cùng filter với
+    get_email_pages_from_graph để kích thước window khớp với lúc sync.
+    folder_ids: tổng số email của các mail folder (folder không còn tồn tại tính là 0), None thì đếm /me/messages
+    """
+    if folder_ids is None:
+        return _count_folder_emails(access_token, account_id, received_from, received_to, meta_only)
+    
+    total = 0
+    for folder_id in folder_ids:
+        try:
+            total += _count_folder_emails(access_token, account_id, received_from, received_to, meta_only, folder_id)
+        except HTTPException as e:
+            if e.status_code != 404:
+                raise
+            print(f"⚠️ Mail folder {folder_id} not found for account {account_id}, skipping")
+    return total
+
+
+def _count_folder_emails(
+    access_token: str,
+    account_id: int,
+    received_from: str,
+    received_to: str,
+    meta_only: bool,
+    folder_id: str = None
+) -> int:
+    """$count của một folder (hoặc /me/messages khi folder_id là None)"""
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if meta_only:
+        filter_candidates = build_meta_receipt_filters(received_from, received_to)
+        level = min(_meta_filter_level_by_account.get(account_id, 0), len(filter_candidates) - 1)
+    else:
+        filter_candidates = [build_email_filter(received_from, received_to)]
+        level = 0
+    
+    while True:
+        params = get_email_api_params(1, filter_candidates[level], "id")
+        params["$count"] = "true"
+        response = _graph_get(account_id, _messages_url(folder_id), headers=headers, params=params)
+        
+        if response.status_code == 400 and level + 1 < len(filter_candidates):
+            level += 1
+            _meta_filter_level_by_account[account_id] = level
+            continue
+        
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Failed to count emails in Microsoft Graph: {response.text}"
+            )
+        
+        return int(response.json().get("@odata.count", 0))
+
+
+def get_messages_batch_from_graph(
+    db: Session,
+    account_id: int,
+    message_ids: List[str],
+    select: str = EMAIL_SELECT_FIELDS,
+    text_body: bool = False
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Lấy đầy đủ nội dung của nhiều email qua endpoint JSON $batch (tối đa GRAPH_BATCH_SIZE request mỗi lần).
+    Trả về dict message_id -> message. Request con bị lỗi sẽ bị bỏ qua và được lấy lại ở lần sync sau.
+    """
+    return dict(iter_messages_batch_from_graph(db, account_id, message_ids, select, text_body))
+
+
+def iter_messages_batch_from_graph(
+    db: Session,
+    account_id: int,
+    message_ids: List[str],
+    select: str = EMAIL_SELECT_FIELDS,
+    text_body: bool = False
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Giống get_messages_batch_from_graph nhưng yield (message_id, message) ngay khi từng response con
+    được decode xong (streaming JSON), nên bộ nhớ chỉ giữ một email thay vì cả batch.
+    text_body: yêu cầu Graph trả body dạng plain text.
+    """
+    if not message_ids:
+        return
+    
+    try:
+        access_token = get_valid_access_token(db, account_id)
+        
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+        
+        # Header riêng của từng request con trong $batch (Graph không áp header của request ngoài cho request con)
+        request_headers = with_immutable_id_prefer({"Prefer": TEXT_BODY_PREFER} if text_body else None, account_id)
+        
+        for start in range(0, len(message_ids), GRAPH_BATCH_SIZE):
+            chunk = message_ids[start:start + GRAPH_BATCH_SIZE]
+            
+            # Request con bị throttle được gửi lại sau Retry-After, tối đa GRAPH_MAX_RETRIES lần
+            attempt = 0
+            while chunk:
+                batch_requests = []
+                for index, message_id in enumerate(chunk):
+                    batch_request = {
+                        "id": str(index),
+                        "method": "GET",
+                        "url": get_message_request_url(message_id, select)
+                    }
+                    if request_headers:
+                        batch_request["headers"] = request_headers
+                    batch_requests.append(batch_request)
+                
+                response = _graph_post(
+                    account_id,
+                    f"{GRAPH_API_BASE}/$batch",
+                    cost=len(batch_requests),
+                    headers=headers,
+                    json={"requests": batch_requests},
+                    stream=True
+                )
+                
+                if response.status_code != 200:
+                    raise HTTPException(
+                        status_code=response.status_code,
+                        detail=f"Failed to fetch email batch from Microsoft Graph: {response.text}"
+                    )
+                
+                throttled_ids = []
+                retry_delay = 0.0
+                for item in iter_json_items(response, "responses.item"):
+                    message_id = chunk[int(item.get("id"))]
+                    if item.get("status") == 200:
+                        yield message_id, item.get("body", {})
+                    elif item.get("status") in THROTTLE_STATUS_CODES and attempt < GRAPH_MAX_RETRIES:
+                        throttled_ids.append(message_id)
+                        retry_delay = max(retry_delay, compute_retry_delay(item.get("headers"), attempt))
+                    else:
+                        print(f"⚠️ Batch request for message {message_id} failed with status {item.get('status')}")
+                
+                if throttled_ids:
+                    graph_scheduler.record_retry(account_id, 429, retry_delay)
+                    time.sleep(retry_delay)
+                    attempt += 1
+                chunk = throttled_ids
         
     except Exception as e:
-        print(f"🔍 DEBUG: Error fetching emails from Graph API: {e}")
+        print(f"🔍 DEBUG: Error fetching email batch from Graph API: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def get_email_delta_pages_from_graph(
+    db: Session,
+    account_id: int,
+    delta_link: str = None,
+    folder_id: str = DELTA_SYNC_FOLDER,
+    received_from: str = None,
+    page_size: int = EMAIL_PAGE_SIZE,
+    text_body: bool = False
+) -> Iterator[Tuple[Iterator[Dict[str, Any]], Dict[str, Any]]]:
+    """
+    Lấy thay đổi của mail folder qua Graph delta query.
+    Yield (messages, page_info) cho từng trang: messages là iterator decode dần từ network (streaming JSON),
+    page_info["@odata.deltaLink"] chỉ có ở trang cuối và chỉ được điền sau khi đã đọc hết messages.
+    Nếu không có delta_link thì bắt đầu vòng delta mới (lọc theo received_from nếu có).
+    text_body: yêu cầu Graph trả body dạng plain text.
+    """
+    try:
+        access_token = get_valid_access_token(db, account_id)
+        
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "Prefer": f"odata.maxpagesize={page_size}"
+        }
+        if text_body:
+            headers["Prefer"] += f", {TEXT_BODY_PREFER}"
+        
+        if delta_link:
+            url = delta_link
+            params = None
+        else:
+            url = f"{_messages_url(folder_id)}/delta"
+            params = get_email_delta_params(build_email_filter(received_from))
+        
+        while url:
+            response = _graph_get(account_id, url, headers=headers, params=params, stream=True)
+            
+            if response.status_code != 200:
+                raise HTTPException(
+                    status_code=response.status_code, 
+                    detail=f"Failed to fetch email delta from Microsoft Graph: {response.text}"
+                )
+            
+            page_info = {}
+            messages = iter_json_items(response, "value.item", page_info)
+            yield messages, page_info
+            
+            # Đọc nốt phần còn lại nếu bên gọi chưa đọc hết, để có @odata.nextLink
+            for _ in messages:
+                pass
+            
+            url = page_info.get("@odata.nextLink")
+            params = None
+    
+    except HTTPException:
+        # Giữ nguyên status code (vd: 410 khi deltaLink hết hạn) để service tự reset
+        raise
+    except Exception as e:
+        print(f"🔍 DEBUG: Error fetching email delta from Graph API: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -57,7 +450,7 @@ def get_user_info(access_token: str) -> Dict[str, Any]:
     Lấy thông tin user từ Microsoft Graph API
     """
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(f"{GRAPH_API_BASE}/me", headers=headers)
+    response = _graph_get(None, f"{GRAPH_API_BASE}/me", headers=headers)
     
     if response.status_code != 200:
         raise HTTPException(
@@ -68,12 +461,13 @@ def get_user_info(access_token: str) -> Dict[str, Any]:
     return response.json()
 
 
-def get_attachments(access_token: str, message_id: str) -> Dict[str, Any]:
+def get_attachments(access_token: str, message_id: str, account_id: int = None) -> Dict[str, Any]:
     """
     Lấy attachments của một email
     """
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(
+    response = _graph_get(
+        account_id,
         f"{GRAPH_API_BASE}/me/messages/{message_id}/attachments",
         headers=headers
     )
@@ -84,4 +478,264 @@ def get_attachments(access_token: str, message_id: str) -> Dict[str, Any]:
             detail="Failed to fetch attachments"
         )
     
-    return response.json() 
\ No newline at end of file
+    return response.json()
+
+
+def get_attachments_metadata(access_token: str, message_id: str, account_id: int = None) -> List[Dict[str, Any]]:
+    """
+    Lấy danh sách attachments của một email, chỉ metadata (không kèm contentBytes)
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = _graph_get(
+        account_id,
+        f"{GRAPH_API_BASE}/me/messages/{quote(message_id, safe='=-_')}/attachments",
+        headers=headers,
+        params={"$select": ATTACHMENT_SELECT_FIELDS}
+    )
+    
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail="Failed to fetch attachments"
+        )
+    
+    return response.json().get("value", [])
+
+
+def get_attachment_metadata(access_token: str, message_id: str, attachment_id: str, account_id: int = None) -> Dict[str, Any]:
+    """
+    Lấy metadata của một attachment (không kèm contentBytes)
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = _graph_get(
+        account_id,
+        f"{GRAPH_API_BASE}/me/messages/{quote(message_id, safe='=-_')}/attachments/{quote(attachment_id, safe='=-_')}",
+        headers=headers,
+        params={"$select": ATTACHMENT_SELECT_FIELDS}
+    )
+    
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail="Failed to fetch attachment"
+        )
+    
+    return response.json()
+
+
+def open_attachment_stream(access_token: str, message_id: str, attachment_id: str, account_id: int = None):
+    """
+    Mở stream nội dung raw của attachment ($value). Bên gọi đọc bằng iter_content và đóng response.
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = _graph_get(
+        account_id,
+        f"{GRAPH_API_BASE}/me/messages/{quote(message_id, safe='=-_')}/attachments/{quote(attachment_id, safe='=-_')}/$value",
+        headers=headers,
+        stream=True
+    )
+    
+    if response.status_code != 200:
+        detail = response.text
+        response.close()
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Failed to download attachment: {detail}"
+        )
+    
+    return response
+
+
+def create_subscription(
+    access_token: str,
+    notification_url: str,
+    resource: str,
+    change_type: str,
+    client_state: str,
+    expiration_date_time: str,
+    account_id: int = None
+) -> Dict[str, Any]:
+    """
+    Tạo change notification subscription. Graph gửi validationToken tới notification_url trước khi trả về
+    """
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "changeType": change_type,
+        "notificationUrl": notification_url,
+        "lifecycleNotificationUrl": notification_url,
+        "resource": resource,
+        "expirationDateTime": expiration_date_time,
+        "clientState": client_state
+    }
+    # Prefer immutable ID: notification trả về resourceData.id cùng loại ID với lúc sync
+    response = _graph_post(account_id, f"{GRAPH_API_BASE}/subscriptions", headers=headers, json=payload)
+    
+    if response.status_code != 201:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Failed to create subscription: {response.text}"
+        )
+    
+    return response.json()
+
+
+def renew_subscription(access_token: str, subscription_id: str, expiration_date_time: str, account_id: int = None) -> Dict[str, Any]:
+    """
+    Gia hạn subscription
+    """
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+    response = _graph_request(
+        account_id,
+        "PATCH",
+        f"{GRAPH_API_BASE}/subscriptions/{subscription_id}",
+        headers=headers,
+        json={"expirationDateTime": expiration_date_time}
+    )
+    
+    if response.status_code != 200:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Failed to renew subscription: {response.text}"
+        )
+    
+    return response.json()
+
+
+def delete_subscription(access_token: str, subscription_id: str, account_id: int = None):
+    """
+    Xóa subscription (404 coi như đã xóa)
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = _graph_request(account_id, "DELETE", f"{GRAPH_API_BASE}/subscriptions/{subscription_id}", headers=headers)
+    
+    if response.status_code not in (204, 404):
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Failed to delete subscription: {response.text}"
+        )
+
+
+def list_mail_folders(access_token: str, account_id: int = None, parent_folder_id: str = None) -> List[Dict[str, Any]]:
+    """
+    Liệt kê mail folder cấp cao nhất, hoặc folder con trực tiếp của parent_folder_id (đi theo @odata.nextLink)
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if parent_folder_id:
+        url = f"{GRAPH_API_BASE}/me/mailFolders/{quote(parent_folder_id, safe='=-_')}/childFolders"
+    else:
+        url = f"{GRAPH_API_BASE}/me/mailFolders"
+    params = {"$select": MAIL_FOLDER_SELECT_FIELDS, "$top": 100}
+    folders = []
+    
+    while url:
+        response = _graph_get(account_id, url, headers=headers, params=params)
+        
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Failed to list mail folders: {response.text}"
+            )
+        
+        page = response.json()
+        folders.extend(page.get("value", []))
+        url = page.get("@odata.nextLink")
+        params = None
+    
+    return folders
+
+
+def get_mail_folders(access_token: str, folders: List[str], account_id: int = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Lấy nhiều mail folder theo well-known name hoặc ID qua JSON $batch.
+    Trả về dict name -> folder, folder không tồn tại (vd: conversationhistory của tài khoản cá nhân) bị bỏ qua.
+    """
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+    result = {}
+    
+    for start in range(0, len(folders), GRAPH_BATCH_SIZE):
+        chunk = folders[start:start + GRAPH_BATCH_SIZE]
+        batch_requests = [
+            {
+                "id": str(index),
+                "method": "GET",
+                "url": f"/me/mailFolders/{quote(folder, safe='=-_')}?$select={MAIL_FOLDER_SELECT_FIELDS}"
+            }
+            for index, folder in enumerate(chunk)
+        ]
+        response = _graph_post(
+            account_id,
+            f"{GRAPH_API_BASE}/$batch",
+            cost=len(batch_requests),
+            headers=headers,
+            json={"requests": batch_requests}
+        )
+        
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Failed to fetch mail folders: {response.text}"
+            )
+        
+        for item in response.json().get("responses", []):
+            folder = chunk[int(item.get("id"))]
+            if item.get("status") == 200:
+                result[folder] = item.get("body", {})
+            elif item.get("status") != 404:
+                raise HTTPException(
+                    status_code=item.get("status") or 500,
+                    detail=f"Failed to fetch mail folder {folder}: {item.get('body')}"
+                )
+    
+    return result
+
+
+def translate_exchange_ids(
+    access_token: str,
+    input_ids: List[str],
+    account_id: int = None,
+    source_id_type: str = "restId",
+    target_id_type: str = "restImmutableEntryId"
+) -> Dict[str, str]:
+    """
+    Chuyển đổi loại ID qua translateExchangeIds (tối đa IMMUTABLE_ID_TRANSLATE_BATCH_SIZE ID mỗi request).
+    Trả về dict source_id -> target_id, ID không chuyển được (email đã bị xóa / chuyển đi) bị bỏ qua.
+    """
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+    id_map = {}
+    
+    for start in range(0, len(input_ids), IMMUTABLE_ID_TRANSLATE_BATCH_SIZE):
+        chunk = input_ids[start:start + IMMUTABLE_ID_TRANSLATE_BATCH_SIZE]
+        response = _graph_post(
+            account_id,
+            f"{GRAPH_API_BASE}/me/translateExchangeIds",
+            headers=headers,
+            json={
+                "inputIds": chunk,
+                "sourceIdType": source_id_type,
+                "targetIdType": target_id_type
+            }
+        )
+        
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Failed to translate Exchange IDs: {response.text}"
+            )
+        
+        for item in response.json().get("value", []):
+            if item.get("sourceId") and item.get("targetId"):
+                id_map[item["sourceId"]] = item["targetId"]
+    
+    return id_map
@@ -0,0 +1,213 @@
+"""
+Throttling-aware scheduler cho Microsoft Graph requests:
+token bucket theo mailbox, giới hạn số request đồng thời mỗi mailbox,
+tuân theo Retry-After khi bị 429/503 và exponential backoff (có jitter) cho lỗi 5xx.
+"""
+import asyncio
+import random
+import threading
+import time
+from typing import Callable, Dict, Any, Optional
+
+import requests
+
+from .config import (
+    GRAPH_MAILBOX_CONCURRENCY,
+    GRAPH_MAILBOX_RATE,
+    GRAPH_MAILBOX_BURST,
+    GRAPH_MAX_RETRIES,
+    GRAPH_BACKOFF_BASE,
+    GRAPH_BACKOFF_MAX,
+    THROTTLE_STATUS_CODES,
+    RETRYABLE_STATUS_CODES
+)
+from .request_budget import request_budget
+
+
+def compute_retry_delay(headers, attempt: int) -> float:
+    """
+    Thời gian chờ trước lần thử tiếp theo: Retry-After nếu Graph trả về,
+    ngược lại exponential backoff với full jitter
+    """
+    retry_after = headers.get("Retry-After") if headers else None
+    if retry_after:
+        try:
+            return min(float(retry_after), GRAPH_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(GRAPH_BACKOFF_MAX, GRAPH_BACKOFF_BASE * (2 ** attempt)))
+
+
+class TokenBucket:
+    """
+    Token bucket thread-safe. Khi bị throttle thì giảm một nửa tốc độ,
+    mỗi request thành công tăng dần lại tới tốc độ tối đa
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self) -> float:
+        """Lấy 1 token nếu có (trả về 0), ngược lại trả về số giây cần chờ trước khi thử lại"""
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> float:
+        """Lấy 1 token, block cho tới khi có. Trả về số giây đã chờ"""
+        waited = 0.0
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    async def acquire_async(self) -> float:
+        """Như acquire nhưng chờ bằng asyncio.sleep (AsyncGraphClient dùng chung bucket với client sync)"""
+        waited = 0.0
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def on_throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.tokens = 0
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class GraphRequestScheduler:
+    """Điều phối Graph requests theo mailbox và thu thập metrics về throttling"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets: Dict[Any, TokenBucket] = {}
+        self.semaphores: Dict[Any, threading.BoundedSemaphore] = {}
+        self.metrics = {
+            "requests": 0,
+            "throttled": 0,
+            "server_errors": 0,
+            "retries": 0,
+            "gave_up": 0,
+            "retry_wait_seconds": 0.0,
+            "rate_limit_wait_seconds": 0.0
+        }
+        self.throttled_by_mailbox: Dict[Any, int] = {}
+
+    def _get_limiters(self, mailbox_key):
+        with self.lock:
+            if mailbox_key not in self.buckets:
+                self.buckets[mailbox_key] = TokenBucket(GRAPH_MAILBOX_RATE, GRAPH_MAILBOX_BURST)
+                self.semaphores[mailbox_key] = threading.BoundedSemaphore(GRAPH_MAILBOX_CONCURRENCY)
+            return self.buckets[mailbox_key], self.semaphores[mailbox_key]
+
+    def _increment(self, key: str, value=1):
+        with self.lock:
+            self.metrics[key] += value
+
+    def get_bucket(self, mailbox_key) -> TokenBucket:
+        """Token bucket của mailbox (dùng chung cho client sync và async)"""
+        return self._get_limiters(mailbox_key)[0]
+
+    def record_request(self, waited: float = 0.0):
+        """Ghi nhận một lần gửi request và thời gian chờ token bucket (client async)"""
+        with self.lock:
+            self.metrics["requests"] += 1
+            self.metrics["rate_limit_wait_seconds"] += waited
+
+    def record_retry(self, mailbox_key, status_code: int, delay: float):
+        """Ghi nhận một lần retry (dùng chung cho cả client sync và async)"""
+        with self.lock:
+            self.metrics["retries"] += 1
+            self.metrics["retry_wait_seconds"] += delay
+            if status_code in THROTTLE_STATUS_CODES:
+                self.metrics["throttled"] += 1
+                self.throttled_by_mailbox[mailbox_key] = self.throttled_by_mailbox.get(mailbox_key, 0) + 1
+            else:
+                self.metrics["server_errors"] += 1
+        if mailbox_key is not None and status_code in THROTTLE_STATUS_CODES:
+            self._get_limiters(mailbox_key)[0].on_throttled()
+
+    def record_gave_up(self):
+        self._increment("gave_up")
+
+    def execute(
+        self,
+        mailbox_key: Optional[Any],
+        send: Callable[[], requests.Response],
+        max_retries: int = GRAPH_MAX_RETRIES,
+        cost: int = 1
+    ) -> requests.Response:
+        """
+        Gửi request qua scheduler. mailbox_key = None: không giới hạn tốc độ, chỉ retry.
+        cost: số request Graph tính vào request budget ($batch = số request con).
+        Trả về response cuối cùng (có thể vẫn là 429/5xx nếu đã hết số lần retry).
+        """
+        for attempt in range(max_retries + 1):
+            self._increment("requests")
+            if mailbox_key is None:
+                response = send()
+            else:
+                bucket, semaphore = self._get_limiters(mailbox_key)
+                waited = bucket.acquire()
+                if waited:
+                    self._increment("rate_limit_wait_seconds", waited)
+                with semaphore:
+                    response = send()
+            request_budget.record(mailbox_key, response.status_code, cost)
+
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                if mailbox_key is not None:
+                    bucket.on_success()
+                return response
+
+            if attempt == max_retries:
+                self.record_gave_up()
+                return response
+
+            delay = compute_retry_delay(response.headers, attempt)
+            self.record_retry(mailbox_key, response.status_code, delay)
+            print(f"⏳ Graph returned {response.status_code} for mailbox {mailbox_key}, retrying in {delay:.1f}s")
+            # Trả connection về pool (cần thiết với stream=True)
+            response.close()
+            time.sleep(delay)
+
+        return response
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Metrics về throttling để expose qua API"""
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics["retry_wait_seconds"] = round(metrics["retry_wait_seconds"], 3)
+            metrics["rate_limit_wait_seconds"] = round(metrics["rate_limit_wait_seconds"], 3)
+            metrics["throttled_by_mailbox"] = {
+                str(key): count for key, count in self.throttled_by_mailbox.items()
+            }
+            metrics["mailbox_rates"] = {
+                str(key): round(bucket.rate, 3) for key, bucket in self.buckets.items()
+            }
+        return metrics
+
+
+# Global instance
+graph_scheduler = GraphRequestScheduler()
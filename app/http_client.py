@@ -0,0 +1,79 @@
+"""
+Shared HTTP client cho tất cả request ra ngoài tới Microsoft (Graph API và OAuth token endpoint)
+"""
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import (
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_MAXSIZE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT
+)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """
+    Lấy requests.Session dùng chung (keep-alive, mỗi host một connection pool)
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=HTTP_POOL_MAXSIZE
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({"Accept-Encoding": "gzip, deflate"})
+                _session = session
+    return _session
+
+
+def close_http_session():
+    """
+    Đóng session dùng chung (gọi khi shutdown)
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    """
+    GET qua session dùng chung, mặc định có timeout
+    """
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_http_session().get(url, **kwargs)
+
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    """
+    POST qua session dùng chung, mặc định có timeout
+    """
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_http_session().post(url, **kwargs)
+
+
+def http_patch(url: str, **kwargs) -> requests.Response:
+    """
+    PATCH qua session dùng chung, mặc định có timeout
+    """
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_http_session().patch(url, **kwargs)
+
+
+def http_delete(url: str, **kwargs) -> requests.Response:
+    """
+    DELETE qua session dùng chung, mặc định có timeout
+    """
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_http_session().delete(url, **kwargs)
@@ -0,0 +1,55 @@
+"""
+Immutable message ID: với Prefer: IdType="ImmutableId" Graph trả ID không đổi khi email bị chuyển folder,
+nên email đã lưu không bị sync lại thành bản trùng. Account cũ chỉ dùng immutable ID sau khi message_id
+đã lưu được chuyển đổi (EmailSyncService.migrate_to_immutable_ids), account mới dùng ngay từ đầu.
+"""
+import threading
+from typing import Dict, Optional
+
+from .config import IMMUTABLE_ID_ENABLED
+from crud import get_account_by_id
+from database import get_db
+
+IMMUTABLE_ID_PREFER = 'IdType="ImmutableId"'
+
+_lock = threading.Lock()
+_immutable_accounts: Dict[int, bool] = {}
+
+
+def uses_immutable_ids(account_id) -> bool:
+    """Account có dùng immutable ID không (đọc cột accounts.uses_immutable_ids một lần rồi cache)"""
+    if not IMMUTABLE_ID_ENABLED or not isinstance(account_id, int):
+        return False
+
+    with _lock:
+        cached = _immutable_accounts.get(account_id)
+    if cached is not None:
+        return cached
+
+    db = next(get_db())
+    try:
+        account = get_account_by_id(db, account_id)
+        cached = bool(account and account.uses_immutable_ids)
+    finally:
+        db.close()
+
+    with _lock:
+        _immutable_accounts[account_id] = cached
+    return cached
+
+
+def set_uses_immutable_ids(account_id: int, value: bool):
+    """Cập nhật cache sau khi migrate"""
+    with _lock:
+        _immutable_accounts[account_id] = value
+
+
+def with_immutable_id_prefer(headers: Optional[Dict[str, str]], account_id) -> Optional[Dict[str, str]]:
+    """Thêm IdType="ImmutableId" vào header Prefer (giữ các preference khác) nếu account dùng immutable ID"""
+    if not uses_immutable_ids(account_id):
+        return headers
+
+    headers = dict(headers or {})
+    prefer = headers.get("Prefer")
+    headers["Prefer"] = f"{prefer}, {IMMUTABLE_ID_PREFER}" if prefer else IMMUTABLE_ID_PREFER
+    return headers
@@ -0,0 +1,101 @@
+"""
+Decode JSON response của Graph theo kiểu streaming (ijson): yield từng object trong collection
+ngay khi đọc xong từ network, thay vì response.json() dựng cả trang trong bộ nhớ
+"""
+from typing import Dict, Any, Iterator, AsyncIterator, Optional
+
+import httpx
+import ijson
+import requests
+
+SCALAR_EVENTS = ("string", "number", "boolean", "null")
+_NO_ITEM = object()
+
+
+class _ItemParser:
+    """Dựng từng phần tử của collection từ các event của ijson, ghi giá trị top-level vào metadata"""
+
+    def __init__(self, item_prefix: str, metadata: Optional[Dict[str, Any]]):
+        self.item_prefix = item_prefix
+        self.metadata = metadata
+        self.depth = 0
+        self.current_key = None
+        self.builder = None
+
+    def event(self, prefix: str, event: str, value) -> Any:
+        """Trả về phần tử vừa đọc xong, hoặc _NO_ITEM"""
+        item = _NO_ITEM
+        if self.builder is not None:
+            self.builder.event(event, value)
+            if prefix == self.item_prefix and event in ("end_map", "end_array"):
+                item = self.builder.value
+                self.builder = None
+        elif prefix == self.item_prefix and event in ("start_map", "start_array"):
+            self.builder = ijson.ObjectBuilder()
+            self.builder.event(event, value)
+        elif prefix == self.item_prefix:
+            item = value
+        elif self.depth == 1 and event == "map_key":
+            self.current_key = value
+        elif self.depth == 1 and self.metadata is not None and event in SCALAR_EVENTS:
+            self.metadata[self.current_key] = value
+
+        if event in ("start_map", "start_array"):
+            self.depth += 1
+        elif event in ("end_map", "end_array"):
+            self.depth -= 1
+        return item
+
+
+def iter_json_items(
+    response: requests.Response,
+    item_prefix: str = "value.item",
+    metadata: Optional[Dict[str, Any]] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yield lần lượt các phần tử của collection (mặc định "value") trong response (gửi với stream=True).
+    Các giá trị top-level như @odata.nextLink / @odata.deltaLink được ghi vào metadata,
+    nên chỉ đầy đủ sau khi đã đọc hết iterator.
+    """
+    response.raw.decode_content = True  # Giải nén gzip trước khi đưa vào parser
+    parser = _ItemParser(item_prefix, metadata)
+
+    try:
+        for prefix, event, value in ijson.parse(response.raw, use_float=True):
+            item = parser.event(prefix, event, value)
+            if item is not _NO_ITEM:
+                yield item
+    finally:
+        response.close()
+
+
+class _AsyncResponseReader:
+    """File-like bất đồng bộ trên body của httpx response (đã giải nén) cho ijson.parse_async"""
+
+    def __init__(self, response: httpx.Response):
+        self.chunks = response.aiter_bytes()
+
+    async def read(self, size: int = -1) -> bytes:
+        if size == 0:  # ijson gọi read(0) để kiểm tra kiểu dữ liệu
+            return b""
+        try:
+            return await self.chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
+
+
+async def aiter_json_items(
+    response: httpx.Response,
+    item_prefix: str = "value.item",
+    metadata: Optional[Dict[str, Any]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """Giống iter_json_items cho httpx response gửi với stream=True (AsyncGraphClient)"""
+    parser = _ItemParser(item_prefix, metadata)
+
+    try:
+        async for prefix, event, value in ijson.parse_async(_AsyncResponseReader(response), use_float=True):
+            item = parser.event(prefix, event, value)
+            if item is not _NO_ITEM:
+                yield item
+    finally:
+        await response.aclose()
@@ -0,0 +1,89 @@
+"""
+Mail folder cần sync của từng account: SYNC_MAIL_FOLDERS (Inbox, Junk Email) và folder do user / inbox rule tạo.
+Danh sách folder được liệt kê một lần rồi cache MAIL_FOLDER_CACHE_SECONDS, khi sync mỗi folder được lấy song song
+với nextLink riêng (get_email_pages_from_graph(folder_ids=...)).
+"""
+import threading
+import time
+from typing import Dict, List, Tuple, Any
+
+from sqlalchemy.orm import Session
+
+from .config import (
+    SYNC_MAIL_FOLDERS,
+    SYNC_CUSTOM_FOLDERS,
+    SYNC_EXCLUDED_FOLDERS,
+    MAIL_FOLDER_CACHE_SECONDS
+)
+from .auth import get_valid_access_token
+from .graph_api import get_mail_folders, list_mail_folders
+
+_lock = threading.Lock()
+_account_locks: Dict[int, threading.Lock] = {}
+# account_id -> (hết hạn lúc (monotonic), danh sách folder)
+_folders_by_account: Dict[int, Tuple[float, List[Dict[str, Any]]]] = {}
+
+
+def list_sync_folders(access_token: str, account_id: int) -> List[Dict[str, Any]]:
+    """
+    Liệt kê folder cần sync: các folder trong SYNC_MAIL_FOLDERS, cộng thêm (nếu SYNC_CUSTOM_FOLDERS) mọi folder
+    trong cây folder trừ SYNC_EXCLUDED_FOLDERS và folder con của chúng
+    """
+    well_known = get_mail_folders(access_token, SYNC_MAIL_FOLDERS + SYNC_EXCLUDED_FOLDERS, account_id)
+    excluded_ids = {well_known[name]["id"] for name in SYNC_EXCLUDED_FOLDERS if name in well_known}
+
+    folders: Dict[str, Dict[str, Any]] = {}
+    for name in SYNC_MAIL_FOLDERS:
+        if name in well_known:
+            folders[well_known[name]["id"]] = well_known[name]
+
+    if SYNC_CUSTOM_FOLDERS:
+        parents = [None]
+        while parents:
+            parent_id = parents.pop(0)
+            for folder in list_mail_folders(access_token, account_id, parent_id):
+                if folder.get("id") in excluded_ids:
+                    continue
+                folders.setdefault(folder["id"], folder)
+                if folder.get("childFolderCount"):
+                    parents.append(folder["id"])
+
+    return [
+        {
+            "id": folder["id"],
+            "displayName": folder.get("displayName"),
+            "totalItemCount": folder.get("totalItemCount")
+        }
+        for folder in folders.values()
+    ]
+
+
+def get_sync_folders(db: Session, account_id: int) -> List[Dict[str, Any]]:
+    """Folder cần sync của account (cache, mỗi account chỉ một thread liệt kê lại khi hết hạn)"""
+    with _lock:
+        account_lock = _account_locks.setdefault(account_id, threading.Lock())
+
+    with account_lock:
+        with _lock:
+            cached = _folders_by_account.get(account_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        access_token = get_valid_access_token(db, account_id)
+        folders = list_sync_folders(access_token, account_id)
+        print(f"📁 Account {account_id}: syncing {len(folders)} mail folders "
+              f"({', '.join(folder.get('displayName') or folder['id'] for folder in folders)})")
+
+        with _lock:
+            _folders_by_account[account_id] = (time.monotonic() + MAIL_FOLDER_CACHE_SECONDS, folders)
+        return folders
+
+
+def get_sync_folder_ids(db: Session, account_id: int) -> List[str]:
+    return [folder["id"] for folder in get_sync_folders(db, account_id)]
+
+
+def invalidate_sync_folders(account_id: int):
+    """Xóa cache (vd: folder đã bị xóa trả về 404), lần sync sau sẽ liệt kê lại"""
+    with _lock:
+        _folders_by_account.pop(account_id, None)
@@ -13,6 +13,7 @@ from crud import (
     get_emails, 
     create_meta_receipt, 
     get_meta_receipt_by_message_id,
+    get_emails_without_meta_receipt,
     bulk_create_meta_receipts
 )
 
@@ -24,9 +25,10 @@ class MetaReceiptService:
     def __init__(self, db: Session):
         self.db = db
     
-    def process_email_to_meta_receipt(self, email: Email) -> Dict[str, Any]:
+    def process_email_to_meta_receipt(self, email: Email, ignore_existing: bool = False) -> Dict[str, Any]:
         """
         Xử lý một email và trích xuất thông tin Meta receipt
+        (ignore_existing: đang trích xuất lại cho receipt đã có, không coi là Duplicate)
         """
         try:
             # Trích xuất thông tin từ body và body_preview
@@ -42,7 +44,9 @@ class MetaReceiptService:
                 status = 'Fail'
             else:
                 # Kiểm tra xem transaction_id đã tồn tại trong database chưa
-                existing_receipt = get_meta_receipt_by_message_id(self.db, email.account_id, email.message_id)
+                existing_receipt = None if ignore_existing else get_meta_receipt_by_message_id(
+                    self.db, email.account_id, email.message_id
+                )
                 if existing_receipt:
                     status = 'Duplicate'
                 elif meta_info.get('reference_number') == '':
@@ -115,6 +119,44 @@ class MetaReceiptService:
             'skipped_count': skipped_count
         }
     
+    def refresh_emails_receipts(self, account_id: int, emails: List[Email]) -> Dict[str, int]:
+        """
+        Trích xuất lại meta receipt cho các email vừa được cập nhật từ Graph (changeKey khác):
+        receipt đã có được cập nhật tại chỗ, email chưa có receipt thì tạo mới
+        """
+        receipts = {
+            receipt.email_id: receipt for receipt in self.db.query(MetaReceipt).filter(
+                and_(
+                    MetaReceipt.account_id == account_id,
+                    MetaReceipt.email_id.in_([email.id for email in emails])
+                )
+            ).all()
+        } if emails else {}
+        
+        refreshed_count = 0
+        for email in emails:
+            receipt = receipts.get(email.id)
+            if not receipt:
+                continue
+            meta_receipt_data = self.process_email_to_meta_receipt(email, ignore_existing=True)
+            if meta_receipt_data:
+                receipt.date = meta_receipt_data['date']
+                receipt.account_id_meta = meta_receipt_data['account_id_meta']
+                receipt.transaction_id = meta_receipt_data['transaction_id']
+                receipt.payment = meta_receipt_data['payment']
+                receipt.card_number = meta_receipt_data['card_number']
+                receipt.reference_number = meta_receipt_data['reference_number']
+                receipt.status = meta_receipt_data['status']
+                receipt.updated_at = datetime.utcnow()
+                refreshed_count += 1
+        self.db.commit()
+        
+        result = self.process_emails_batch(account_id, [email for email in emails if email.id not in receipts])
+        return {
+            'refreshed_count': refreshed_count,
+            'created_count': result['created_count']
+        }
+    
     def process_account_emails(
         self, 
         account_id: int, 
@@ -171,6 +213,21 @@ class MetaReceiptService:
                 'error': str(e)
             }
     
+    def process_new_emails(
+        self,
+        account_id: int,
+        received_from: datetime = None,
+        received_to: datetime = None
+    ) -> Dict[str, Any]:
+        """
+        Tạo meta receipts cho mọi email trong khoảng [received_from, received_to) chưa có receipt
+        (không giới hạn số email như process_account_emails), dùng sau mỗi bước của initial sync
+        """
+        emails = get_emails_without_meta_receipt(self.db, account_id, received_from, received_to)
+        result = self.process_emails_batch(account_id, emails)
+        result['account_id'] = account_id
+        return result
+    
     def process_multiple_accounts(
         self, 
         account_ids: List[int], 
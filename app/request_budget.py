@@ -0,0 +1,186 @@
+"""
+Request budget: đếm mọi Graph request (và request tới OAuth token endpoint) theo account và theo bucket thời gian.
+Số liệu trong REQUEST_BUDGET_WINDOW_SECONDS gần nhất được giữ trong bộ nhớ để AutoSyncService hoãn việc
+ưu tiên thấp khi account gần hết budget, tổng theo bucket được ghi định kỳ vào bảng graph_request_usage.
+"""
+import calendar
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional, Tuple
+
+from .config import (
+    REQUEST_BUDGET_WINDOW_SECONDS,
+    REQUEST_BUDGET_PER_ACCOUNT,
+    REQUEST_BUDGET_APP,
+    REQUEST_BUDGET_LOW_PRIORITY_RATIO,
+    REQUEST_BUDGET_NORMAL_PRIORITY_RATIO,
+    REQUEST_BUDGET_BUCKET_SECONDS,
+    REQUEST_BUDGET_FLUSH_SECONDS,
+    THROTTLE_STATUS_CODES
+)
+from crud import add_graph_request_usage
+from database import get_db
+
+SLOT_SECONDS = 10  # Độ chi tiết của cửa sổ trượt trong bộ nhớ
+PRIORITY_RATIOS = {
+    "low": REQUEST_BUDGET_LOW_PRIORITY_RATIO,
+    "normal": REQUEST_BUDGET_NORMAL_PRIORITY_RATIO,
+    "high": 1.0
+}
+
+
+def _account_key(mailbox_key) -> int:
+    """mailbox_key của scheduler là account_id, None (không gắn account) được ghi là 0"""
+    return mailbox_key if isinstance(mailbox_key, int) else 0
+
+
+def _bucket_start(now: datetime) -> datetime:
+    """now là giờ UTC naive (utcnow): dùng timegm, không dùng timestamp() vốn coi datetime naive là giờ local"""
+    timestamp = calendar.timegm(now.utctimetuple())
+    return datetime.utcfromtimestamp(timestamp - timestamp % REQUEST_BUDGET_BUCKET_SECONDS)
+
+
+class RequestBudget:
+    """Thread-safe, được gọi từ graph_scheduler, AsyncGraphClient và auth"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # account_id -> deque[[slot, cost, throttled]] trong cửa sổ trượt
+        self.windows: Dict[int, deque] = {}
+        # (account_id, bucket_start) -> counters chưa ghi xuống database
+        self.pending: Dict[Tuple[int, datetime], Dict[str, int]] = {}
+        self.is_running = False
+        self.flush_thread = None
+
+    def _add_pending(self, account_id: int, **counters):
+        key = (account_id, _bucket_start(datetime.utcnow()))
+        bucket = self.pending.setdefault(key, {"requests": 0, "cost": 0, "throttled": 0, "token_requests": 0})
+        for name, value in counters.items():
+            bucket[name] += value
+
+    def _prune(self, window: deque, now_slot: int):
+        oldest = now_slot - REQUEST_BUDGET_WINDOW_SECONDS // SLOT_SECONDS
+        while window and window[0][0] <= oldest:
+            window.popleft()
+
+    def record(self, mailbox_key, status_code: Optional[int] = None, cost: int = 1):
+        """Ghi nhận một HTTP request tới Graph. cost: số request Graph tính vào throttling ($batch = số request con)"""
+        account_id = _account_key(mailbox_key)
+        throttled = 1 if status_code in THROTTLE_STATUS_CODES else 0
+        slot = int(time.time()) // SLOT_SECONDS
+
+        with self.lock:
+            window = self.windows.setdefault(account_id, deque())
+            if window and window[-1][0] == slot:
+                window[-1][1] += cost
+                window[-1][2] += throttled
+            else:
+                window.append([slot, cost, throttled])
+            self._prune(window, slot)
+            self._add_pending(account_id, requests=1, cost=cost, throttled=throttled)
+
+    def record_token_request(self, account_id: Optional[int] = None):
+        """Ghi nhận một request tới OAuth token endpoint (không tính vào budget của Graph)"""
+        with self.lock:
+            self._add_pending(_account_key(account_id), token_requests=1)
+
+    def _window_usage(self, account_id: int) -> Tuple[int, int]:
+        """(cost, throttled) của account trong cửa sổ hiện tại, cần giữ lock"""
+        window = self.windows.get(account_id)
+        if not window:
+            return 0, 0
+        self._prune(window, int(time.time()) // SLOT_SECONDS)
+        return sum(slot[1] for slot in window), sum(slot[2] for slot in window)
+
+    def get_usage(self, account_id: int) -> Dict[str, Any]:
+        """Số request của account trong REQUEST_BUDGET_WINDOW_SECONDS gần nhất"""
+        with self.lock:
+            cost, throttled = self._window_usage(account_id)
+        return {
+            "account_id": account_id,
+            "cost": cost,
+            "throttled": throttled,
+            "budget": REQUEST_BUDGET_PER_ACCOUNT,
+            "usage_ratio": round(cost / REQUEST_BUDGET_PER_ACCOUNT, 4)
+        }
+
+    def get_app_usage(self) -> int:
+        with self.lock:
+            return sum(self._window_usage(account_id)[0] for account_id in list(self.windows))
+
+    def should_defer(self, account_id: int, priority: str = "low") -> bool:
+        """
+        Có nên hoãn việc của account không: dùng quá tỉ lệ budget của priority (account hoặc toàn app),
+        hoặc việc ưu tiên thấp khi account vừa bị throttle trong cửa sổ hiện tại
+        """
+        ratio = PRIORITY_RATIOS.get(priority, REQUEST_BUDGET_LOW_PRIORITY_RATIO)
+        with self.lock:
+            cost, throttled = self._window_usage(account_id)
+        if cost >= REQUEST_BUDGET_PER_ACCOUNT * ratio:
+            return True
+        if priority == "low" and throttled:
+            return True
+        return REQUEST_BUDGET_APP is not None and self.get_app_usage() >= REQUEST_BUDGET_APP * ratio
+
+    def get_status(self) -> Dict[str, Any]:
+        """Usage hiện tại của các account có request trong cửa sổ"""
+        with self.lock:
+            account_ids = list(self.windows)
+        accounts = [self.get_usage(account_id) for account_id in account_ids]
+        accounts = [usage for usage in accounts if usage["cost"]]
+        return {
+            "window_seconds": REQUEST_BUDGET_WINDOW_SECONDS,
+            "app_cost": sum(usage["cost"] for usage in accounts),
+            "app_budget": REQUEST_BUDGET_APP,
+            "accounts": sorted(accounts, key=lambda usage: usage["cost"], reverse=True)
+        }
+
+    def flush(self):
+        """Ghi số liệu đang chờ vào bảng graph_request_usage"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        db = next(get_db())
+        try:
+            add_graph_request_usage(db, pending)
+        except Exception as e:
+            print(f"❌ Failed to persist Graph request usage: {str(e)}")
+            # Giữ lại để ghi ở lần sau
+            with self.lock:
+                for key, counters in pending.items():
+                    bucket = self.pending.setdefault(key, dict.fromkeys(counters, 0))
+                    for name, value in counters.items():
+                        bucket[name] += value
+        finally:
+            db.close()
+
+    def start(self):
+        """Start thread ghi số liệu định kỳ"""
+        if self.is_running:
+            return
+        self.is_running = True
+        self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flush_thread.start()
+
+    def stop(self):
+        """Stop thread và ghi nốt số liệu còn lại"""
+        self.is_running = False
+        if self.flush_thread:
+            self.flush_thread.join()
+        self.flush()
+
+    def _flush_loop(self):
+        last_flush = time.monotonic()
+        while self.is_running:
+            time.sleep(1)
+            if time.monotonic() - last_flush >= REQUEST_BUDGET_FLUSH_SECONDS:
+                last_flush = time.monotonic()
+                self.flush()
+
+
+# Global instance
+request_budget = RequestBudget()
@@ -1,11 +1,10 @@
 """
 API routes for the application
 """
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
+from fastapi import APIRouter, Body, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from typing import Optional
-import requests
 import io
 import pandas as pd
 from datetime import datetime, timedelta
@@ -16,7 +15,6 @@ from crud import (
     save_user_and_token_to_db, 
     get_account_by_email, 
     get_account_by_id,
-    get_valid_auth_token,
     get_emails,
     get_email_by_message_id,
     search_emails,
@@ -35,17 +33,39 @@ from crud import (
     delete_account_for_user,
     # MetaReceipt CRUD
     get_meta_receipts,
-    get_meta_receipts_count
+    get_meta_receipts_count,
+    # Circuit breaker
+    reset_circuit_breaker,
+    # Graph request budget
+    get_graph_request_usage,
+    # Webhook subscription
+    get_graph_subscription,
+    # Single-flight sync
+    get_sync_jobs
 )
 from models import Account, User
-from .config import CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, GRAPH_API_BASE
-from .graph_api import get_user_info, get_attachments
+from .config import CLIENT_ID, CLIENT_SECRET, REDIRECT_URI, GRAPH_API_BASE, LOGIN_AUTHORITY
+from .graph_api import get_user_info
+from .http_client import http_post
 from .services import EmailSyncService
 from .auth import get_valid_access_token
 from .export_service import ExportService
 from .meta_receipt_service import MetaReceiptService
 from .user_auth import create_access_token, get_current_active_user, ACCESS_TOKEN_EXPIRE_MINUTES
 from .auto_sync_service import auto_sync_service
+from .graph_scheduler import graph_scheduler
+from .request_budget import request_budget
+from .token_cache import token_cache
+from .sync_registry import sync_registry
+from .circuit_breaker import get_circuit_breaker_status
+from .webhook_service import webhook_service, ensure_subscription, remove_subscription, subscription_to_dict
+from .attachment_store import (
+    download_message_attachments,
+    get_attachments_list,
+    get_cached_attachment,
+    get_attachment_path
+)
+from .file_response import RangeFileResponse
 
 router = APIRouter()
 
@@ -264,6 +284,8 @@ def delete_user_account(
         if not success:
             raise HTTPException(status_code=404, detail="Account không tồn tại")
         
+        token_cache.invalidate(account_id)
+        
         return JSONResponse({
             "message": "Xóa account thành công"
         })
@@ -292,7 +314,7 @@ def login(user_id: Optional[int] = None):
         "scope": "offline_access Mail.Read User.Read",
         "state": state_param
     })
-    auth_url = f"https://login.microsoftonline.com/common/oauth2/v2.0/authorize?{query_params}"
+    auth_url = f"{LOGIN_AUTHORITY}/oauth2/v2.0/authorize?{query_params}"
     
     return JSONResponse({
         "login_url": auth_url,
@@ -308,7 +330,7 @@ def callback(code: str, state: Optional[str] = None, db: Session = Depends(get_d
     """
     Callback sau khi user đăng nhập Microsoft
     """
-    token_url = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
+    token_url = f"{LOGIN_AUTHORITY}/oauth2/v2.0/token"
     
     data = {
         "client_id": CLIENT_ID,
@@ -319,7 +341,8 @@ def callback(code: str, state: Optional[str] = None, db: Session = Depends(get_d
         "client_secret": CLIENT_SECRET
     }
 
-    response = requests.post(token_url, data=data)
+    response = http_post(token_url, data=data)
+    request_budget.record_token_request()
     token_data = response.json()
 
     if response.status_code != 200:
@@ -348,6 +371,12 @@ def callback(code: str, state: Optional[str] = None, db: Session = Depends(get_d
         db, email, name, access_token, refresh_token, expires_in, me, user_id=user_id
     )
     
+    # Token mới thay cho token cũ trong cache
+    token_cache.invalidate(account.id)
+    
+    # Đăng nhập lại thành công: đóng circuit breaker (nếu có) để account được sync lại
+    reset_circuit_breaker(db, account.id)
+    
     # Add to auto sync queue
     auto_sync_service.add_new_account(account.id)
     
@@ -515,6 +544,7 @@ def get_mail_detail(
             } if email.flag_status else None,
             "categories": email.categories,
             "attachments": email.attachments,
+            "removed_at": email.removed_at.isoformat() if email.removed_at else None,
             "created_at": email.created_at.isoformat(),
             "updated_at": email.updated_at.isoformat()
         }
@@ -538,11 +568,16 @@ def sync_emails(
     """
     try:
         service = EmailSyncService(db, account_id)
-        result = service.sync_emails_by_date_range(received_from, received_to, top)
+        result = sync_registry.run(
+            account_id, "range",
+            lambda: service.sync_emails_by_date_range(received_from, received_to, top),
+            f"{received_from}:{received_to}:{top}"
+        )
         
         return JSONResponse({
             "message": f"Đồng bộ thành công {result['synced_count']} email",
             "synced_count": result["synced_count"],
+            "updated_count": result["updated_count"],
             "total_fetched": result["total_fetched"],
             "filter": f"Meta ads receipt emails from {received_from} to {received_to}" if received_from and received_to else "Meta ads receipt emails only"
         })
@@ -551,6 +586,93 @@ def sync_emails(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/mails/sync-backfill/")
+def sync_backfill_emails(
+    account_id: int,
+    received_from: str,
+    received_to: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Đồng bộ lại email trong khoảng thời gian bất kỳ (YYYY-MM-DD), chia window theo số email
+    """
+    try:
+        received_to = received_to or datetime.utcnow().strftime('%Y-%m-%d')
+        try:
+            datetime.strptime(received_from, '%Y-%m-%d')
+            datetime.strptime(received_to, '%Y-%m-%d')
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Định dạng ngày phải là YYYY-MM-DD")
+        
+        service = EmailSyncService(db, account_id)
+        result = sync_registry.run(
+            account_id, "backfill", lambda: service.sync_backfill(received_from, received_to),
+            f"{received_from}:{received_to}"
+        )
+        
+        return JSONResponse({
+            "message": f"Đồng bộ thành công {result['total_synced']} email",
+            **result
+        })
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/mails/migrate-immutable-ids/")
+def migrate_immutable_ids(account_id: int, db: Session = Depends(get_db)):
+    """
+    Chuyển message_id đã lưu của account sang immutable ID (translateExchangeIds),
+    sau đó email bị chuyển folder không còn bị sync lại thành bản trùng
+    """
+    try:
+        account = get_account_by_id(db, account_id)
+        if not account:
+            raise HTTPException(status_code=404, detail="Account not found")
+        
+        result = sync_registry.run(
+            account_id, "immutable-ids", EmailSyncService(db, account_id).migrate_to_immutable_ids
+        )
+        
+        # Subscription cũ gửi REST ID trong notification: tạo lại với immutable ID
+        if webhook_service.enabled and get_graph_subscription(db, account_id):
+            ensure_subscription(db, account_id, recreate=True)
+        
+        return JSONResponse(result)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/mails/sync-jobs/")
+def get_sync_jobs_status(account_id: Optional[int] = None, db: Session = Depends(get_db)):
+    """
+    Job sync đang chạy trong process này (kèm số request đang chờ dùng chung kết quả)
+    và job gần nhất của từng key (bảng sync_jobs, chỉ ghi khi dùng Postgres advisory lock)
+    """
+    try:
+        return JSONResponse({
+            "registry": sync_registry.get_status(),
+            "jobs": [
+                {
+                    "account_id": job.account_id,
+                    "job_key": job.job_key,
+                    "status": job.status,
+                    "error": job.error,
+                    "started_at": job.started_at.isoformat() if job.started_at else None,
+                    "finished_at": job.finished_at.isoformat() if job.finished_at else None
+                }
+                for job in get_sync_jobs(db, account_id)
+            ]
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.get("/mails/sync-monthly/")
 def sync_monthly_emails(
     account_ids: str,  # Comma-separated list of account IDs
@@ -582,6 +704,7 @@ def sync_monthly_emails(
         # Kết quả tổng hợp
         total_synced = 0
         total_days_processed = 0
+        total_windows_processed = 0
         sync_results = []
         convert_results = []
         
@@ -589,15 +712,19 @@ def sync_monthly_emails(
         for account_id in account_id_list:
             try:
                 service = EmailSyncService(db, account_id)
-                result = service.sync_monthly_emails()
+                result = sync_registry.run(
+                    account_id, "monthly", service.sync_monthly_emails, datetime.utcnow().strftime('%Y-%m-%d')
+                )
                 
                 total_synced += result["total_synced"]
                 total_days_processed += result["days_processed"]
+                total_windows_processed += result["windows_processed"]
                 
                 sync_results.append({
                     "account_id": account_id,
                     "total_synced": result["total_synced"],
                     "days_processed": result["days_processed"],
+                    "windows_processed": result["windows_processed"],
                     "details": result["details"]
                 })
                 
@@ -651,6 +778,7 @@ def sync_monthly_emails(
             "message": f"Đồng bộ thành công {total_synced} email trong {total_days_processed} ngày cho {len(account_id_list)} accounts",
             "total_synced": total_synced,
             "total_days_processed": total_days_processed,
+            "total_windows_processed": total_windows_processed,
             "accounts_processed": len(account_id_list),
             "sync_results": sync_results,
             "convert_results": convert_results if convert_to_meta_receipts else None
@@ -670,7 +798,9 @@ def sync_daily_emails(
     """
     try:
         service = EmailSyncService(db, account_id)
-        result = service.sync_daily_emails()
+        result = sync_registry.run(
+            account_id, "daily", service.sync_daily_emails, datetime.utcnow().strftime('%Y-%m-%d')
+        )
         
         return JSONResponse({
             "message": f"Đồng bộ thành công {result['total_synced']} email mới",
@@ -683,6 +813,31 @@ def sync_daily_emails(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/mails/sync-delta/")
+def sync_delta_emails(
+    account_id: int,
+    db: Session = Depends(get_db)
+):
+    """
+    Đồng bộ tăng dần bằng Graph delta query (chỉ lấy thay đổi kể từ lần sync trước)
+    """
+    try:
+        service = EmailSyncService(db, account_id)
+        result = sync_registry.run(account_id, "delta", service.sync_delta_emails)
+        
+        return JSONResponse({
+            "message": f"Đồng bộ thành công {result['total_synced']} email mới",
+            "total_synced": result["total_synced"],
+            "total_fetched": result["total_fetched"],
+            "updated_count": result["updated_count"],
+            "removed_count": result["removed_count"],
+            "folder_ids": result["folder_ids"]
+        })
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.get("/mails/sync-all/")
 def sync_all_emails(
     account_id: int,
@@ -694,11 +849,14 @@ def sync_all_emails(
     """
     try:
         service = EmailSyncService(db, account_id)
-        result = service.sync_emails_by_date_range(top=top)
+        result = sync_registry.run(
+            account_id, "range", lambda: service.sync_emails_by_date_range(top=top), f"None:None:{top}"
+        )
         
         return JSONResponse({
             "message": f"Đồng bộ thành công {result['synced_count']} email",
             "synced_count": result["synced_count"],
+            "updated_count": result["updated_count"],
             "total_fetched": result["total_fetched"],
             "filter": "All emails"
         })
@@ -846,6 +1004,7 @@ def search_mails(
                 "hasAttachments": email.has_attachments,
                 "bodyPreview": email.body_preview,
                 "importance": email.importance,
+                "removed_at": email.removed_at.isoformat() if email.removed_at else None,
                 "created_at": email.created_at.isoformat(),
                 "updated_at": email.updated_at.isoformat()
             }
@@ -870,13 +1029,74 @@ def get_mail_attachments(
     db: Session = Depends(get_db)
 ):
     """
-    Lấy danh sách file đính kèm của một email
+    Lấy danh sách file đính kèm của một email (metadata lưu lúc sync, chỉ gọi Graph khi chưa có).
+    Nội dung file lấy qua /mails/attachments/{message_id}/{attachment_id}/content
+    """
+    try:
+        attachments = get_attachments_list(db, account_id, message_id)
+        return JSONResponse({"value": attachments})
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/mails/attachments/{message_id}/{attachment_id}/content")
+def get_mail_attachment_content(
+    account_id: int,
+    message_id: str,
+    attachment_id: str,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """
+    Tải nội dung một file đính kèm. Lần đầu lấy từ Graph vào attachment store,
+    các lần sau trả trực tiếp từ đĩa (hỗ trợ Range, If-None-Match, ETag theo SHA-256)
+    """
+    try:
+        email = get_email_by_message_id(db, account_id, message_id)
+        if not email:
+            raise HTTPException(status_code=404, detail="Email not found")
+        
+        attachment = get_cached_attachment(db, account_id, email, attachment_id)
+        return RangeFileResponse(
+            get_attachment_path(attachment.content_hash),
+            etag=f'"{attachment.content_hash}"',
+            request_headers=request.headers,
+            media_type=attachment.content_type,
+            filename=attachment.name
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/mails/attachments/{message_id}/download")
+def download_mail_attachments(
+    account_id: int,
+    message_id: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Stream file đính kèm của một email vào attachment store (dedup theo SHA-256)
     """
     try:
-        access_token = get_valid_access_token(db, account_id)
-        attachments = get_attachments(access_token, message_id)
-        return JSONResponse(attachments)
+        email = get_email_by_message_id(db, account_id, message_id)
+        if not email:
+            raise HTTPException(status_code=404, detail="Email not found")
         
+        attachments = download_message_attachments(db, account_id, email)
+        return JSONResponse({
+            "message_id": message_id,
+            "attachments": attachments,
+            "total": len(attachments)
+        })
+        
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -887,29 +1107,15 @@ def get_auth_status(account_id: int, db: Session = Depends(get_db)):
     Kiểm tra trạng thái xác thực của account
     """
     try:
-        # Kiểm tra account có tồn tại không
-        account = get_account_by_id(db, account_id)
-        if not account:
-            return JSONResponse({"authenticated": False, "message": "Account not found"})
-        
-        # Kiểm tra token có hợp lệ không
-        auth_token = get_valid_auth_token(db, account_id)
-        if not auth_token:
-            return JSONResponse({"authenticated": False, "message": "No valid token found"})
+        # Account và token lấy từ token cache (không query accounts / auth_tokens mỗi lần gọi)
+        status = token_cache.get_status(db, account_id)
+        if not status:
+            return JSONResponse({"authenticated": False, "message": "Account not found or no valid token found"})
         
         return JSONResponse({
             "authenticated": True,
-            "account": {
-                "id": account.id,
-                "email": account.email,
-                "name": account.name,
-                "display_name": account.display_name
-            },
-            "token": {
-                "expires_at": auth_token.expires_at.isoformat(),
-                "expires_in": auth_token.expires_in,
-                "is_active": auth_token.is_active
-            },
+            "account": status["account"],
+            "token": status["token"],
             "message": "Token is valid"
         })
         
@@ -980,6 +1186,75 @@ def get_auto_sync_status():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/graph/throttling-metrics")
+def get_graph_throttling_metrics():
+    """Metrics của Graph request scheduler (số lần bị throttle, thời gian chờ, tốc độ hiện tại mỗi mailbox)"""
+    try:
+        return JSONResponse({
+            "metrics": graph_scheduler.get_metrics(),
+            "token_cache": token_cache.get_metrics()
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/graph/request-budget")
+def get_graph_request_budget(
+    account_id: Optional[int] = None,
+    hours: int = 24,
+    db: Session = Depends(get_db)
+):
+    """
+    Graph request budget: usage trong cửa sổ hiện tại (bộ nhớ) và lịch sử theo bucket (bảng graph_request_usage)
+    """
+    try:
+        request_budget.flush()
+        history = get_graph_request_usage(db, datetime.utcnow() - timedelta(hours=hours), account_id)
+        current = request_budget.get_status()
+        if account_id is not None:
+            current["accounts"] = [request_budget.get_usage(account_id)]
+
+        return JSONResponse({
+            "current": current,
+            "history": [
+                {
+                    "account_id": row.account_id,
+                    "bucket_start": row.bucket_start.isoformat(),
+                    "requests": row.requests,
+                    "cost": row.cost,
+                    "throttled": row.throttled,
+                    "token_requests": row.token_requests
+                }
+                for row in history
+            ]
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/auto-sync/circuit-breakers")
+def get_circuit_breakers(db: Session = Depends(get_db)):
+    """Danh sách các account đang bị circuit breaker bỏ qua khi auto sync"""
+    try:
+        return JSONResponse({
+            "circuit_breakers": get_circuit_breaker_status(db)
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/auto-sync/circuit-breakers/{account_id}/reset")
+def reset_account_circuit_breaker(account_id: int, db: Session = Depends(get_db)):
+    """Đóng circuit breaker của account để auto sync thử lại ngay ở chu kỳ tiếp theo"""
+    try:
+        reset_circuit_breaker(db, account_id)
+        return JSONResponse({
+            "message": f"Circuit breaker for account {account_id} reset"
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.post("/auto-sync/add-account/{account_id}")
 def add_account_to_sync(account_id: int):
     """Manually add an account to the auto sync queue"""
@@ -993,6 +1268,61 @@ def add_account_to_sync(account_id: int):
         raise HTTPException(status_code=500, detail=str(e)) 
 
 
+# Webhook (Graph change notifications) Endpoints
+@router.post("/webhooks/graph")
+def graph_webhook(
+    validationToken: Optional[str] = None,
+    payload: Optional[dict] = Body(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Nhận change notifications và lifecycle notifications từ Microsoft Graph.
+    Khi tạo subscription, Graph gửi validationToken và yêu cầu trả lại nguyên văn dạng text/plain.
+    """
+    if validationToken is not None:
+        return PlainTextResponse(validationToken)
+    
+    accepted = webhook_service.handle_notifications(db, payload or {})
+    return JSONResponse({"accepted": accepted}, status_code=202)
+
+
+@router.get("/webhooks/subscriptions")
+def get_webhook_subscriptions(db: Session = Depends(get_db)):
+    """Trạng thái webhook service và các subscriptions"""
+    try:
+        return JSONResponse(webhook_service.get_status(db))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/webhooks/subscriptions/{account_id}")
+def create_webhook_subscription(account_id: int, renew: bool = False, db: Session = Depends(get_db)):
+    """Tạo subscription cho account (hoặc gia hạn nếu đã có)"""
+    if not webhook_service.enabled:
+        raise HTTPException(status_code=400, detail="WEBHOOK_NOTIFICATION_URL is not configured")
+    
+    try:
+        subscription = ensure_subscription(db, account_id, renew=renew)
+        return JSONResponse({"subscription": subscription_to_dict(subscription)})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.delete("/webhooks/subscriptions/{account_id}")
+def delete_webhook_subscription(account_id: int, db: Session = Depends(get_db)):
+    """Xóa subscription của account (account quay về chỉ dùng daily sync)"""
+    try:
+        if not remove_subscription(db, account_id):
+            raise HTTPException(status_code=404, detail="Subscription not found")
+        return JSONResponse({"message": f"Subscription of account {account_id} deleted"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.get("/export/meta-receipts/")
 def export_meta_receipts(
     account_ids: str,  # Comma-separated list of account IDs
@@ -1,14 +1,49 @@
 """
 Business logic services for email synchronization
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, Any, List
+from itertools import islice, chain
+from typing import Dict, Any, List, Iterable, Optional, Tuple
+from fastapi import HTTPException
 from sqlalchemy.orm import Session
 
-from .graph_api import get_emails_from_graph
-from .email_utils import is_meta_receipt_email
+from .config import (
+    EMAIL_PAGE_SIZE,
+    EMAIL_COMPARE_CHUNK_SIZE,
+    DELTA_SYNC_FOLDER,
+    BACKFILL_MAX_WORKERS,
+    MULTI_FOLDER_SYNC_ENABLED
+)
+from .graph_api import (
+    get_email_pages_from_graph,
+    iter_messages_batch_from_graph,
+    get_email_delta_pages_from_graph,
+    translate_exchange_ids
+)
+from .auth import get_valid_access_token
+from .backfill_planner import BackfillPlanner, format_window_time
+from .immutable_ids import uses_immutable_ids, set_uses_immutable_ids
+from .mail_folders import get_sync_folder_ids, invalidate_sync_folders
+from .email_utils import is_meta_receipt_email, is_text_body_account, EMAIL_SELECT_FIELDS, EMAIL_HEADER_SELECT_FIELDS
 from .email_utils_bs4 import extract_meta_receipt_info_combined
-from crud import create_email
+from .meta_receipt_service import MetaReceiptService
+from crud import (
+    create_email,
+    get_email_change_keys,
+    is_email_changed,
+    bulk_update_emails_from_graph,
+    mark_emails_removed,
+    restore_removed_emails,
+    get_delta_sync_state,
+    save_delta_link,
+    delete_delta_sync_state,
+    delete_account_delta_sync_states,
+    get_account_message_ids,
+    update_email_message_ids,
+    update_account
+)
+from database import get_db
 from models import Email
 
 
@@ -18,47 +53,82 @@ class EmailSyncService:
     def __init__(self, db: Session, account_id: int):
         self.db = db
         self.account_id = account_id
+        self.text_body = is_text_body_account(account_id)  # Text body mode: body dạng plain text
     
     def sync_emails_by_date_range(
         self, 
         received_from: str = None, 
         received_to: str = None,
-        top: int = 999
+        top: int = EMAIL_PAGE_SIZE
     ) -> Dict[str, Any]:
         """
-        Đồng bộ email theo khoảng thời gian
+        Đồng bộ email theo khoảng thời gian (xử lý lần lượt từng trang, top = số email mỗi trang).
+        Filter Meta receipt được đẩy xuống Graph, is_meta_receipt_email chỉ còn là lớp kiểm tra lại.
+        Two-phase fetch: phase 1 chỉ lấy header (id, subject, ngày, changeKey), phase 2 lấy body qua $batch
+        cho các receipt chưa có trong database hoặc có changeKey khác với bản đã lưu.
+        Khi bật MULTI_FOLDER_SYNC_ENABLED, các mail folder (Inbox, Junk, folder của inbox rule) được quét song song
+        và trang của mọi folder đi chung qua bước so sánh / ghi database này.
+        Email đã có nhưng changeKey khác được cập nhật (updated_count) và meta receipt của nó được trích xuất lại.
         """
         try:
-            # Lấy emails từ Graph API
-            emails_data = get_emails_from_graph(
+            synced_count = 0
+            updated_count = 0
+            total_fetched = 0
+            meta_receipt_rows = []
+            
+            # Phase 1: lấy header emails từ Graph API theo từng trang
+            pages = get_email_pages_from_graph(
                 self.db, 
                 self.account_id, 
                 top, 
                 received_from, 
-                received_to
+                received_to,
+                meta_only=True,
+                select=EMAIL_HEADER_SELECT_FIELDS,
+                folder_ids=get_sync_folder_ids(self.db, self.account_id) if MULTI_FOLDER_SYNC_ENABLED else None,
+                on_folder_missing=lambda folder_id: invalidate_sync_folders(self.account_id)
             )
             
-            synced_count = 0
-            meta_receipt_rows = []
-            
-            # Lưu từng email vào database
-            for email_data in emails_data.get("value", []):
-                email_id = email_data.get("id")
+            for page in pages:
+                total_fetched += len(page)
+                
+                # So sánh changeKey với database (một query cho cả trang)
+                page_ids = [email_header.get("id") for email_header in page]
+                change_keys = get_email_change_keys(self.db, self.account_id, page_ids)
+                
+                # Chỉ lấy body cho Meta receipt emails mới hoặc đã thay đổi
+                candidate_ids = []
+                unchanged_ids = []
+                for email_header in page:
+                    email_id = email_header.get("id")
+                    if email_id in change_keys and not is_email_changed(change_keys, email_header):
+                        print(f"⚠️ Email unchanged in DB: {email_header.get('subject', 'No subject')} (id: {email_id})")
+                        unchanged_ids.append(email_id)
+                        continue
+                    # Email đã có trong database thì luôn cập nhật (kể cả khi subject không còn khớp filter)
+                    if email_id in change_keys or is_meta_receipt_email(email_header.get("subject") or ""):
+                        candidate_ids.append(email_id)
                 
-                # Kiểm tra email đã tồn tại chưa
-                existing_email = self.db.query(Email).filter_by(
-                    account_id=self.account_id, 
-                    message_id=email_id
-                ).first()
+                # Email đã đánh dấu removed nhưng vẫn còn trong một folder đang sync
+                restore_removed_emails(self.db, self.account_id, unchanged_ids)
                 
-                if existing_email:
-                    print(f"⚠️ Email already exists in DB: {email_data.get('subject', 'No subject')} (id: {email_id})")
+                if not candidate_ids:
                     continue
                 
-                subject = email_data.get("subject", "")
+                # Phase 2: lấy đầy đủ nội dung qua $batch, lưu từng email ngay khi được decode
+                messages = iter_messages_batch_from_graph(
+                    self.db, self.account_id, candidate_ids, text_body=self.text_body
+                )
                 
-                # Chỉ lưu Meta receipt emails
-                if is_meta_receipt_email(subject):
+                changed_emails = []
+                for email_id, email_data in messages:
+                    # Email đã có, changeKey khác: cập nhật theo lô ở cuối trang, không tính là email mới
+                    if email_id in change_keys:
+                        changed_emails.append(email_data)
+                        continue
+                    
+                    subject = email_data.get("subject", "")
+                    
                     # Trích xuất thông tin từ body và body_preview
                     body_html = email_data.get('body', {}).get('content', '')
                     body_preview = email_data.get('bodyPreview', '')
@@ -80,10 +150,18 @@ class EmailSyncService:
                     create_email(self.db, self.account_id, email_data)
                     synced_count += 1
                     print(f"✅ Synced email: {subject if subject else 'No subject'}")
+                
+                if changed_emails:
+                    updated_emails = bulk_update_emails_from_graph(self.db, self.account_id, changed_emails)
+                    updated_count += len(updated_emails)
+                    receipt_result = MetaReceiptService(self.db).refresh_emails_receipts(self.account_id, updated_emails)
+                    print(f"🔄 Updated {len(updated_emails)} changed emails "
+                          f"({receipt_result['refreshed_count']} meta receipts re-extracted)")
             
             return {
                 "synced_count": synced_count,
-                "total_fetched": len(emails_data.get("value", [])),
+                "updated_count": updated_count,
+                "total_fetched": total_fetched,
                 "meta_receipt_rows": meta_receipt_rows
             }
             
@@ -97,48 +175,66 @@ class EmailSyncService:
         """
         today = datetime.utcnow().date()
         one_month_ago = today - timedelta(days=30)
-        total_synced = 0
-        total_days = 0
-        details = []
+        result = self.sync_backfill(one_month_ago.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d'))
+        # Số ngày trong khoảng sync (giữ cho client cũ của /mails/sync-monthly/)
+        result["days_processed"] = (today - one_month_ago).days + 1
+        return result
+    
+    def sync_backfill(self, received_from: str, received_to: str) -> Dict[str, Any]:
+        """
+        Đồng bộ khoảng thời gian bất kỳ (YYYY-MM-DD, gồm cả ngày received_to).
+        """
+        start = datetime.strptime(received_from, '%Y-%m-%d')
+        end = min(datetime.strptime(received_to, '%Y-%m-%d') + timedelta(days=1), datetime.utcnow() + timedelta(minutes=1))
+        return self.sync_time_range(start, end)
+    
+    def sync_time_range(self, start: datetime, end: datetime) -> Dict[str, Any]:
+        """
+        Đồng bộ khoảng [start, end). BackfillPlanner chia khoảng theo $count, các window được sync song song,
+        mỗi window dùng một database session riêng.
+        """
+        planner = BackfillPlanner(
+            get_valid_access_token(self.db, self.account_id),
+            self.account_id,
+            folder_ids=get_sync_folder_ids(self.db, self.account_id) if MULTI_FOLDER_SYNC_ENABLED else None
+        )
+        windows = planner.plan(start, end)
+        print(f"🗓️ Backfill {format_window_time(start)} → {format_window_time(end)} for account {self.account_id}: "
+              f"{len(windows)} windows, {sum(count for _, _, count in windows)} emails, {planner.count_requests} count requests")
         
-        for i in range(31):
-            day_from = one_month_ago + timedelta(days=i)
-            day_to = day_from
-            
-            if day_from > today:
-                break
-                
-            received_from = day_from.strftime('%Y-%m-%d')
-            received_to = day_to.strftime('%Y-%m-%d')
-            
+        def sync_window(window) -> Dict[str, Any]:
+            window_start, window_end, expected = window
+            detail = {
+                "from": format_window_time(window_start),
+                "to": format_window_time(window_end),
+                "expected": expected
+            }
+            db = next(get_db())
             try:
-                result = self.sync_emails_by_date_range(received_from, received_to)
-                synced_count = result["synced_count"]
-                total_synced += synced_count
-                total_days += 1
-                
-                details.append({
-                    "date": received_from,
-                    "synced": synced_count,
-                    "total_fetched": result["total_fetched"]
-                })
-                
+                result = EmailSyncService(db, self.account_id).sync_emails_by_date_range(detail["from"], detail["to"])
+                detail["synced"] = result["synced_count"]
+                detail["updated"] = result["updated_count"]
+                detail["total_fetched"] = result["total_fetched"]
             except Exception as e:
-                details.append({
-                    "date": received_from,
-                    "error": str(e)
-                })
-                continue
+                detail["error"] = str(e)
+            finally:
+                db.close()
+            return detail
+        
+        with ThreadPoolExecutor(max_workers=BACKFILL_MAX_WORKERS) as executor:
+            details = list(executor.map(sync_window, windows))
         
         return {
-            "total_synced": total_synced,
-            "days_processed": total_days,
+            "total_synced": sum(detail.get("synced", 0) for detail in details),
+            "updated_count": sum(detail.get("updated", 0) for detail in details),
+            "windows_processed": len([detail for detail in details if "error" not in detail]),
+            "count_requests": planner.count_requests,
             "details": details
         }
     
     def sync_daily_emails(self) -> Dict[str, Any]:
         """
-        Đồng bộ email mới hàng ngày với tối đa 999 emails
+        Đồng bộ email mới hàng ngày (lấy hết các trang, không giới hạn 999 emails)
         """
         today = datetime.utcnow().date()
         yesterday = today - timedelta(days=1)
@@ -147,11 +243,11 @@ class EmailSyncService:
         received_to = today.strftime('%Y-%m-%d')
         
         try:
-            # Sử dụng tối đa 999 emails cho daily sync
-            result = self.sync_emails_by_date_range(received_from, received_to, top=999)
+            result = self.sync_emails_by_date_range(received_from, received_to)
             
             return {
                 "total_synced": result["synced_count"],
+                "updated_count": result["updated_count"],
                 "total_fetched": result["total_fetched"],
                 "date_range": {
                     "from": received_from,
@@ -160,4 +256,244 @@ class EmailSyncService:
             }
             
         except Exception as e:
-            raise 
\ No newline at end of file
+            raise
+    
+    def sync_delta_emails(self, folder_id: str = None) -> Dict[str, Any]:
+        """
+        Đồng bộ tăng dần bằng Graph delta query: chỉ lấy thay đổi kể từ deltaLink lần trước.
+        Delta query chạy trên từng mail folder, mỗi folder một deltaLink riêng: folder_id None thì chạy mọi folder
+        cần sync (get_sync_folder_ids khi bật MULTI_FOLDER_SYNC_ENABLED, ngược lại DELTA_SYNC_FOLDER).
+        Lần đầu (chưa có deltaLink) bắt đầu từ ngày hôm qua.
+        """
+        if folder_id:
+            folder_ids = [folder_id]
+        elif MULTI_FOLDER_SYNC_ENABLED:
+            folder_ids = get_sync_folder_ids(self.db, self.account_id)
+        else:
+            folder_ids = [DELTA_SYNC_FOLDER]
+        
+        result = {
+            "total_synced": 0,
+            "total_fetched": 0,
+            "updated_count": 0,
+            "removed_count": 0
+        }
+        # Email chuyển giữa hai folder đang sync có @removed ở folder cũ và xuất hiện ở folder mới:
+        # message_id -> True nếu chỉ gặp @removed, chỉ đánh dấu removed_at sau khi đã chạy hết các folder
+        removals: Dict[str, bool] = {}
+        delta_links: Dict[str, str] = {}
+        synced_folder_ids = []
+        
+        for current_folder_id in folder_ids:
+            try:
+                folder_result, delta_links[current_folder_id] = self._sync_folder_delta(current_folder_id, removals)
+            except HTTPException as e:
+                # Folder đã bị xóa: bỏ qua, lần sync sau liệt kê lại danh sách folder
+                if e.status_code != 404 or folder_id:
+                    raise
+                print(f"⚠️ Mail folder {current_folder_id} not found for account {self.account_id}, skipping")
+                invalidate_sync_folders(self.account_id)
+                delete_delta_sync_state(self.db, self.account_id, current_folder_id)
+                continue
+            
+            for key, value in folder_result.items():
+                result[key] += value
+            synced_folder_ids.append(current_folder_id)
+        
+        removed_ids = [message_id for message_id, removed in removals.items() if removed]
+        if removed_ids:
+            result["removed_count"] = mark_emails_removed(self.db, self.account_id, removed_ids)
+            print(f"🗑️ Marked {result['removed_count']} emails as removed")
+        
+        # Chỉ lưu deltaLink khi mọi folder đã xử lý xong, lỗi giữa chừng sẽ được chạy lại lần sau
+        for current_folder_id, delta_link in delta_links.items():
+            if delta_link:
+                save_delta_link(self.db, self.account_id, delta_link, current_folder_id)
+        
+        result["folder_ids"] = synced_folder_ids
+        return result
+    
+    def _sync_folder_delta(self, folder_id: str, removals: Dict[str, bool]) -> Tuple[Dict[str, Any], Optional[str]]:
+        """Chạy delta query của một folder từ deltaLink đã lưu, trả về (kết quả, deltaLink mới)"""
+        state = get_delta_sync_state(self.db, self.account_id, folder_id)
+        delta_link = state.delta_link if state else None
+        
+        try:
+            return self._apply_email_delta(folder_id, delta_link, removals)
+        except HTTPException as e:
+            # 410 Gone: deltaLink hết hạn, bắt đầu lại vòng delta mới
+            if e.status_code != 410 or not delta_link:
+                raise
+            print(f"⚠️ Delta link expired for account {self.account_id} (folder {folder_id}), restarting delta sync")
+            delete_delta_sync_state(self.db, self.account_id, folder_id)
+            return self._apply_email_delta(folder_id, None, removals)
+    
+    def sync_messages_by_ids(self, changes: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Đồng bộ các message cụ thể từ change notification (message_id -> changeType),
+        không quét lại cả khoảng thời gian. Message bị xóa được xử lý như @removed của delta query
+        (đánh dấu removed_at, meta receipt được giữ lại). Khi bật MULTI_FOLDER_SYNC_ENABLED, message
+        nằm ngoài các folder cần sync (vd: đã chuyển vào Deleted Items) cũng được xử lý như bị xóa.
+        """
+        removed = [
+            {"id": message_id, "@removed": {"reason": "deleted"}}
+            for message_id, change_type in changes.items() if change_type == "deleted"
+        ]
+        fetch_ids = [message_id for message_id, change_type in changes.items() if change_type != "deleted"]
+        select = EMAIL_SELECT_FIELDS
+        sync_folder_ids = None
+        if MULTI_FOLDER_SYNC_ENABLED and fetch_ids:
+            sync_folder_ids = set(get_sync_folder_ids(self.db, self.account_id))
+            select += ",parentFolderId"
+        fetched = iter_messages_batch_from_graph(
+            self.db, self.account_id, fetch_ids, select, text_body=self.text_body
+        )
+        
+        def to_delta_item(email_data: Dict[str, Any]) -> Dict[str, Any]:
+            if sync_folder_ids is not None and email_data.get("parentFolderId") not in sync_folder_ids:
+                return {"id": email_data.get("id"), "@removed": {"reason": "changed"}}
+            return email_data
+        
+        return self.apply_delta_messages(chain(removed, (to_delta_item(email_data) for _, email_data in fetched)))
+    
+    def migrate_to_immutable_ids(self) -> Dict[str, Any]:
+        """
+        Chuyển message_id đã lưu (REST ID, đổi khi email bị chuyển folder) sang immutable ID bằng
+        translateExchangeIds, sau đó các lần sync của account gửi Prefer: IdType="ImmutableId".
+        ID không chuyển được (email đã bị xóa / chuyển đi) được giữ nguyên.
+        """
+        if uses_immutable_ids(self.account_id):
+            return {"account_id": self.account_id, "already_migrated": True}
+        
+        message_ids = get_account_message_ids(self.db, self.account_id)
+        access_token = get_valid_access_token(self.db, self.account_id)
+        id_map = translate_exchange_ids(access_token, message_ids, self.account_id)
+        result = update_email_message_ids(self.db, self.account_id, id_map)
+        
+        # deltaLink cũ trả về REST ID: bắt đầu vòng delta mới với immutable ID
+        delete_account_delta_sync_states(self.db, self.account_id)
+        update_account(self.db, self.account_id, uses_immutable_ids=True)
+        set_uses_immutable_ids(self.account_id, True)
+        
+        print(f"🆔 Migrated {result['updated']} message ids to immutable ids for account {self.account_id} "
+              f"({result['duplicates_removed']} duplicates removed, {len(message_ids) - len(id_map)} not translated)")
+        return {
+            "account_id": self.account_id,
+            "total": len(message_ids),
+            "translated": len(id_map),
+            "updated": result["updated"],
+            "duplicates_removed": result["duplicates_removed"]
+        }
+    
+    def _apply_email_delta(
+        self,
+        folder_id: str,
+        delta_link: str = None,
+        removals: Dict[str, bool] = None
+    ) -> Tuple[Dict[str, Any], Optional[str]]:
+        """
+        Áp dụng các thay đổi (thêm / cập nhật / xóa) từ delta query của folder vào database,
+        trả về (kết quả, deltaLink mới)
+        """
+        received_from = None
+        if not delta_link:
+            received_from = (datetime.utcnow().date() - timedelta(days=1)).strftime('%Y-%m-%d')
+        
+        result = {
+            "total_synced": 0,
+            "total_fetched": 0,
+            "updated_count": 0,
+            "removed_count": 0
+        }
+        new_delta_link = None
+        
+        pages = get_email_delta_pages_from_graph(
+            self.db,
+            self.account_id,
+            delta_link,
+            folder_id,
+            received_from,
+            text_body=self.text_body
+        )
+        
+        for messages, page_info in pages:
+            page_result = self.apply_delta_messages(messages, removals)
+            for key, value in page_result.items():
+                result[key] += value
+            
+            if page_info.get("@odata.deltaLink"):
+                new_delta_link = page_info["@odata.deltaLink"]
+        
+        return result, new_delta_link
+    
+    def apply_delta_messages(self, messages: Iterable[Dict[str, Any]], removals: Dict[str, bool] = None) -> Dict[str, int]:
+        """
+        Áp dụng một trang kết quả delta (thêm / cập nhật / xóa) vào database.
+        Messages được xử lý theo từng nhóm EMAIL_COMPARE_CHUNK_SIZE: một query lấy changeKey cả nhóm,
+        chỉ email mới hoặc có changeKey khác mới được ghi.
+        removals: không đánh dấu @removed ngay mà ghi vào dict (message_id -> còn bị xóa hay không) để bên gọi
+        đánh dấu sau khi đã xem hết các folder.
+        """
+        synced_count = 0
+        fetched_count = 0
+        updated_count = 0
+        removed_count = 0
+        
+        messages = iter(messages)
+        while True:
+            chunk = list(islice(messages, EMAIL_COMPARE_CHUNK_SIZE))
+            if not chunk:
+                break
+            fetched_count += len(chunk)
+            
+            change_keys = get_email_change_keys(
+                self.db, self.account_id, [email_data.get("id") for email_data in chunk]
+            )
+            changed_emails = []
+            removed_ids = []
+            unchanged_ids = []
+            
+            for email_data in chunk:
+                email_id = email_data.get("id")
+                
+                # Message đã bị xóa hoặc chuyển ra khỏi folder: chỉ đánh dấu removed_at, meta receipt được giữ lại
+                if "@removed" in email_data:
+                    if removals is not None:
+                        removals.setdefault(email_id, True)
+                    elif email_id in change_keys:
+                        removed_ids.append(email_id)
+                    continue
+                if removals is not None:
+                    removals[email_id] = False
+                
+                if email_id in change_keys:
+                    if is_email_changed(change_keys, email_data):
+                        changed_emails.append(email_data)
+                    else:
+                        unchanged_ids.append(email_id)
+                    continue
+                
+                subject = email_data.get("subject") or ""
+                
+                # Chỉ lưu Meta receipt emails
+                if is_meta_receipt_email(subject):
+                    create_email(self.db, self.account_id, email_data)
+                    synced_count += 1
+                    print(f"✅ Synced email: {subject}")
+            
+            if changed_emails:
+                bulk_update_emails_from_graph(self.db, self.account_id, changed_emails)
+                updated_count += len(changed_emails)
+            
+            if removed_ids:
+                marked = mark_emails_removed(self.db, self.account_id, removed_ids)
+                removed_count += marked
+                print(f"🗑️ Marked {marked} emails as removed")
+            restore_removed_emails(self.db, self.account_id, unchanged_ids)
+        
+        return {
+            "total_synced": synced_count,
+            "total_fetched": fetched_count,
+            "updated_count": updated_count,
+            "removed_count": removed_count
+        }
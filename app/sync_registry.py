@@ -0,0 +1,195 @@
+"""
+Single-flight registry cho sync theo account: mỗi account chỉ một job sync chạy tại một thời điểm.
+Request tới sau cho cùng account và cùng cửa sổ (job_key) không sync lại mà chờ job đang chạy và nhận kết quả của nó.
+Giữa các worker process, job được tuần tự hóa bằng Postgres advisory lock (SYNC_LOCK_NAMESPACE, account_id)
+và kết quả được ghi vào bảng sync_jobs để process đang chờ dùng lại. Lock và sync_jobs dùng chung một connection,
+mỗi job chỉ giữ thêm một connection ngoài session của chính nó.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Any, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .config import SYNC_LOCK_NAMESPACE, SYNC_LOCK_POLL_SECONDS, SYNC_LOCK_TIMEOUT_SECONDS
+from crud import get_sync_job, save_sync_job
+from database import engine
+
+
+class _Flight:
+    """Job đang chạy trong process: các caller đi sau chờ event rồi lấy result / error"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+    def wait(self) -> Dict[str, Any]:
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SyncRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights: Dict[str, _Flight] = {}
+        self.account_locks: Dict[int, threading.Lock] = {}
+        self.metrics = {
+            "started": 0,
+            "coalesced": 0,
+            "coalesced_cross_process": 0
+        }
+
+    @property
+    def uses_advisory_lock(self) -> bool:
+        return engine.dialect.name == "postgresql"
+
+    def _thread_lock(self, account_id: int) -> threading.Lock:
+        with self.lock:
+            return self.account_locks.setdefault(account_id, threading.Lock())
+
+    def _finished_result(self, db: Session, job_key: str, requested_at: datetime) -> Optional[Dict[str, Any]]:
+        """Kết quả của job cùng key đã chạy xong (ở process khác) sau thời điểm request"""
+        job = get_sync_job(db, job_key)
+        result = None
+        if job and job.status == "succeeded" and job.finished_at and job.finished_at >= requested_at:
+            result = job.result
+        db.commit()  # Kết thúc transaction đọc, connection còn dùng cho lock
+        return result
+
+    @contextmanager
+    def _advisory_lock(self, account_id: int, job_key: str = None, requested_at: datetime = None):
+        """
+        Giữ advisory lock của account. Yield (db, finished): db là session trên connection giữ lock
+        (dùng cho sync_jobs, None khi không dùng advisory lock), finished là kết quả của job cùng key
+        mà process khác vừa chạy xong trong lúc chờ (khi đó không giữ lock)
+        """
+        if not self.uses_advisory_lock:
+            yield None, None
+            return
+
+        params = {"namespace": SYNC_LOCK_NAMESPACE, "account_id": account_id}
+        with engine.connect() as connection, Session(bind=connection) as db:
+            deadline = time.monotonic() + SYNC_LOCK_TIMEOUT_SECONDS
+            while True:
+                acquired = db.execute(
+                    text("SELECT pg_try_advisory_lock(:namespace, :account_id)"), params
+                ).scalar()
+                db.commit()
+
+                finished = self._finished_result(db, job_key, requested_at) if job_key else None
+                if finished is not None:
+                    if acquired:
+                        db.execute(text("SELECT pg_advisory_unlock(:namespace, :account_id)"), params)
+                        db.commit()
+                    yield db, finished
+                    return
+                if acquired:
+                    break
+                if time.monotonic() > deadline:
+                    raise HTTPException(status_code=409, detail=f"Sync của account {account_id} đang chạy ở process khác")
+                time.sleep(SYNC_LOCK_POLL_SECONDS)
+
+            try:
+                yield db, None
+            finally:
+                db.rollback()
+                db.execute(text("SELECT pg_advisory_unlock(:namespace, :account_id)"), params)
+                db.commit()
+
+    @contextmanager
+    def account_lock(self, account_id: int):
+        """Tuần tự hóa một đoạn ghi database của account với các job sync khác (không coalesce)"""
+        with self._thread_lock(account_id):
+            with self._advisory_lock(account_id):
+                yield
+
+    def run(self, account_id: int, operation: str, fn: Callable[[], Dict[str, Any]], window: str = "") -> Dict[str, Any]:
+        """
+        Chạy fn như job sync (account_id, operation, window). Nếu job cùng key đang chạy thì chờ và trả về
+        kết quả của job đó; job khác của cùng account thì chờ tới lượt.
+        """
+        job_key = f"{account_id}:{operation}:{window}"
+        requested_at = datetime.utcnow()
+
+        with self.lock:
+            flight = self.flights.get(job_key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.flights[job_key] = flight
+            else:
+                flight.waiters += 1
+                self.metrics["coalesced"] += 1
+
+        if not leader:
+            print(f"🔗 Joined running sync {job_key}")
+            return flight.wait()
+
+        try:
+            with self._thread_lock(account_id):
+                with self._advisory_lock(account_id, job_key, requested_at) as (db, finished):
+                    if finished is not None:
+                        self.metrics["coalesced_cross_process"] += 1
+                        print(f"🔗 Reused result of sync {job_key} finished by another process")
+                        flight.result = finished
+                    else:
+                        flight.result = self._run_job(db, account_id, job_key, fn)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(job_key, None)
+            flight.event.set()
+
+    def _run_job(self, db: Optional[Session], account_id: int, job_key: str, fn: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """Chạy fn trong khi giữ lock, ghi trạng thái vào sync_jobs qua db (chỉ cần khi có nhiều process)"""
+        self.metrics["started"] += 1
+        if db is None:
+            return fn()
+
+        save_sync_job(
+            db, account_id, job_key,
+            status="running", started_at=datetime.utcnow(), finished_at=None, error=None, result=None
+        )
+        db.commit()  # Không giữ transaction (refresh sau commit) trong suốt job
+        try:
+            result = fn()
+        except Exception as e:
+            save_sync_job(db, account_id, job_key, status="failed", error=str(e), finished_at=datetime.utcnow())
+            raise
+
+        save_sync_job(
+            db, account_id, job_key,
+            status="succeeded",
+            result=json.loads(json.dumps(result, default=str)),
+            finished_at=datetime.utcnow()
+        )
+        return result
+
+    def get_status(self) -> Dict[str, Any]:
+        """Các job đang chạy trong process này và số request đã được coalesce"""
+        with self.lock:
+            return {
+                "running": [
+                    {"job_key": job_key, "waiters": flight.waiters}
+                    for job_key, flight in self.flights.items()
+                ],
+                "metrics": dict(self.metrics),
+                "advisory_lock": self.uses_advisory_lock
+            }
+
+
+# Global instance
+sync_registry = SyncRegistry()
@@ -0,0 +1,318 @@
+"""
+Access token cache theo account: mọi đường gọi Graph lấy token từ bộ nhớ thay vì query auth_tokens mỗi lần.
+Thread nền refresh trước khi token hết hạn (TOKEN_REFRESH_AHEAD_SECONDS), các request refresh đồng thời của
+cùng account được gộp thành một (refresh_token cũ không bị ghi đè bởi request chạy sau).
+Giữa các worker process, refresh được tuần tự hóa bằng Postgres advisory lock (TOKEN_LOCK_NAMESPACE, account_id):
+process lấy được lock sau cùng đọc lại auth_tokens và dùng token process trước vừa ghi.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .config import (
+    CLIENT_ID,
+    CLIENT_SECRET,
+    AUTHORITY,
+    SCOPE,
+    TOKEN_REFRESH_AHEAD_SECONDS,
+    TOKEN_EXPIRY_SKEW_SECONDS,
+    TOKEN_CACHE_RELOAD_SECONDS,
+    TOKEN_CACHE_CHECK_SECONDS,
+    TOKEN_LOCK_NAMESPACE,
+    TOKEN_LOCK_POLL_SECONDS,
+    TOKEN_LOCK_TIMEOUT_SECONDS
+)
+from .http_client import http_post
+from .request_budget import request_budget
+from crud import get_account_by_id, get_valid_auth_token, update_auth_token
+from database import engine, get_db
+
+
+class CachedToken:
+    """Bản sao trong bộ nhớ của dòng auth_tokens (kèm thông tin account cho /status)"""
+
+    def __init__(self, auth_token, account=None):
+        self.token_id = auth_token.id
+        self.account_id = auth_token.account_id
+        self.access_token = auth_token.access_token
+        self.refresh_token = auth_token.refresh_token
+        self.expires_in = auth_token.expires_in
+        self.expires_at = auth_token.expires_at
+        self.is_active = auth_token.is_active
+        self.account = {
+            "id": account.id,
+            "email": account.email,
+            "name": account.name,
+            "display_name": account.display_name
+        } if account else None
+        self.loaded_at = time.monotonic()
+        self.refreshed_at = 0.0  # monotonic, lần refresh gần nhất trong process này
+
+    def expires_within(self, seconds: float) -> bool:
+        return datetime.utcnow() + timedelta(seconds=seconds) >= self.expires_at
+
+
+class TokenCache:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens: Dict[int, CachedToken] = {}
+        self.refresh_locks: Dict[int, threading.Lock] = {}
+        self.metrics = {
+            "hits": 0,
+            "loads": 0,
+            "refreshes": 0,
+            "refreshes_ahead": 0,
+            "refreshes_coalesced": 0,
+            "refreshes_cross_process": 0,
+            "refresh_failures": 0
+        }
+        self.is_running = False
+        self.refresh_thread = None
+
+    def _load(self, db: Session, account_id: int) -> Optional[CachedToken]:
+        """Đọc token (và account) từ database vào cache"""
+        auth_token = get_valid_auth_token(db, account_id)
+        if not auth_token:
+            self.invalidate(account_id)
+            return None
+        entry = CachedToken(auth_token, get_account_by_id(db, account_id))
+        with self.lock:
+            previous = self.tokens.get(account_id)
+            if previous:
+                entry.refreshed_at = previous.refreshed_at
+            self.tokens[account_id] = entry
+            self.metrics["loads"] += 1
+        return entry
+
+    def get(self, db: Session, account_id: int) -> Optional[CachedToken]:
+        """Token của account từ cache, đọc lại database khi chưa có hoặc đã quá TOKEN_CACHE_RELOAD_SECONDS"""
+        with self.lock:
+            entry = self.tokens.get(account_id)
+            if entry and time.monotonic() - entry.loaded_at < TOKEN_CACHE_RELOAD_SECONDS:
+                self.metrics["hits"] += 1
+                return entry
+        return self._load(db, account_id)
+
+    def get_access_token(self, db: Session, account_id: int) -> str:
+        """Access token còn hạn; token sắp hết hạn (TOKEN_EXPIRY_SKEW_SECONDS) được refresh ngay"""
+        entry = self.get(db, account_id)
+        if not entry:
+            raise HTTPException(status_code=401, detail="No access token available")
+        if entry.expires_within(TOKEN_EXPIRY_SKEW_SECONDS):
+            return self.refresh(db, account_id)
+        return entry.access_token
+
+    @property
+    def uses_advisory_lock(self) -> bool:
+        return engine.dialect.name == "postgresql"
+
+    @contextmanager
+    def advisory_lock(self, account_id: int):
+        """Giữ advisory lock refresh của account, chờ tối đa TOKEN_LOCK_TIMEOUT_SECONDS khi process khác đang refresh"""
+        if not self.uses_advisory_lock:
+            yield
+            return
+
+        params = {"namespace": TOKEN_LOCK_NAMESPACE, "account_id": account_id}
+        with engine.connect() as connection:
+            deadline = time.monotonic() + TOKEN_LOCK_TIMEOUT_SECONDS
+            while not connection.execute(
+                text("SELECT pg_try_advisory_lock(:namespace, :account_id)"), params
+            ).scalar():
+                connection.commit()
+                if time.monotonic() > deadline:
+                    raise HTTPException(status_code=503, detail=f"Token của account {account_id} đang được refresh ở process khác")
+                time.sleep(TOKEN_LOCK_POLL_SECONDS)
+            connection.commit()
+
+            try:
+                yield
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(:namespace, :account_id)"), params)
+                connection.commit()
+
+    @contextmanager
+    def try_advisory_locks(self, account_ids: List[int]):
+        """
+        Thử lấy advisory lock của nhiều account (không chờ), yield các account đã lấy được lock.
+        Dùng cho refresh_tokens bulk: account đang được process khác refresh thì bỏ qua
+        """
+        if not self.uses_advisory_lock:
+            yield list(account_ids)
+            return
+
+        locked = []
+        with engine.connect() as connection:
+            try:
+                for account_id in account_ids:
+                    if connection.execute(
+                        text("SELECT pg_try_advisory_lock(:namespace, :account_id)"),
+                        {"namespace": TOKEN_LOCK_NAMESPACE, "account_id": account_id}
+                    ).scalar():
+                        locked.append(account_id)
+                connection.commit()
+                yield locked
+            finally:
+                for account_id in locked:
+                    connection.execute(
+                        text("SELECT pg_advisory_unlock(:namespace, :account_id)"),
+                        {"namespace": TOKEN_LOCK_NAMESPACE, "account_id": account_id}
+                    )
+                connection.commit()
+
+    def refresh_lock(self, account_id: int) -> threading.Lock:
+        """Lock refresh của account (refresh_tokens bulk cũng giữ lock này khi gọi OAuth)"""
+        with self.lock:
+            return self.refresh_locks.setdefault(account_id, threading.Lock())
+
+    def request_refresh(self, account_id: int, refresh_token: str):
+        """POST grant_type=refresh_token lên OAuth token endpoint, trả về response"""
+        token_url = f"{AUTHORITY}/oauth2/v2.0/token"
+        data = {
+            "client_id": CLIENT_ID,
+            "scope": " ".join(SCOPE),
+            "refresh_token": refresh_token,
+            "grant_type": "refresh_token",
+            "client_secret": CLIENT_SECRET
+        }
+        response = http_post(token_url, data=data)
+        request_budget.record_token_request(account_id)
+        return response
+
+    def refresh(self, db: Session, account_id: int, within_seconds: float = TOKEN_EXPIRY_SKEW_SECONDS) -> str:
+        """
+        Refresh access token bằng refresh_token nếu token hết hạn trong within_seconds. Chỉ một request refresh
+        mỗi account tại một thời điểm (thread lock trong process, advisory lock giữa các process): caller chờ lock
+        mà token đã được refresh xong trong lúc chờ thì dùng luôn token mới.
+        """
+        requested_at = time.monotonic()
+        with self.refresh_lock(account_id):
+            with self.lock:
+                entry = self.tokens.get(account_id)
+                # Thread khác vừa refresh xong (kể cả trước khi caller này gọi refresh): không gửi refresh lần hai
+                if entry and (entry.refreshed_at >= requested_at or not entry.expires_within(within_seconds)):
+                    self.metrics["refreshes_coalesced"] += 1
+                    return entry.access_token
+
+            # Advisory lock: process khác đang refresh thì chờ, lấy được lock rồi mới đọc lại database
+            with self.advisory_lock(account_id):
+                auth_token = get_valid_auth_token(db, account_id)
+                if not auth_token:
+                    self.invalidate(account_id)
+                    raise HTTPException(status_code=401, detail="No valid token found")
+                db.refresh(auth_token)
+                # Token đã được refresh (bởi process khác) trong lúc chờ: dùng luôn, không gửi refresh_token cũ
+                if datetime.utcnow() + timedelta(seconds=within_seconds) < auth_token.expires_at and (
+                    not entry or auth_token.expires_at > entry.expires_at
+                ):
+                    entry = self._load(db, account_id)
+                    entry.refreshed_at = time.monotonic()
+                    with self.lock:
+                        self.metrics["refreshes_cross_process"] += 1
+                    return entry.access_token
+
+                response = self.request_refresh(account_id, auth_token.refresh_token)
+                if response.status_code != 200:
+                    with self.lock:
+                        self.metrics["refresh_failures"] += 1
+                    raise HTTPException(status_code=401, detail=f"Failed to refresh token: {response.text}")
+
+                token_data = response.json()
+
+                # Cập nhật token trong database (commit trước khi nhả lock để process chờ đọc được token mới)
+                update_auth_token(
+                    db, auth_token.id,
+                    access_token=token_data['access_token'],
+                    refresh_token=token_data.get('refresh_token', auth_token.refresh_token),
+                    expires_in=token_data['expires_in'],
+                    expires_at=datetime.utcnow() + timedelta(seconds=token_data['expires_in'])
+                )
+
+            entry = self._load(db, account_id)
+            entry.refreshed_at = time.monotonic()
+            with self.lock:
+                self.metrics["refreshes"] += 1
+            return entry.access_token
+
+    def invalidate(self, account_id: int):
+        """Xóa token khỏi cache (token mới từ /auth/callback, account bị xóa)"""
+        with self.lock:
+            self.tokens.pop(account_id, None)
+
+    def get_status(self, db: Session, account_id: int) -> Optional[Dict[str, Any]]:
+        """Trạng thái token cho /status/{account_id}"""
+        entry = self.get(db, account_id)
+        if not entry:
+            return None
+        return {
+            "account": entry.account,
+            "token": {
+                "expires_at": entry.expires_at.isoformat(),
+                "expires_in": entry.expires_in,
+                "is_active": entry.is_active,
+                "refresh_ahead_at": (entry.expires_at - timedelta(seconds=TOKEN_REFRESH_AHEAD_SECONDS)).isoformat()
+            }
+        }
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.metrics, cached_accounts=len(self.tokens))
+
+    def refresh_expiring(self):
+        """Refresh trước các token trong cache sẽ hết hạn trong TOKEN_REFRESH_AHEAD_SECONDS"""
+        with self.lock:
+            expiring = [
+                account_id for account_id, entry in self.tokens.items()
+                if entry.expires_within(TOKEN_REFRESH_AHEAD_SECONDS)
+            ]
+        if not expiring:
+            return
+
+        db = next(get_db())
+        try:
+            for account_id in expiring:
+                try:
+                    self.refresh(db, account_id, TOKEN_REFRESH_AHEAD_SECONDS)
+                    with self.lock:
+                        self.metrics["refreshes_ahead"] += 1
+                except Exception as e:
+                    # Bỏ khỏi cache để không thử lại mỗi chu kỳ, lần dùng kế tiếp sẽ refresh (và báo lỗi) như bình thường
+                    print(f"❌ Failed to refresh token ahead for account {account_id}: {str(e)}")
+                    self.invalidate(account_id)
+        finally:
+            db.close()
+
+    def start(self):
+        """Start thread refresh-ahead"""
+        if self.is_running:
+            return
+        self.is_running = True
+        self.refresh_thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self.refresh_thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.refresh_thread:
+            self.refresh_thread.join()
+
+    def _refresh_loop(self):
+        last_check = 0.0
+        while self.is_running:
+            time.sleep(1)
+            if time.monotonic() - last_check >= TOKEN_CACHE_CHECK_SECONDS:
+                last_check = time.monotonic()
+                try:
+                    self.refresh_expiring()
+                except Exception as e:
+                    print(f"❌ Error in token refresh loop: {str(e)}")
+
+
+# Global instance
+token_cache = TokenCache()
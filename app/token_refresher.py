@@ -0,0 +1,162 @@
+"""
+Bulk refresh access token: refresh nhiều account song song (pool TOKEN_REFRESH_MAX_WORKERS request OAuth),
+phân loại từng kết quả (ok / invalid_grant / transient) và ghi auth_tokens theo batch.
+Dùng bởi refresh_tokens.py (CLI) và AutoSyncService trước mỗi lượt daily sync.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Dict, Any, List
+
+import requests
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from .config import TOKEN_REFRESH_MAX_WORKERS, TOKEN_REFRESH_MAX_RETRIES, TOKEN_REFRESH_DB_BATCH_SIZE, RETRYABLE_STATUS_CODES
+from .circuit_breaker import AccountCircuitBreakerService
+from .graph_scheduler import compute_retry_delay
+from .token_cache import token_cache
+from crud import get_expiring_auth_tokens, bulk_update_auth_tokens
+
+RESULT_STATUSES = ("ok", "invalid_grant", "transient", "skipped")
+
+
+def classify_token_response(response) -> str:
+    """ok / invalid_grant (phải đăng nhập lại) / transient (thử lại được)"""
+    if response.status_code == 200:
+        return "ok"
+    if response.status_code in (400, 401):
+        try:
+            error = response.json().get("error")
+        except ValueError:
+            error = None
+        if error in ("invalid_grant", "interaction_required"):
+            return "invalid_grant"
+    return "transient"
+
+
+def _refresh_one(account_id: int, refresh_token: str, expires_before: datetime) -> Dict[str, Any]:
+    """Refresh một token (chạy trong worker, không dùng database)"""
+    result = {"account_id": account_id, "attempts": 0, "status": "skipped"}
+    # Request đang refresh token của account (giữ refresh_lock, có thể đang chờ advisory lock của batch này)
+    # thì bỏ qua, request đó tự refresh sau khi batch nhả lock
+    refresh_lock = token_cache.refresh_lock(account_id)
+    if not refresh_lock.acquire(blocking=False):
+        return result
+    try:
+        with token_cache.lock:
+            cached = token_cache.tokens.get(account_id)
+        if cached and cached.expires_at >= expires_before:
+            return result
+
+        for attempt in range(TOKEN_REFRESH_MAX_RETRIES + 1):
+            result["attempts"] = attempt + 1
+            headers = None
+            try:
+                response = token_cache.request_refresh(account_id, refresh_token)
+                status = classify_token_response(response)
+                if status == "ok":
+                    result.update(status="ok", token_data=response.json())
+                    return result
+                result.update(status=status, error=f"{response.status_code}: {response.text[:500]}")
+                if status != "transient" or response.status_code not in RETRYABLE_STATUS_CODES:
+                    return result
+                headers = response.headers
+            except requests.RequestException as e:
+                result.update(status="transient", error=str(e))
+
+            if attempt < TOKEN_REFRESH_MAX_RETRIES:
+                time.sleep(compute_retry_delay(headers, attempt))
+        return result
+    finally:
+        refresh_lock.release()
+
+
+def _save_batch(db: Session, results: List[Dict[str, Any]]):
+    """Ghi các token refresh thành công vào auth_tokens (một lần commit) rồi bỏ bản cũ khỏi token cache"""
+    now = datetime.utcnow()
+    bulk_update_auth_tokens(db, [
+        {
+            "id": result["token_id"],
+            "access_token": result["token_data"]["access_token"],
+            "refresh_token": result["token_data"].get("refresh_token", result["refresh_token"]),
+            "expires_in": result["token_data"]["expires_in"],
+            "expires_at": now + timedelta(seconds=result["token_data"]["expires_in"])
+        }
+        for result in results
+    ])
+    for result in results:
+        token_cache.invalidate(result["account_id"])
+
+
+def refresh_tokens(
+    db: Session,
+    account_ids: List[int] = None,
+    within_seconds: int = 0,
+    max_workers: int = TOKEN_REFRESH_MAX_WORKERS,
+    circuit_breaker: AccountCircuitBreakerService = None
+) -> Dict[str, Any]:
+    """
+    Refresh song song các token active hết hạn trong within_seconds tới (mặc định: đã hết hạn),
+    chỉ trong account_ids nếu có, mỗi batch TOKEN_REFRESH_DB_BATCH_SIZE account giữ advisory lock tới khi ghi xong.
+    Account bị invalid_grant được ghi vào circuit breaker.
+    Trả về báo cáo tổng hợp và kết quả từng account.
+    """
+    started_at = time.monotonic()
+    expires_before = datetime.utcnow() + timedelta(seconds=within_seconds)
+    candidate_ids = [token.account_id for token in get_expiring_auth_tokens(db, expires_before, account_ids)]
+    summary: Dict[str, Any] = {"total": len(candidate_ids), **{status: 0 for status in RESULT_STATUSES}, "results": []}
+    if not candidate_ids:
+        summary["duration_seconds"] = 0.0
+        return summary
+
+    print(f"🔄 Refreshing {len(candidate_ids)} tokens ({max_workers} workers)")
+    circuit_breaker = circuit_breaker or AccountCircuitBreakerService(db)
+
+    def add_result(result: Dict[str, Any]):
+        summary[result["status"]] += 1
+        summary["results"].append({
+            key: value for key, value in result.items() if key not in ("token_data", "refresh_token", "token_id")
+        })
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(candidate_ids)))) as executor:
+        for batch_start in range(0, len(candidate_ids), TOKEN_REFRESH_DB_BATCH_SIZE):
+            batch_ids = candidate_ids[batch_start:batch_start + TOKEN_REFRESH_DB_BATCH_SIZE]
+
+            # Giữ advisory lock của cả batch tới khi token mới được ghi: process khác không refresh trùng
+            # (account đang được process khác refresh thì bỏ qua)
+            with token_cache.try_advisory_locks(batch_ids) as locked_ids:
+                # Đọc lại sau khi lấy lock: token có thể vừa được process khác refresh.
+                # Chỉ giữ các giá trị cần dùng, commit của batch làm expire các object đã load
+                db.expire_all()
+                tokens = {
+                    token.account_id: {"token_id": token.id, "refresh_token": token.refresh_token}
+                    for token in get_expiring_auth_tokens(db, expires_before, locked_ids)
+                } if locked_ids else {}
+                for account_id in batch_ids:
+                    if account_id not in tokens:
+                        add_result({"account_id": account_id, "attempts": 0, "status": "skipped"})
+
+                futures = {
+                    executor.submit(_refresh_one, account_id, token["refresh_token"], expires_before): account_id
+                    for account_id, token in tokens.items()
+                }
+                pending: List[Dict[str, Any]] = []
+                for future in as_completed(futures):
+                    account_id = futures[future]
+                    result = future.result()
+                    if result["status"] == "ok":
+                        pending.append(dict(result, **tokens[account_id]))
+                    elif result["status"] == "invalid_grant":
+                        token_cache.invalidate(account_id)
+                        circuit_breaker.record_failure(
+                            account_id, HTTPException(status_code=401, detail=f"invalid_grant: {result['error']}")
+                        )
+                    add_result(result)
+
+                _save_batch(db, pending)
+
+    summary["duration_seconds"] = round(time.monotonic() - started_at, 2)
+    print(f"✅ Token refresh: {summary['ok']} ok, {summary['invalid_grant']} invalid_grant, "
+          f"{summary['transient']} transient, {summary['skipped']} skipped in {summary['duration_seconds']}s")
+    return summary
@@ -0,0 +1,353 @@
+"""
+Change notifications (webhook) của Microsoft Graph: tạo / gia hạn subscription cho từng account
+và chỉ đồng bộ các message được báo thay đổi, thay vì chờ daily sync quét cả khoảng thời gian.
+Daily sync vẫn chạy làm fallback khi notification bị mất.
+"""
+import hashlib
+import hmac
+import json
+import queue
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+from sqlalchemy import and_
+
+from .config import (
+    WEBHOOK_NOTIFICATION_URL,
+    WEBHOOK_RESOURCE,
+    WEBHOOK_CHANGE_TYPES,
+    WEBHOOK_SUBSCRIPTION_MINUTES,
+    WEBHOOK_RENEW_BEFORE_MINUTES,
+    WEBHOOK_DEBOUNCE_SECONDS,
+    DELTA_SYNC_ENABLED
+)
+from .auth import get_valid_access_token
+from .graph_api import create_subscription, renew_subscription, delete_subscription
+from .services import EmailSyncService
+from .meta_receipt_service import MetaReceiptService
+from .circuit_breaker import AccountCircuitBreakerService
+from .sync_registry import sync_registry
+from crud import (
+    get_graph_subscription,
+    get_graph_subscription_by_id,
+    get_graph_subscriptions,
+    save_graph_subscription,
+    delete_graph_subscription
+)
+from database import get_db
+from models import Account, AuthToken, GraphSubscription
+
+RENEWAL_CHECK_INTERVAL = 3600  # Kiểm tra subscription sắp hết hạn mỗi giờ
+
+
+def _to_graph_datetime(value: datetime) -> str:
+    return value.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+
+
+def _from_graph_datetime(value: str) -> datetime:
+    return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def ensure_subscription(db: Session, account_id: int, renew: bool = False, recreate: bool = False) -> GraphSubscription:
+    """
+    Tạo subscription cho account nếu chưa có, gia hạn nếu sắp hết hạn (hoặc renew=True).
+    recreate=True: bỏ subscription cũ và tạo mới (vd: Graph báo subscriptionRemoved)
+    """
+    subscription = get_graph_subscription(db, account_id)
+    expiration = datetime.utcnow() + timedelta(minutes=WEBHOOK_SUBSCRIPTION_MINUTES)
+
+    # WEBHOOK_RESOURCE đã đổi (vd: subscription cũ chỉ trên inbox): xóa subscription cũ rồi tạo lại
+    if subscription and subscription.resource != WEBHOOK_RESOURCE:
+        print(f"🔁 Subscription resource changed for account {account_id}: {subscription.resource} → {WEBHOOK_RESOURCE}")
+        remove_subscription(db, account_id)
+        subscription = None
+
+    if subscription and not recreate:
+        remaining = subscription.expiration_date_time - datetime.utcnow()
+        if not renew and remaining > timedelta(minutes=WEBHOOK_RENEW_BEFORE_MINUTES):
+            return subscription
+
+        access_token = get_valid_access_token(db, account_id)
+        try:
+            result = renew_subscription(
+                access_token, subscription.subscription_id, _to_graph_datetime(expiration), account_id
+            )
+            print(f"🔁 Renewed subscription for account {account_id} until {result.get('expirationDateTime')}")
+            return save_graph_subscription(
+                db, account_id, expiration_date_time=_from_graph_datetime(result["expirationDateTime"])
+            )
+        except HTTPException as e:
+            if e.status_code != 404:
+                raise
+            print(f"⚠️ Subscription {subscription.subscription_id} not found, creating a new one")
+
+    access_token = get_valid_access_token(db, account_id)
+    client_state = secrets.token_urlsafe(32)
+    result = create_subscription(
+        access_token,
+        WEBHOOK_NOTIFICATION_URL,
+        WEBHOOK_RESOURCE,
+        WEBHOOK_CHANGE_TYPES,
+        client_state,
+        _to_graph_datetime(expiration),
+        account_id
+    )
+    print(f"🔔 Created subscription {result['id']} for account {account_id}")
+    return save_graph_subscription(
+        db,
+        account_id,
+        subscription_id=result["id"],
+        resource=WEBHOOK_RESOURCE,
+        client_state=client_state,
+        expiration_date_time=_from_graph_datetime(result["expirationDateTime"])
+    )
+
+
+def remove_subscription(db: Session, account_id: int) -> bool:
+    """Xóa subscription của account trên Graph và trong database"""
+    subscription = get_graph_subscription(db, account_id)
+    if not subscription:
+        return False
+
+    try:
+        access_token = get_valid_access_token(db, account_id)
+        delete_subscription(access_token, subscription.subscription_id, account_id)
+    except HTTPException as e:
+        # Token hỏng thì subscription cũng sẽ tự hết hạn, vẫn xóa trong database
+        print(f"⚠️ Failed to delete subscription on Graph for account {account_id}: {e.detail}")
+
+    delete_graph_subscription(db, account_id)
+    return True
+
+
+def subscription_to_dict(subscription: GraphSubscription) -> Dict[str, Any]:
+    return {
+        "account_id": subscription.account_id,
+        "subscription_id": subscription.subscription_id,
+        "resource": subscription.resource,
+        "expiration_date_time": subscription.expiration_date_time.isoformat(),
+        "last_notification_at": subscription.last_notification_at.isoformat() if subscription.last_notification_at else None
+    }
+
+
+class WebhookService:
+    """
+    Nhận change notifications, đưa vào hàng đợi và đồng bộ theo từng account trong background thread.
+    Endpoint webhook chỉ kiểm tra clientState rồi trả về ngay (Graph yêu cầu phản hồi trong 3 giây).
+    """
+
+    def __init__(self):
+        self.is_running = False
+        self.worker_thread = None
+        self.notifications: "queue.Queue[Tuple[int, Optional[str], str]]" = queue.Queue()
+        self.last_renewal_check = 0.0
+        self.metrics = {
+            "received": 0,
+            "rejected": 0,
+            "lifecycle_events": 0,
+            "synced_accounts": 0,
+            "synced_emails": 0
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return bool(WEBHOOK_NOTIFICATION_URL)
+
+    def start(self):
+        """Start worker xử lý notifications"""
+        if self.is_running or not self.enabled:
+            return
+
+        self.is_running = True
+        # Lần kiểm tra subscription đầu tiên chờ server nhận request (Graph gọi validationToken về webhook)
+        self.last_renewal_check = time.monotonic() - RENEWAL_CHECK_INTERVAL + 30
+        self.worker_thread = threading.Thread(target=self._worker_loop, daemon=True)
+        self.worker_thread.start()
+        print(f"Webhook service started (notification url: {WEBHOOK_NOTIFICATION_URL})")
+
+    def stop(self):
+        """Stop worker xử lý notifications"""
+        self.is_running = False
+        if self.worker_thread:
+            self.worker_thread.join()
+        print("Webhook service stopped")
+
+    def handle_notifications(self, db: Session, payload: Dict[str, Any]) -> int:
+        """
+        Kiểm tra clientState của từng notification và đưa vào hàng đợi. Trả về số notification hợp lệ
+        """
+        accepted = 0
+        subscriptions: Dict[str, Optional[GraphSubscription]] = {}
+
+        for notification in payload.get("value", []):
+            self.metrics["received"] += 1
+            subscription_id = notification.get("subscriptionId")
+            if subscription_id not in subscriptions:
+                subscriptions[subscription_id] = get_graph_subscription_by_id(db, subscription_id)
+            subscription = subscriptions[subscription_id]
+
+            if not subscription or not hmac.compare_digest(
+                subscription.client_state, notification.get("clientState") or ""
+            ):
+                self.metrics["rejected"] += 1
+                print(f"⚠️ Rejected notification for unknown subscription or bad clientState: {subscription_id}")
+                continue
+
+            lifecycle_event = notification.get("lifecycleEvent")
+            if lifecycle_event:
+                self.metrics["lifecycle_events"] += 1
+                self.notifications.put((subscription.account_id, None, lifecycle_event))
+            else:
+                message_id = (notification.get("resourceData") or {}).get("id")
+                if not message_id:
+                    continue
+                self.notifications.put((subscription.account_id, message_id, notification.get("changeType")))
+            accepted += 1
+
+        return accepted
+
+    def _worker_loop(self):
+        """Gom notifications trong WEBHOOK_DEBOUNCE_SECONDS rồi đồng bộ một lần cho mỗi account"""
+        while self.is_running:
+            try:
+                if time.monotonic() - self.last_renewal_check >= RENEWAL_CHECK_INTERVAL:
+                    self.last_renewal_check = time.monotonic()
+                    self.renew_subscriptions()
+
+                try:
+                    items = [self.notifications.get(timeout=1)]
+                except queue.Empty:
+                    continue
+
+                time.sleep(WEBHOOK_DEBOUNCE_SECONDS)
+                while True:
+                    try:
+                        items.append(self.notifications.get_nowait())
+                    except queue.Empty:
+                        break
+
+                self.process_notifications(items)
+            except Exception as e:
+                print(f"Error in webhook worker loop: {str(e)}")
+                time.sleep(5)
+
+    def process_notifications(self, items: List[Tuple[int, Optional[str], str]]):
+        """Đồng bộ các message được báo thay đổi, gom theo account"""
+        changes: Dict[int, Dict[str, str]] = {}
+        lifecycle_events: Dict[int, set] = {}
+        for account_id, message_id, change_type in items:
+            if message_id is None:
+                lifecycle_events.setdefault(account_id, set()).add(change_type)
+            else:
+                # Nhiều notification cho cùng message: giữ changeType mới nhất
+                changes.setdefault(account_id, {})[message_id] = change_type
+
+        db = next(get_db())
+        try:
+            circuit_breaker = AccountCircuitBreakerService(db)
+
+            for account_id, events in lifecycle_events.items():
+                try:
+                    self._handle_lifecycle_events(db, account_id, events)
+                except Exception as e:
+                    print(f"❌ Error handling lifecycle events {events} for account {account_id}: {str(e)}")
+
+            for account_id, account_changes in changes.items():
+                if not circuit_breaker.allow(account_id):
+                    print(f"⏭️ Skipping notifications for account {account_id} (circuit open)")
+                    continue
+
+                try:
+                    # Mỗi đợt notification là một job riêng, chỉ cần chờ job sync khác của account
+                    result = sync_registry.run(
+                        account_id, "notifications",
+                        lambda: EmailSyncService(db, account_id).sync_messages_by_ids(account_changes),
+                        hashlib.sha1(json.dumps(account_changes, sort_keys=True).encode()).hexdigest()
+                    )
+                    self.metrics["synced_accounts"] += 1
+                    self.metrics["synced_emails"] += result["total_synced"]
+                    print(f"🔔 Notification sync for account {account_id}: {len(account_changes)} changes, {result['total_synced']} new emails")
+
+                    if result["total_synced"] > 0:
+                        MetaReceiptService(db).process_account_emails(account_id)
+
+                    save_graph_subscription(db, account_id, last_notification_at=datetime.utcnow())
+                    circuit_breaker.record_success(account_id)
+                except Exception as e:
+                    print(f"❌ Error processing notifications for account {account_id}: {str(e)}")
+                    circuit_breaker.record_failure(account_id, e)
+        finally:
+            db.close()
+
+    def _handle_lifecycle_events(self, db: Session, account_id: int, events: set):
+        """
+        reauthorizationRequired: gia hạn, subscriptionRemoved: tạo lại,
+        missed: notification bị mất nên đồng bộ lại các folder như daily sync
+        """
+        print(f"🔔 Lifecycle events for account {account_id}: {sorted(events)}")
+        if "subscriptionRemoved" in events:
+            ensure_subscription(db, account_id, recreate=True)
+        elif "reauthorizationRequired" in events:
+            ensure_subscription(db, account_id, renew=True)
+
+        if "missed" in events:
+            sync_service = EmailSyncService(db, account_id)
+            if DELTA_SYNC_ENABLED:
+                result = sync_registry.run(account_id, "delta", sync_service.sync_delta_emails)
+            else:
+                result = sync_registry.run(
+                    account_id, "daily", sync_service.sync_daily_emails, datetime.utcnow().strftime('%Y-%m-%d')
+                )
+            if result["total_synced"] > 0:
+                MetaReceiptService(db).process_account_emails(account_id)
+
+    def renew_subscriptions(self) -> Dict[str, Any]:
+        """Tạo subscription cho account chưa có, gia hạn subscription sắp hết hạn"""
+        if not self.enabled:
+            return {"checked": 0, "failed": 0}
+
+        db = next(get_db())
+        checked = 0
+        failed = 0
+        try:
+            active_accounts = db.query(Account).join(AuthToken).filter(
+                and_(
+                    Account.is_active == True,
+                    AuthToken.is_active == True
+                )
+            ).all()
+            circuit_breaker = AccountCircuitBreakerService(db)
+
+            for account in active_accounts:
+                if not circuit_breaker.allow(account.id):
+                    continue
+                try:
+                    ensure_subscription(db, account.id)
+                    checked += 1
+                except Exception as e:
+                    failed += 1
+                    print(f"❌ Failed to ensure subscription for account {account.id}: {str(e)}")
+        finally:
+            db.close()
+
+        return {"checked": checked, "failed": failed}
+
+    def get_status(self, db: Session) -> Dict[str, Any]:
+        """Trạng thái webhook và danh sách subscriptions"""
+        return {
+            "enabled": self.enabled,
+            "is_running": self.is_running,
+            "notification_url": WEBHOOK_NOTIFICATION_URL,
+            "queued": self.notifications.qsize(),
+            "metrics": dict(self.metrics),
+            "subscriptions": [subscription_to_dict(s) for s in get_graph_subscriptions(db)]
+        }
+
+
+# Global instance
+webhook_service = WebhookService()
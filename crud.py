@@ -6,7 +6,19 @@ import json
 import bcrypt
 from passlib.context import CryptContext
 
-from models import Account, AuthToken, Email, EmailAttachment, User, MetaReceipt
+from models import (
+    Account,
+    AuthToken,
+    Email,
+    EmailAttachment,
+    User,
+    MetaReceipt,
+    DeltaSyncState,
+    AccountCircuitBreaker,
+    GraphSubscription,
+    GraphRequestUsage,
+    SyncJob
+)
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -176,6 +188,15 @@ def update_account(db: Session, account_id: int, **kwargs):
         db.refresh(db_account)
     return db_account
 
+def get_backfill_accounts(db: Session):
+    """Lấy các account active còn progressive initial backfill (backfill_cursor khác NULL)"""
+    return db.query(Account).filter(
+        and_(
+            Account.is_active == True,
+            Account.backfill_cursor.isnot(None)
+        )
+    ).all()
+
 # AuthToken CRUD operations
 def create_auth_token(
     db: Session, 
@@ -249,6 +270,27 @@ def deactivate_auth_token(db: Session, account_id: int):
     ).update({"is_active": False, "updated_at": datetime.utcnow()})
     db.commit()
 
+def get_expiring_auth_tokens(db: Session, expires_before: datetime, account_ids: List[int] = None):
+    """Các token active (của account active) hết hạn trước expires_before"""
+    query = db.query(AuthToken).join(Account, Account.id == AuthToken.account_id).filter(
+        and_(
+            Account.is_active == True,
+            AuthToken.is_active == True,
+            AuthToken.expires_at < expires_before
+        )
+    )
+    if account_ids is not None:
+        query = query.filter(AuthToken.account_id.in_(account_ids))
+    return query.order_by(AuthToken.expires_at).all()
+
+def bulk_update_auth_tokens(db: Session, tokens_data: List[dict]):
+    """Cập nhật nhiều token cùng lúc (một lần commit), mỗi dict có id và các trường cần cập nhật"""
+    if not tokens_data:
+        return
+    now = datetime.utcnow()
+    db.bulk_update_mappings(AuthToken, [dict(token_data, updated_at=now) for token_data in tokens_data])
+    db.commit()
+
 # Email CRUD operations
 def create_email(db: Session, account_id: int, email_data: dict):
     """Tạo email mới hoặc cập nhật email cũ"""
@@ -261,43 +303,56 @@ def create_email(db: Session, account_id: int, email_data: dict):
     ).first()
     
     if existing_email:
+        # changeKey không đổi: message không thay đổi, không cần ghi lại
+        if existing_email.change_key and existing_email.change_key == email_data.get("changeKey"):
+            return existing_email
         # Cập nhật email cũ
-        for key, value in email_data.items():
-            if hasattr(existing_email, key) and key != "id":
-                setattr(existing_email, key, value)
-        existing_email.updated_at = datetime.utcnow()
-        db.commit()
-        db.refresh(existing_email)
-        return existing_email
+        return update_email_from_graph(db, existing_email, email_data)
     else:
         # Tạo email mới
-        db_email = Email(
-            account_id=account_id,
-            message_id=email_data.get("id"),
-            subject=email_data.get("subject"),
-            from_email=email_data.get("from", {}).get("emailAddress", {}).get("address"),
-            from_name=email_data.get("from", {}).get("emailAddress", {}).get("name"),
-            to_recipients=email_data.get("toRecipients"),
-            cc_recipients=email_data.get("ccRecipients"),
-            bcc_recipients=email_data.get("bccRecipients"),
-            received_date_time=datetime.fromisoformat(email_data.get("receivedDateTime").replace("Z", "+00:00")) if email_data.get("receivedDateTime") else None,
-            sent_date_time=datetime.fromisoformat(email_data.get("sentDateTime").replace("Z", "+00:00")) if email_data.get("sentDateTime") else None,
-            is_read=email_data.get("isRead", False),
-            has_attachments=email_data.get("hasAttachments", False),
-            body=email_data.get("body", {}).get("content") if email_data.get("body") else None,
-            body_preview=email_data.get("bodyPreview"),
-            importance=email_data.get("importance"),
-            conversation_id=email_data.get("conversationId"),
-            conversation_index=email_data.get("conversationIndex"),
-            flag_status=email_data.get("flag", {}).get("flagStatus") if email_data.get("flag") else None,
-            categories=email_data.get("categories"),
-            attachments=email_data.get("attachments")
-        )
+        db_email = build_email_from_graph(account_id, email_data)
         db.add(db_email)
+        add_attachments_from_graph(db, [db_email])
         db.commit()
         db.refresh(db_email)
         return db_email
 
+def build_email_from_graph(account_id: int, email_data: dict) -> Email:
+    """Tạo object Email (chưa add vào session) từ dữ liệu Graph"""
+    return Email(
+        account_id=account_id,
+        message_id=email_data.get("id"),
+        change_key=email_data.get("changeKey"),
+        subject=email_data.get("subject"),
+        from_email=email_data.get("from", {}).get("emailAddress", {}).get("address"),
+        from_name=email_data.get("from", {}).get("emailAddress", {}).get("name"),
+        to_recipients=email_data.get("toRecipients"),
+        cc_recipients=email_data.get("ccRecipients"),
+        bcc_recipients=email_data.get("bccRecipients"),
+        received_date_time=datetime.fromisoformat(email_data.get("receivedDateTime").replace("Z", "+00:00")) if email_data.get("receivedDateTime") else None,
+        sent_date_time=datetime.fromisoformat(email_data.get("sentDateTime").replace("Z", "+00:00")) if email_data.get("sentDateTime") else None,
+        is_read=email_data.get("isRead", False),
+        has_attachments=email_data.get("hasAttachments", False),
+        body=email_data.get("body", {}).get("content") if email_data.get("body") else None,
+        body_preview=email_data.get("bodyPreview"),
+        importance=email_data.get("importance"),
+        conversation_id=email_data.get("conversationId"),
+        conversation_index=email_data.get("conversationIndex"),
+        flag_status=email_data.get("flag", {}).get("flagStatus") if email_data.get("flag") else None,
+        categories=email_data.get("categories"),
+        attachments=email_data.get("attachments")
+    )
+
+def bulk_create_emails(db: Session, account_id: int, emails_data: List[dict]):
+    """Tạo nhiều email cùng lúc (một lần commit)"""
+    emails = [build_email_from_graph(account_id, email_data) for email_data in emails_data]
+    
+    db.add_all(emails)
+    add_attachments_from_graph(db, emails)
+    db.commit()
+    
+    return emails
+
 def get_emails(
     db: Session, 
     account_id: int, 
@@ -322,6 +377,23 @@ def get_emails(
     
     return query.order_by(Email.received_date_time.desc()).offset(skip).limit(limit).all()
 
+def get_emails_without_meta_receipt(
+    db: Session,
+    account_id: int,
+    received_from: datetime = None,
+    received_to: datetime = None
+):
+    """Email trong khoảng [received_from, received_to) chưa có meta receipt, mới nhất trước"""
+    query = db.query(Email).filter(
+        Email.account_id == account_id,
+        ~db.query(MetaReceipt.id).filter(MetaReceipt.email_id == Email.id).exists()
+    )
+    if received_from:
+        query = query.filter(Email.received_date_time >= received_from)
+    if received_to:
+        query = query.filter(Email.received_date_time < received_to)
+    return query.order_by(Email.received_date_time.desc()).all()
+
 def get_email_by_message_id(db: Session, account_id: int, message_id: str):
     """Lấy email theo message_id"""
     return db.query(Email).filter(
@@ -355,6 +427,154 @@ def update_email_read_status(db: Session, email_id: int, is_read: bool):
         db.refresh(db_email)
     return db_email
 
+def get_email_change_keys(db: Session, account_id: int, message_ids: List[str]) -> dict:
+    """Lấy changeKey của các email đã có trong database (một query), trả về dict message_id -> change_key"""
+    if not message_ids:
+        return {}
+    return {
+        message_id: change_key for message_id, change_key in db.query(Email.message_id, Email.change_key).filter(
+            and_(
+                Email.account_id == account_id,
+                Email.message_id.in_(message_ids)
+            )
+        ).all()
+    }
+
+def is_email_changed(change_keys: dict, email_data: dict) -> bool:
+    """Email đã có trong database nhưng changeKey khác (hoặc chưa lưu changeKey) thì cần ghi lại"""
+    stored_change_key = change_keys.get(email_data.get("id"))
+    return not stored_change_key or stored_change_key != email_data.get("changeKey")
+
+def _apply_graph_fields(db_email: Email, email_data: dict):
+    """Gán các trường có thể thay đổi từ dữ liệu Graph vào Email (chưa commit)"""
+    if "changeKey" in email_data:
+        db_email.change_key = email_data.get("changeKey")
+    if "subject" in email_data:
+        db_email.subject = email_data.get("subject")
+    if "isRead" in email_data:
+        db_email.is_read = email_data.get("isRead", False)
+    if "importance" in email_data:
+        db_email.importance = email_data.get("importance")
+    if "categories" in email_data:
+        db_email.categories = email_data.get("categories")
+    if "flag" in email_data:
+        db_email.flag_status = email_data.get("flag", {}).get("flagStatus") if email_data.get("flag") else None
+    if email_data.get("body"):
+        db_email.body = email_data.get("body", {}).get("content")
+    if "bodyPreview" in email_data:
+        db_email.body_preview = email_data.get("bodyPreview")
+    if "attachments" in email_data:
+        db_email.attachments = email_data.get("attachments")
+    db_email.removed_at = None
+    db_email.updated_at = datetime.utcnow()
+
+def update_email_from_graph(db: Session, db_email: Email, email_data: dict):
+    """Cập nhật các trường có thể thay đổi của email từ dữ liệu Graph (delta query)"""
+    _apply_graph_fields(db_email, email_data)
+    add_attachments_from_graph(db, [db_email], prune=True)
+    db.commit()
+    db.refresh(db_email)
+    return db_email
+
+def bulk_update_emails_from_graph(db: Session, account_id: int, emails_data: List[dict]):
+    """Cập nhật nhiều email đã có cùng lúc (một query + một lần commit)"""
+    if not emails_data:
+        return []
+    
+    data_by_id = {email_data.get("id"): email_data for email_data in emails_data}
+    emails = db.query(Email).filter(
+        and_(
+            Email.account_id == account_id,
+            Email.message_id.in_(list(data_by_id.keys()))
+        )
+    ).all()
+    
+    for db_email in emails:
+        _apply_graph_fields(db_email, data_by_id[db_email.message_id])
+    add_attachments_from_graph(db, emails, prune=True)
+    db.commit()
+    
+    return emails
+
+def mark_emails_removed(db: Session, account_id: int, message_ids: List[str]) -> int:
+    """
+    Đánh dấu email bị @removed (xóa hoặc chuyển ra khỏi folder đang delta): chỉ ghi removed_at,
+    email, meta receipts và attachments được giữ lại. Trả về số email được đánh dấu
+    """
+    if not message_ids:
+        return 0
+    count = db.query(Email).filter(
+        and_(
+            Email.account_id == account_id,
+            Email.message_id.in_(message_ids),
+            Email.removed_at.is_(None)
+        )
+    ).update({"removed_at": datetime.utcnow()}, synchronize_session=False)
+    db.commit()
+    return count
+
+def restore_removed_emails(db: Session, account_id: int, message_ids: List[str]) -> int:
+    """Email đã đánh dấu removed xuất hiện lại (vd: được chuyển sang folder khác đang sync): bỏ removed_at"""
+    if not message_ids:
+        return 0
+    count = db.query(Email).filter(
+        and_(
+            Email.account_id == account_id,
+            Email.message_id.in_(message_ids),
+            Email.removed_at.isnot(None)
+        )
+    ).update({"removed_at": None}, synchronize_session=False)
+    if count:
+        db.commit()
+    return count
+
+def get_account_message_ids(db: Session, account_id: int) -> List[str]:
+    """Lấy tất cả message_id đã lưu của account"""
+    return [row[0] for row in db.query(Email.message_id).filter(Email.account_id == account_id).all()]
+
+def update_email_message_ids(db: Session, account_id: int, id_map: dict) -> dict:
+    """
+    Đổi message_id của emails (và meta receipts) theo id_map {message_id cũ: message_id mới}.
+    Email có ID mới đã tồn tại là bản trùng (email bị chuyển folder rồi sync lại): xóa bản cũ.
+    """
+    id_map = {source: target for source, target in id_map.items() if target and source != target}
+    if not id_map:
+        return {"updated": 0, "duplicates_removed": 0}
+    
+    emails = db.query(Email).filter(
+        and_(
+            Email.account_id == account_id,
+            Email.message_id.in_(list(id_map.keys()))
+        )
+    ).all()
+    existing_targets = {
+        row[0] for row in db.query(Email.message_id).filter(
+            Email.message_id.in_(list(id_map.values()))
+        ).all()
+    }
+    
+    updated = 0
+    duplicates = []
+    for db_email in emails:
+        target = id_map[db_email.message_id]
+        if target in existing_targets:
+            duplicates.append(db_email)
+            continue
+        db.query(MetaReceipt).filter(MetaReceipt.email_id == db_email.id).update(
+            {"message_id": target}, synchronize_session=False
+        )
+        db_email.message_id = target
+        existing_targets.add(target)
+        updated += 1
+    
+    for db_email in duplicates:
+        db.query(MetaReceipt).filter(MetaReceipt.email_id == db_email.id).delete(synchronize_session=False)
+        db.query(EmailAttachment).filter(EmailAttachment.email_id == db_email.id).delete(synchronize_session=False)
+        db.delete(db_email)
+    
+    db.commit()
+    return {"updated": updated, "duplicates_removed": len(duplicates)}
+
 # EmailAttachment CRUD operations
 def create_email_attachment(db: Session, email_id: int, attachment_data: dict):
     """Tạo attachment mới"""
@@ -379,6 +599,84 @@ def get_email_attachments(db: Session, email_id: int):
     """Lấy danh sách attachment của email"""
     return db.query(EmailAttachment).filter(EmailAttachment.email_id == email_id).all()
 
+def add_attachments_from_graph(db: Session, emails: List[Email], prune: bool = False):
+    """
+    Ghi metadata attachments (lấy kèm email qua $expand, nằm trong Email.attachments) vào email_attachments.
+    Một query kiểm tra attachment đã có, chưa commit.
+    prune (cập nhật email đã có): xóa các dòng có attachment_id không còn trong danh sách expand.
+    """
+    if prune:
+        db.flush()
+        for email in emails:
+            if email.attachments is None:
+                continue
+            attachment_ids = [attachment_data.get("id") for attachment_data in email.attachments]
+            db.query(EmailAttachment).filter(
+                EmailAttachment.email_id == email.id,
+                EmailAttachment.attachment_id.notin_(attachment_ids)
+            ).delete(synchronize_session=False)
+    
+    emails = [email for email in emails if email.attachments]
+    if not emails:
+        return
+    
+    db.flush()
+    existing = set(
+        db.query(EmailAttachment.email_id, EmailAttachment.attachment_id).filter(
+            EmailAttachment.email_id.in_([email.id for email in emails])
+        ).all()
+    )
+    for email in emails:
+        for attachment_data in email.attachments:
+            if (email.id, attachment_data.get("id")) in existing:
+                continue
+            db.add(EmailAttachment(
+                email_id=email.id,
+                attachment_id=attachment_data.get("id"),
+                name=attachment_data.get("name"),
+                content_type=attachment_data.get("contentType"),
+                size=attachment_data.get("size"),
+                is_inline=attachment_data.get("isInline", False)
+            ))
+
+def save_attachments_metadata(db: Session, db_email: Email, attachments_data: List[dict]):
+    """Lưu metadata attachments lấy trực tiếp từ Graph (khi email chưa có dữ liệu từ lúc sync)"""
+    db_email.attachments = attachments_data
+    add_attachments_from_graph(db, [db_email], prune=True)
+    db.commit()
+    return get_email_attachments(db, db_email.id)
+
+def get_email_attachment(db: Session, email_id: int, attachment_id: str):
+    """Lấy một attachment theo attachment_id của Graph"""
+    return db.query(EmailAttachment).filter(
+        and_(
+            EmailAttachment.email_id == email_id,
+            EmailAttachment.attachment_id == attachment_id
+        )
+    ).first()
+
+def save_email_attachment(db: Session, email_id: int, attachment_data: dict, file_path: str = None, content_hash: str = None):
+    """Tạo mới hoặc cập nhật attachment, nội dung nằm trong attachment store (không lưu content_bytes)"""
+    db_attachment = get_email_attachment(db, email_id, attachment_data.get("id"))
+    if not db_attachment:
+        db_attachment = EmailAttachment(email_id=email_id, attachment_id=attachment_data.get("id"))
+        db.add(db_attachment)
+    
+    db_attachment.name = attachment_data.get("name")
+    db_attachment.content_type = attachment_data.get("contentType")
+    db_attachment.size = attachment_data.get("size")
+    db_attachment.is_inline = attachment_data.get("isInline", False)
+    db_attachment.content_id = attachment_data.get("contentId")
+    db_attachment.content_location = attachment_data.get("contentLocation")
+    if file_path:
+        db_attachment.file_path = file_path
+        db_attachment.content_hash = content_hash
+        db_attachment.content_bytes = None
+    
+    db.commit()
+    db.refresh(db_attachment)
+    return db_attachment
+
 # Utility functions
 def save_user_and_token_to_db(db: Session, email: str, name: str, access_token: str, refresh_token: str, expires_in: int, user_info: dict = None, user_id: int = None):
     """Lưu user và token vào database"""
@@ -558,4 +856,200 @@ def get_meta_receipts_count(
     if status:
         query = query.filter(MetaReceipt.status == status)
     
-    return query.count() 
\ No newline at end of file
+    return query.count()
+
+# DeltaSyncState CRUD operations
+def get_delta_sync_state(db: Session, account_id: int, folder_id: str = "inbox"):
+    """Lấy trạng thái delta sync (deltaLink) của account theo folder"""
+    return db.query(DeltaSyncState).filter(
+        and_(
+            DeltaSyncState.account_id == account_id,
+            DeltaSyncState.folder_id == folder_id
+        )
+    ).first()
+
+def save_delta_link(db: Session, account_id: int, delta_link: str, folder_id: str = "inbox"):
+    """Tạo mới hoặc cập nhật deltaLink của account theo folder"""
+    state = get_delta_sync_state(db, account_id, folder_id)
+    if state:
+        state.delta_link = delta_link
+        state.last_synced_at = datetime.utcnow()
+        state.updated_at = datetime.utcnow()
+    else:
+        state = DeltaSyncState(
+            account_id=account_id,
+            folder_id=folder_id,
+            delta_link=delta_link,
+            last_synced_at=datetime.utcnow()
+        )
+        db.add(state)
+    db.commit()
+    db.refresh(state)
+    return state
+
+def delete_delta_sync_state(db: Session, account_id: int, folder_id: str = "inbox"):
+    """Xóa deltaLink (dùng khi deltaLink hết hạn, lần sync sau sẽ bắt đầu lại)"""
+    db.query(DeltaSyncState).filter(
+        and_(
+            DeltaSyncState.account_id == account_id,
+            DeltaSyncState.folder_id == folder_id
+        )
+    ).delete(synchronize_session=False)
+    db.commit()
+
+def delete_account_delta_sync_states(db: Session, account_id: int):
+    """Xóa deltaLink của mọi folder của account (vd: sau khi chuyển sang immutable ID)"""
+    db.query(DeltaSyncState).filter(DeltaSyncState.account_id == account_id).delete(synchronize_session=False)
+    db.commit()
+
+# AccountCircuitBreaker CRUD operations
+def get_circuit_breaker(db: Session, account_id: int):
+    """Lấy circuit breaker của account"""
+    return db.query(AccountCircuitBreaker).filter(AccountCircuitBreaker.account_id == account_id).first()
+
+def get_tripped_circuit_breakers(db: Session):
+    """Lấy tất cả circuit breaker đang open hoặc half-open"""
+    return db.query(AccountCircuitBreaker).filter(
+        AccountCircuitBreaker.state.in_(["open", "half_open"])
+    ).all()
+
+def get_failing_account_ids(db: Session):
+    """account_id của các circuit breaker đang closed nhưng còn lỗi liên tiếp (failure_count > 0)"""
+    return [
+        account_id for (account_id,) in db.query(AccountCircuitBreaker.account_id).filter(
+            and_(
+                AccountCircuitBreaker.state == "closed",
+                AccountCircuitBreaker.failure_count > 0
+            )
+        ).all()
+    ]
+
+def save_circuit_breaker(db: Session, account_id: int, **kwargs):
+    """Tạo mới hoặc cập nhật circuit breaker của account"""
+    breaker = get_circuit_breaker(db, account_id)
+    if not breaker:
+        breaker = AccountCircuitBreaker(account_id=account_id)
+        db.add(breaker)
+    
+    for key, value in kwargs.items():
+        if hasattr(breaker, key):
+            setattr(breaker, key, value)
+    
+    breaker.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(breaker)
+    return breaker
+
+def reset_circuit_breaker(db: Session, account_id: int):
+    """Đóng circuit breaker của account (vd: sau khi user đăng nhập lại)"""
+    db.query(AccountCircuitBreaker).filter(
+        AccountCircuitBreaker.account_id == account_id
+    ).update({
+        "state": "closed",
+        "failure_count": 0,
+        "open_count": 0,
+        "next_probe_at": None,
+        "updated_at": datetime.utcnow()
+    })
+    db.commit()
+
+# GraphSubscription CRUD operations
+def get_graph_subscription(db: Session, account_id: int):
+    """Lấy webhook subscription của account"""
+    return db.query(GraphSubscription).filter(GraphSubscription.account_id == account_id).first()
+
+def get_graph_subscription_by_id(db: Session, subscription_id: str):
+    """Lấy webhook subscription theo ID subscription của Graph"""
+    return db.query(GraphSubscription).filter(GraphSubscription.subscription_id == subscription_id).first()
+
+def get_graph_subscriptions(db: Session):
+    """Lấy tất cả webhook subscriptions"""
+    return db.query(GraphSubscription).all()
+
+def save_graph_subscription(db: Session, account_id: int, **kwargs):
+    """Tạo mới hoặc cập nhật webhook subscription của account"""
+    subscription = get_graph_subscription(db, account_id)
+    if not subscription:
+        subscription = GraphSubscription(account_id=account_id)
+        db.add(subscription)
+    
+    for key, value in kwargs.items():
+        if hasattr(subscription, key):
+            setattr(subscription, key, value)
+    
+    subscription.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(subscription)
+    return subscription
+
+def delete_graph_subscription(db: Session, account_id: int):
+    """Xóa webhook subscription của account"""
+    db.query(GraphSubscription).filter(
+        GraphSubscription.account_id == account_id
+    ).delete(synchronize_session=False)
+    db.commit()
+
+# GraphRequestUsage CRUD operations
+def add_graph_request_usage(db: Session, usage: dict):
+    """
+    Cộng dồn số liệu request vào bảng graph_request_usage.
+    usage: {(account_id, bucket_start): {"requests": .., "cost": .., "throttled": .., "token_requests": ..}}
+    """
+    for (account_id, bucket_start), counters in usage.items():
+        row = db.query(GraphRequestUsage).filter(
+            and_(
+                GraphRequestUsage.account_id == account_id,
+                GraphRequestUsage.bucket_start == bucket_start
+            )
+        ).first()
+        if not row:
+            row = GraphRequestUsage(
+                account_id=account_id,
+                bucket_start=bucket_start,
+                requests=0,
+                cost=0,
+                throttled=0,
+                token_requests=0
+            )
+            db.add(row)
+        
+        for key, value in counters.items():
+            setattr(row, key, (getattr(row, key) or 0) + value)
+        row.updated_at = datetime.utcnow()
+    
+    db.commit()
+
+def get_graph_request_usage(db: Session, since: datetime, account_id: Optional[int] = None):
+    """Lấy số liệu request từ thời điểm since, có thể lọc theo account"""
+    query = db.query(GraphRequestUsage).filter(GraphRequestUsage.bucket_start >= since)
+    if account_id is not None:
+        query = query.filter(GraphRequestUsage.account_id == account_id)
+    return query.order_by(GraphRequestUsage.bucket_start, GraphRequestUsage.account_id).all()
+
+# SyncJob CRUD operations
+def get_sync_job(db: Session, job_key: str):
+    """Lấy job sync theo key"""
+    return db.query(SyncJob).filter(SyncJob.job_key == job_key).first()
+
+def get_sync_jobs(db: Session, account_id: Optional[int] = None, limit: int = 100):
+    """Lấy các job sync gần nhất, có thể lọc theo account"""
+    query = db.query(SyncJob)
+    if account_id is not None:
+        query = query.filter(SyncJob.account_id == account_id)
+    return query.order_by(SyncJob.updated_at.desc()).limit(limit).all()
+
+def save_sync_job(db: Session, account_id: int, job_key: str, **kwargs):
+    """Tạo mới hoặc cập nhật job sync"""
+    job = get_sync_job(db, job_key)
+    if not job:
+        job = SyncJob(account_id=account_id, job_key=job_key)
+        db.add(job)
+    
+    for key, value in kwargs.items():
+        if hasattr(job, key):
+            setattr(job, key, value)
+    
+    job.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(job)
+    return job
@@ -58,11 +58,30 @@ def get_db():
     finally:
         db.close()
 
+# Các cột được thêm vào bảng đã có (create_all không thêm cột cho bảng đã tồn tại)
+ADDED_COLUMNS = [
+    ("emails", "change_key", "VARCHAR(255)"),
+    ("email_attachments", "content_hash", "VARCHAR(64)"),
+    # Account đã có trước khi dùng immutable ID giữ FALSE cho tới khi chạy migrate_message_ids_to_immutable.py
+    ("accounts", "uses_immutable_ids", "BOOLEAN DEFAULT FALSE"),
+    ("emails", "removed_at", "TIMESTAMP"),
+    ("accounts", "backfill_cursor", "TIMESTAMP"),
+    ("accounts", "backfill_stop_at", "TIMESTAMP"),
+]
+
 def create_tables():
     """Tạo tất cả bảng trong database"""
     # Import models để đảm bảo chúng được đăng ký với Base
     import models
     Base.metadata.create_all(bind=engine)
+    migrate_tables()
+
+def migrate_tables():
+    """Thêm các cột mới (ADDED_COLUMNS) vào bảng đã tồn tại"""
+    from sqlalchemy import text
+    with engine.begin() as connection:
+        for table, column, column_type in ADDED_COLUMNS:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {column_type}"))
 
 def drop_tables():
     """Xóa tất cả bảng trong database"""
@@ -9,6 +9,10 @@ from database import create_tables, engine
 from app.routes import router
 
 from app.auto_sync_service import auto_sync_service
+from app.webhook_service import webhook_service
+from app.request_budget import request_budget
+from app.token_cache import token_cache
+from app.http_client import close_http_session
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -25,6 +29,18 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"Failed to start auto sync service: {str(e)}")
     
+    # Ghi số liệu Graph requests định kỳ vào database
+    request_budget.start()
+    
+    # Refresh access token trước khi hết hạn
+    token_cache.start()
+    
+    try:
+        # Webhook chỉ chạy khi có WEBHOOK_NOTIFICATION_URL
+        webhook_service.start()
+    except Exception as e:
+        print(f"Failed to start webhook service: {str(e)}")
+    
     yield
     
     # Shutdown
@@ -33,6 +49,15 @@ async def lifespan(app: FastAPI):
         print("Auto sync service stopped on shutdown")
     except Exception as e:
         print(f"Failed to stop auto sync service: {str(e)}")
+    
+    try:
+        webhook_service.stop()
+    except Exception as e:
+        print(f"Failed to stop webhook service: {str(e)}")
+    
+    token_cache.stop()
+    request_budget.stop()
+    close_http_session()
 
 
 # Tạo FastAPI app với lifespan
@@ -0,0 +1,32 @@
+"""
+Script để chuyển các attachment còn lưu base64 (content_bytes) trong database sang attachment store
+"""
+import sys
+import os
+
+# Thêm thư mục hiện tại vào path để import các module
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from database import SessionLocal, create_tables
+from app.attachment_store import migrate_base64_attachments
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Chuyển attachments base64 sang attachment store')
+    parser.add_argument('--batch-size', type=int, default=100, help='Kích thước batch (mặc định: 100)')
+    
+    args = parser.parse_args()
+    
+    # Đảm bảo cột content_hash đã tồn tại
+    create_tables()
+    
+    db = SessionLocal()
+    try:
+        print("🔄 Bắt đầu chuyển attachments sang store...")
+        migrated = migrate_base64_attachments(db, args.batch_size)
+        print(f"\n✅ Đã chuyển {migrated} attachments")
+    except Exception as e:
+        print(f"\n❌ Lỗi: {e}")
+    finally:
+        db.close()
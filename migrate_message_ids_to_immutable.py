@@ -0,0 +1,46 @@
+"""
+Script để chuyển message_id đã lưu sang immutable ID (translateExchangeIds) cho các account chưa migrate
+"""
+import sys
+import os
+
+# Thêm thư mục hiện tại vào path để import các module
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from database import SessionLocal, create_tables
+from models import Account
+from crud import get_graph_subscription
+from app.services import EmailSyncService
+from app.webhook_service import webhook_service, ensure_subscription
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Chuyển message_id sang immutable ID')
+    parser.add_argument('--account-id', type=int, help='Chỉ migrate một account (mặc định: tất cả account chưa migrate)')
+
+    args = parser.parse_args()
+
+    # Đảm bảo cột uses_immutable_ids đã tồn tại
+    create_tables()
+
+    db = SessionLocal()
+    try:
+        query = db.query(Account).filter(Account.is_active == True)
+        if args.account_id:
+            query = query.filter(Account.id == args.account_id)
+        else:
+            query = query.filter(Account.uses_immutable_ids == False)
+        accounts = query.all()
+
+        print(f"🔄 Bắt đầu migrate {len(accounts)} accounts sang immutable ID...")
+        for account in accounts:
+            try:
+                result = EmailSyncService(db, account.id).migrate_to_immutable_ids()
+                if webhook_service.enabled and get_graph_subscription(db, account.id):
+                    ensure_subscription(db, account.id, recreate=True)
+                print(f"✅ {account.email}: {result}")
+            except Exception as e:
+                print(f"❌ {account.email}: {e}")
+    finally:
+        db.close()
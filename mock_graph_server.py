@@ -0,0 +1,1177 @@
+#!/usr/bin/env python3
+"""
+Microsoft Graph stand-in server chạy local, dùng cho load test và benchmark sync mà không cần gọi Graph thật.
+
+Hỗ trợ các endpoint project đang dùng:
+- OAuth: /{tenant}/oauth2/v2.0/authorize, /{tenant}/oauth2/v2.0/token
+- Graph: /v1.0/me, /v1.0/me/messages ($filter, $top, $select, $skip, nextLink), /v1.0/me/messages/{id},
+  /v1.0/me/messages/{id}/attachments, /v1.0/me/mailFolders (+ /{folder}, /childFolders, /messages),
+  /v1.0/me/mailFolders/{folder}/messages/delta, /v1.0/$batch,
+  /v1.0/subscriptions (validation handshake, notification khi email được thêm / sửa / xóa qua /_control),
+  /v1.0/me/translateExchangeIds
+- Message ID: mặc định trả REST ID ("<immutable id>~<số lần chuyển folder>", đổi sau mỗi lần
+  /_control/.../move), Prefer: IdType="ImmutableId" trả ID không đổi. Request nhận cả hai loại ID.
+
+Mailbox: tự sinh Meta receipts từ index.html (mỗi user một mailbox, sinh khi được gọi lần đầu),
+phân vào Inbox, Junk Email và folder "Meta receipts" (con của Inbox, giả lập inbox rule),
+hoặc load từ file JSON (--mailbox), hoặc replay các response đã ghi từ Graph thật (--record / --replay).
+Fault injection: latency, 429 (có Retry-After) và 5xx theo tỉ lệ, chỉnh được lúc chạy qua /_control/faults.
+
+Chạy:
+    python mock_graph_server.py --port 8765 --messages 2000 --latency-ms 30 --throttle-rate 0.05
+
+Trỏ app vào server:
+    GRAPH_API_BASE=http://localhost:8765/v1.0 \\
+    AUTHORITY=http://localhost:8765/consumers \\
+    LOGIN_AUTHORITY=http://localhost:8765/common \\
+    uvicorn main:app
+
+Access token có dạng "mock-access-<user>", refresh token "mock-refresh-<user>"
+(refresh token chứa "revoked" sẽ bị trả về invalid_grant).
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import html
+import json
+import os
+import random
+import re
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit, parse_qsl, quote
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, RedirectResponse, Response
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.html")
+META_SENDER = {"name": "Meta ads", "address": "advertise-noreply@support.facebook.com"}
+META_SUBJECT = "Your Meta ads receipt"
+NOISE_SENDERS = [
+    {"name": "Newsletter", "address": "news@example.com"},
+    {"name": "Team", "address": "team@example.com"},
+    {"name": "Billing", "address": "billing@example.com"}
+]
+NOISE_SUBJECTS = ["Weekly digest", "Meeting notes", "Your invoice", "Security alert"]
+DEFAULT_PAGE_SIZE = 10  # Giống Graph khi không có $top / odata.maxpagesize
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_REQUESTS = 20
+RECORD_BASE_PLACEHOLDER = "{{GRAPH_BASE}}"
+ROOT_FOLDER_ID = "AQMkADAwATMwMAItRoot"
+# (id, well-known name, displayName, parent): cây folder giống nhau cho mọi mailbox
+MAIL_FOLDERS = [
+    ("AQMkADAwATMwMAItInbox", "inbox", "Inbox", ROOT_FOLDER_ID),
+    ("AQMkADAwATMwMAItJunk", "junkemail", "Junk Email", ROOT_FOLDER_ID),
+    ("AQMkADAwATMwMAItSent", "sentitems", "Sent Items", ROOT_FOLDER_ID),
+    ("AQMkADAwATMwMAItDeleted", "deleteditems", "Deleted Items", ROOT_FOLDER_ID),
+    ("AQMkADAwATMwMAItDrafts", "drafts", "Drafts", ROOT_FOLDER_ID),
+    ("AQMkADAwATMwMAItReceipts", None, "Meta receipts", "AQMkADAwATMwMAItInbox")
+]
+FOLDER_IDS = {name: folder_id for folder_id, name, _, _ in MAIL_FOLDERS if name}
+# Tỉ lệ (%) Meta receipt bị rule chuyển vào folder riêng / bị đưa vào Junk, email thường nằm trong Inbox
+RECEIPT_FOLDER_PERCENT = 15
+JUNK_FOLDER_PERCENT = 10
+
+
+# ---------------------------------------------------------------------------
+# Fault injection
+# ---------------------------------------------------------------------------
+
+class FaultConfig:
+    """Cấu hình fault injection, đổi được lúc chạy qua POST /_control/faults"""
+
+    FIELDS = ("latency_ms", "jitter_ms", "throttle_rate", "error_rate", "retry_after")
+
+    def __init__(self, latency_ms=0, jitter_ms=0, throttle_rate=0.0, error_rate=0.0, retry_after=1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random()
+
+    def update(self, values: Dict[str, Any]):
+        for key in self.FIELDS:
+            if key in values:
+                setattr(self, key, type(getattr(self, key))(values[key]))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in self.FIELDS}
+
+    def delay(self) -> float:
+        """Số giây latency cho một request"""
+        if not self.latency_ms and not self.jitter_ms:
+            return 0.0
+        return max(0.0, self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+    def pick_fault(self) -> Optional[Tuple[int, Dict[str, Any], Dict[str, str]]]:
+        """Trả về (status, body, headers) nếu request này bị inject lỗi"""
+        roll = self.rng.random()
+        if roll < self.throttle_rate:
+            return 429, graph_error("TooManyRequests", "Application is over its MailboxConcurrency limit."), {
+                "Retry-After": str(self.retry_after)
+            }
+        if roll < self.throttle_rate + self.error_rate:
+            status = self.rng.choice([500, 502, 503, 504])
+            headers = {"Retry-After": str(self.retry_after)} if status == 503 else {}
+            return status, graph_error("ServiceUnavailable", "Injected server error."), headers
+        return None
+
+
+class Stats:
+    """Đếm request theo endpoint và số lỗi đã inject"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests: Dict[str, int] = {}
+        self.faults: Dict[str, int] = {}
+        self.started_at = datetime.utcnow()
+
+    def record(self, endpoint: str, fault_status: Optional[int] = None):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            if fault_status:
+                self.faults[str(fault_status)] = self.faults.get(str(fault_status), 0) + 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "since": self.started_at.isoformat() + "Z",
+                "total_requests": sum(self.requests.values()),
+                "requests": dict(self.requests),
+                "injected_faults": dict(self.faults)
+            }
+
+
+def graph_error(code: str, message: str) -> Dict[str, Any]:
+    return {"error": {"code": code, "message": message}}
+
+
+# ---------------------------------------------------------------------------
+# Mailbox
+# ---------------------------------------------------------------------------
+
+def html_to_text(body_html: str) -> str:
+    """Chuyển body HTML thành plain text (giả lập Prefer: outlook.body-content-type="text")"""
+    text = re.sub(r'(?is)<(style|script|head)\b.*?</\1>', '', body_html)
+    text = re.sub(r'(?i)<br\s*/?>|</(div|p|tr|td|table|h\d)>', '\n', text)
+    text = re.sub(r'<[^>]+>', '', text)
+    lines = [re.sub(r'[ \t\xa0]+', ' ', html.unescape(line)).strip() for line in text.split('\n')]
+    return '\r\n'.join(line for line in lines if line)
+
+
+def new_message_id(rng: random.Random) -> str:
+    return "AAMkAG" + base64.urlsafe_b64encode(rng.getrandbits(256).to_bytes(32, "big")).decode().rstrip("=")
+
+
+def new_change_key(rng: random.Random) -> str:
+    return "CQAAABYAAAA" + base64.b64encode(rng.getrandbits(96).to_bytes(12, "big")).decode()
+
+
+class MailboxGenerator:
+    """Sinh mailbox tổng hợp: Meta receipts dựa trên index.html xen lẫn email thường"""
+
+    def __init__(self, message_count: int, days: int, noise_ratio: float, attachment_ratio: float, attachment_kb: int):
+        self.message_count = message_count
+        self.days = days
+        self.noise_ratio = noise_ratio
+        self.attachment_ratio = attachment_ratio
+        self.attachment_kb = attachment_kb
+        with open(TEMPLATE_PATH, encoding="utf-8") as f:
+            self.template = f.read()
+
+    def receipt_body(self, rng: random.Random, received_at: datetime) -> str:
+        account_id = str(rng.randint(10 ** 14, 10 ** 15 - 1))
+        transaction_id = f"{rng.randint(10 ** 16, 10 ** 17 - 1)}-{rng.randint(10 ** 16, 10 ** 17 - 1)}"
+        amount = f"${rng.randint(1, 500000) / 100:,.2f}"
+        return (
+            self.template
+            .replace("Meraki-T-T052-P2", f"Mock-Campaign-{rng.randint(1, 999)}")
+            .replace("580558867876422", account_id)
+            .replace("24090552693965621-24103687332652159", transaction_id)
+            .replace("$0.01", amount)
+            .replace("18 Jul 2025", received_at.strftime("%d %b %Y"))
+        )
+
+    def build_message(self, rng: random.Random, user: str, received_at: datetime) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        is_receipt = rng.random() >= self.noise_ratio
+        if is_receipt:
+            sender, subject = META_SENDER, META_SUBJECT
+            body = self.receipt_body(rng, received_at)
+        else:
+            sender, subject = rng.choice(NOISE_SENDERS), rng.choice(NOISE_SUBJECTS)
+            body = f"<html><body><div>{subject}</div><p>{'Lorem ipsum dolor sit amet. ' * rng.randint(5, 50)}</p></body></html>"
+
+        attachments = []
+        if rng.random() < self.attachment_ratio:
+            content = rng.getrandbits(self.attachment_kb * 8192).to_bytes(self.attachment_kb * 1024, "big")
+            attachments.append({
+                "@odata.type": "#microsoft.graph.fileAttachment",
+                "id": "AAMkAtt" + hashlib.sha1(content).hexdigest()[:24],
+                "name": f"receipt-{received_at.strftime('%Y%m%d')}.pdf",
+                "contentType": "application/pdf",
+                "size": len(content),
+                "isInline": False,
+                "lastModifiedDateTime": received_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "contentBytes": base64.b64encode(content).decode()
+            })
+
+        timestamp = received_at.strftime("%Y-%m-%dT%H:%M:%SZ")
+        message = {
+            "id": new_message_id(rng),
+            "changeKey": new_change_key(rng),
+            "createdDateTime": timestamp,
+            "lastModifiedDateTime": timestamp,
+            "receivedDateTime": timestamp,
+            "sentDateTime": timestamp,
+            "subject": subject,
+            "from": {"emailAddress": dict(sender)},
+            "sender": {"emailAddress": dict(sender)},
+            "toRecipients": [{"emailAddress": {"name": user, "address": f"{user}@mock.local"}}],
+            "ccRecipients": [],
+            "bccRecipients": [],
+            "isRead": rng.random() < 0.5,
+            "hasAttachments": bool(attachments),
+            "importance": "normal",
+            "conversationId": "AAQkAG" + hashlib.sha1(subject.encode()).hexdigest()[:24],
+            "conversationIndex": base64.b64encode(rng.getrandbits(176).to_bytes(22, "big")).decode(),
+            "flag": {"flagStatus": "notFlagged"},
+            "categories": [],
+            "parentFolderId": self.pick_folder(is_receipt, received_at),
+            "body": {"contentType": "html", "content": body},
+            "bodyPreview": html_to_text(body)[:255]
+        }
+        return message, attachments
+
+    @staticmethod
+    def pick_folder(is_receipt: bool, received_at: datetime) -> str:
+        """Folder theo hash (không dùng rng để nội dung mailbox sinh ra không đổi)"""
+        bucket = int(hashlib.sha1(received_at.isoformat().encode()).hexdigest(), 16) % 100
+        if bucket < JUNK_FOLDER_PERCENT:
+            return FOLDER_IDS["junkemail"]
+        if is_receipt and bucket < JUNK_FOLDER_PERCENT + RECEIPT_FOLDER_PERCENT:
+            return "AQMkADAwATMwMAItReceipts"
+        return FOLDER_IDS["inbox"]
+
+    def generate(self, user: str) -> "Mailbox":
+        rng = random.Random(int(hashlib.sha256(user.encode()).hexdigest(), 16))
+        mailbox = Mailbox(user, rng)
+        now = datetime.utcnow().replace(microsecond=0)
+        for _ in range(self.message_count):
+            received_at = now - timedelta(seconds=rng.randint(0, self.days * 86400))
+            mailbox.add(*self.build_message(rng, user, received_at))
+        return mailbox
+
+
+class Mailbox:
+    """Messages của một user, kèm change log để phục vụ delta query"""
+
+    def __init__(self, user: str, rng: random.Random):
+        self.user = user
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.messages: Dict[str, Dict[str, Any]] = {}
+        self.attachments: Dict[str, List[Dict[str, Any]]] = {}
+        self.sequence = 0
+        self.changes: Dict[str, Tuple[int, bool]] = {}  # message_id -> (sequence, removed)
+        self.moves: Dict[str, int] = {}  # message_id (immutable) -> số lần chuyển folder, là một phần của REST ID
+        self.min_delta_token = 0  # deltatoken nhỏ hơn giá trị này trả về 410
+
+    def _bump(self, message_id: str, removed: bool = False):
+        self.sequence += 1
+        self.changes[message_id] = (self.sequence, removed)
+
+    def add(self, message: Dict[str, Any], attachments: List[Dict[str, Any]] = None):
+        with self.lock:
+            self.messages[message["id"]] = message
+            self.attachments[message["id"]] = attachments or []
+            self._bump(message["id"])
+
+    def update(self, message_id: str, fields: Dict[str, Any]) -> bool:
+        with self.lock:
+            message = self.messages.get(message_id)
+            if not message:
+                return False
+            message.update(fields)
+            message["changeKey"] = new_change_key(self.rng)
+            message["lastModifiedDateTime"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+            self._bump(message_id)
+            return True
+
+    def remove(self, message_id: str) -> bool:
+        with self.lock:
+            if self.messages.pop(message_id, None) is None:
+                return False
+            self.attachments.pop(message_id, None)
+            self._bump(message_id, removed=True)
+            return True
+
+    def move(self, message_id: str, folder_id: Optional[str] = None) -> bool:
+        """Chuyển folder: REST ID đổi, immutable ID giữ nguyên"""
+        with self.lock:
+            if message_id not in self.messages:
+                return False
+            self.moves[message_id] = self.moves.get(message_id, 0) + 1
+            if folder_id:
+                self.messages[message_id]["parentFolderId"] = folder_id
+            self._bump(message_id)
+            return True
+
+    def external_id(self, message_id: str, immutable: bool) -> str:
+        return message_id if immutable else f"{message_id}~{self.moves.get(message_id, 0)}"
+
+    def resolve(self, external_id: str) -> Optional[str]:
+        """REST ID hoặc immutable ID -> ID nội bộ (REST ID cũ sau khi chuyển folder: None)"""
+        if external_id in self.messages:
+            return external_id
+        message_id, _, moves = external_id.rpartition("~")
+        if message_id in self.messages and moves == str(self.moves.get(message_id, 0)):
+            return message_id
+        return None
+
+    def folder_of(self, message: Dict[str, Any]) -> str:
+        """Folder ID của message (message load từ file có parentFolderId lạ được coi là nằm trong Inbox)"""
+        folder_id = resolve_folder_id(message.get("parentFolderId") or "")
+        return folder_id or FOLDER_IDS["inbox"]
+
+    def sorted_messages(self, folder_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self.lock:
+            messages = [
+                message for message in self.messages.values()
+                if folder_id is None or self.folder_of(message) == folder_id
+            ]
+        return sorted(messages, key=lambda m: m.get("receivedDateTime") or "", reverse=True)
+
+    def changes_since(self, token: int) -> List[Tuple[str, bool]]:
+        with self.lock:
+            return [
+                (message_id, removed)
+                for message_id, (sequence, removed) in sorted(self.changes.items(), key=lambda item: item[1][0])
+                if sequence > token
+            ]
+
+
+def resolve_folder_id(folder: str) -> Optional[str]:
+    """Well-known name hoặc folder ID -> folder ID"""
+    if folder.lower() in FOLDER_IDS:
+        return FOLDER_IDS[folder.lower()]
+    return folder if any(folder == folder_id for folder_id, _, _, _ in MAIL_FOLDERS) else None
+
+
+# ---------------------------------------------------------------------------
+# OData helpers
+# ---------------------------------------------------------------------------
+
+def _odata_values(pattern: str, filter_str: str) -> List[str]:
+    return [value.replace("''", "'") for value in re.findall(pattern, filter_str)]
+
+
+def compile_filter(filter_str: Optional[str]):
+    """
+    Dịch các dạng $filter mà app tạo ra (receivedDateTime ge/le/lt, from/emailAddress/address eq,
+    startswith(subject,...)) thành hàm kiểm tra. Không phải OData parser đầy đủ.
+    """
+    if not filter_str:
+        return lambda message: True, False
+
+    received_from = re.search(r"receivedDateTime ge (\S+)", filter_str)
+    received_to = re.search(r"receivedDateTime le (\S+)", filter_str)
+    received_before = re.search(r"receivedDateTime lt (\S+)", filter_str)
+    senders = {value.lower() for value in _odata_values(r"from/emailAddress/address eq '((?:[^']|'')*)'", filter_str)}
+    subjects = _odata_values(r"startswith\(subject,'((?:[^']|'')*)'\)", filter_str)
+
+    def matches(message: Dict[str, Any]) -> bool:
+        received = (message.get("receivedDateTime") or "").rstrip("Z")
+        if received_from and received < received_from.group(1).rstrip("Z"):
+            return False
+        if received_to and received > received_to.group(1).rstrip("Z"):
+            return False
+        if received_before and received >= received_before.group(1).rstrip("Z"):
+            return False
+        if senders and (message.get("from", {}).get("emailAddress", {}).get("address") or "").lower() not in senders:
+            return False
+        if subjects and not any((message.get("subject") or "").startswith(subject) for subject in subjects):
+            return False
+        return True
+
+    return matches, bool(senders and subjects)
+
+
+def parse_prefer(headers: Dict[str, str]) -> Dict[str, str]:
+    prefer = {}
+    for part in (headers.get("prefer") or "").split(","):
+        if "=" in part:
+            key, value = part.split("=", 1)
+            prefer[key.strip().lower()] = value.strip().strip('"')
+    return prefer
+
+
+def project_message(message: Dict[str, Any], select: Optional[str], text_body: bool, attachments=None, expand: Optional[str] = None) -> Dict[str, Any]:
+    fields = [field.strip() for field in select.split(",")] if select else None
+    result = {"@odata.etag": f'W/"{message.get("changeKey")}"'}
+    for key, value in message.items():
+        if fields is None or key in fields or key == "id":
+            result[key] = value
+    if text_body and "body" in result:
+        result["body"] = {"contentType": "text", "content": html_to_text(result["body"]["content"])}
+    if fields and "attachments" in fields and attachments is not None:
+        result["attachments"] = [attachment_metadata(attachment) for attachment in attachments]
+    if expand and expand.startswith("attachments"):
+        # $expand=attachments($select=id,name,...)
+        match = re.match(r"attachments\(\$select=([^)]*)\)", expand)
+        attachment_fields = match.group(1).split(",") if match else None
+        result["attachments"] = [attachment_metadata(attachment, attachment_fields) for attachment in attachments or []]
+    return result
+
+
+def attachment_metadata(attachment: Dict[str, Any], fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    return {
+        key: value for key, value in attachment.items()
+        if key != "contentBytes" and (fields is None or key in fields or key in ("id", "@odata.type"))
+    }
+
+
+# ---------------------------------------------------------------------------
+# Graph stand-in
+# ---------------------------------------------------------------------------
+
+class GraphStandIn:
+    """Xử lý request Graph trên các mailbox trong bộ nhớ"""
+
+    def __init__(self, args):
+        self.args = args
+        self.generator = MailboxGenerator(
+            args.messages, args.days, args.noise_ratio, args.attachment_ratio, args.attachment_kb
+        )
+        self.mailboxes: Dict[str, Mailbox] = {}
+        self.lock = threading.Lock()
+        self.recorded_messages = self._load_mailbox_file(args.mailbox) if args.mailbox else None
+
+    @staticmethod
+    def _load_mailbox_file(path: str) -> List[Dict[str, Any]]:
+        """File JSON là list message hoặc response Graph dạng {"value": [...]}"""
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return data.get("value", []) if isinstance(data, dict) else data
+
+    def get_mailbox(self, user: str) -> Mailbox:
+        with self.lock:
+            mailbox = self.mailboxes.get(user)
+            if mailbox is None:
+                if self.recorded_messages is not None:
+                    mailbox = Mailbox(user, random.Random(user))
+                    for message in self.recorded_messages:
+                        message = json.loads(json.dumps(message))
+                        mailbox.add(message, message.pop("attachments", None) or [])
+                else:
+                    mailbox = self.generator.generate(user)
+                self.mailboxes[user] = mailbox
+            return mailbox
+
+    def handle(
+        self,
+        user: str,
+        method: str,
+        path: str,
+        params: Dict[str, str],
+        headers: Dict[str, str],
+        body: Any,
+        base_url: str
+    ) -> Tuple[int, Any, Dict[str, str]]:
+        """Trả về (status, body, headers). body là dict (JSON) hoặc bytes"""
+        mailbox = self.get_mailbox(user)
+        prefer = parse_prefer(headers)
+        text_body = prefer.get("outlook.body-content-type") == "text"
+        immutable = prefer.get("idtype") == "ImmutableId"
+        parts = [part for part in path.strip("/").split("/") if part]
+
+        if parts == ["me"] and method == "GET":
+            return 200, {
+                "id": hashlib.sha1(user.encode()).hexdigest()[:16],
+                "displayName": user,
+                "mail": f"{user}@mock.local",
+                "userPrincipalName": f"{user}@mock.local"
+            }, {}
+
+        if parts == ["me", "messages"] and method == "GET":
+            return self.list_messages(mailbox, params, text_body, immutable, base_url)
+
+        if len(parts) >= 2 and parts[:2] == ["me", "mailFolders"] and parts[-1] != "delta" and method == "GET":
+            return self.mail_folders(mailbox, parts[2:], params, text_body, immutable, base_url)
+
+        if len(parts) == 3 and parts[:2] == ["me", "messages"] and method == "GET":
+            message_id = mailbox.resolve(parts[2])
+            if not message_id:
+                return 404, graph_error("ErrorItemNotFound", "The specified object was not found in the store."), {}
+            result = project_message(
+                mailbox.messages[message_id], params.get("$select"), text_body,
+                mailbox.attachments.get(message_id), params.get("$expand")
+            )
+            result["id"] = mailbox.external_id(message_id, immutable)
+            return 200, result, {}
+
+        if len(parts) >= 4 and parts[:2] == ["me", "messages"] and parts[3] == "attachments" and method == "GET":
+            return self.get_attachments(mailbox, mailbox.resolve(parts[2]), parts[4:], params)
+
+        if (len(parts) == 5 and parts[:2] == ["me", "mailFolders"]
+                and parts[3:] == ["messages", "delta"] and method == "GET"):
+            return self.delta(mailbox, parts[2], params, prefer, text_body, immutable, base_url)
+
+        if parts == ["me", "translateExchangeIds"] and method == "POST":
+            return self.translate_ids(mailbox, body or {})
+
+        return 400, graph_error("BadRequest", f"Unsupported request: {method} /{path}"), {}
+
+    def mail_folders(self, mailbox: Mailbox, rest: List[str], params: Dict[str, str], text_body: bool, immutable: bool, base_url: str):
+        """/me/mailFolders, /me/mailFolders/{folder}, /childFolders và /messages của một folder"""
+        if rest:
+            folder_id = resolve_folder_id(rest[0])
+            if not folder_id:
+                return 404, graph_error("ErrorItemNotFound", "The specified folder could not be found in the store."), {}
+        else:
+            folder_id = ROOT_FOLDER_ID
+
+        if rest[1:] == ["messages"]:
+            return self.list_messages(mailbox, params, text_body, immutable, base_url, folder_id)
+
+        def folder_resource(folder: Tuple[str, Optional[str], str, str]) -> Dict[str, Any]:
+            messages = mailbox.sorted_messages(folder[0])
+            resource = {
+                "id": folder[0],
+                "displayName": folder[2],
+                "parentFolderId": folder[3],
+                "childFolderCount": len([child for child in MAIL_FOLDERS if child[3] == folder[0]]),
+                "unreadItemCount": len([message for message in messages if not message.get("isRead")]),
+                "totalItemCount": len(messages)
+            }
+            select = params.get("$select")
+            return {key: value for key, value in resource.items() if not select or key == "id" or key in select.split(",")}
+
+        if len(rest) == 1:
+            folder = next(folder for folder in MAIL_FOLDERS if folder[0] == folder_id)
+            return 200, folder_resource(folder), {}
+        if len(rest) > 2 or rest[1:] not in ([], ["childFolders"]):
+            return 400, graph_error("BadRequest", f"Unsupported request: GET /me/mailFolders/{'/'.join(rest)}"), {}
+
+        top = min(int(params.get("$top", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        skip = int(params.get("$skip", 0))
+        children = [folder for folder in MAIL_FOLDERS if folder[3] == folder_id]
+        result = {"value": [folder_resource(folder) for folder in children[skip:skip + top]]}
+        if skip + top < len(children):
+            path = "/".join(["me", "mailFolders"] + rest)
+            result["@odata.nextLink"] = f"{base_url}/{path}?{urlencode(dict(params, **{'$skip': str(skip + top)}), quote_via=quote)}"
+        return 200, result, {}
+
+    def list_messages(self, mailbox: Mailbox, params: Dict[str, str], text_body: bool, immutable: bool, base_url: str, folder_id: Optional[str] = None):
+        matches, combined = compile_filter(params.get("$filter"))
+        if combined and self.args.reject_combined_filter:
+            return 400, graph_error("InefficientFilter", "The restriction or sort order is too complex for this operation."), {}
+
+        top = min(int(params.get("$top", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        skip = int(params.get("$skip", 0))
+        messages = [message for message in mailbox.sorted_messages(folder_id) if matches(message)]
+        page = messages[skip:skip + top]
+
+        result = {
+            "@odata.context": f"{base_url}/$metadata#users('{mailbox.user}')/messages",
+            "value": [
+                dict(
+                    project_message(
+                        message, params.get("$select"), text_body,
+                        mailbox.attachments.get(message["id"]), params.get("$expand")
+                    ),
+                    id=mailbox.external_id(message["id"], immutable)
+                )
+                for message in page
+            ]
+        }
+        if params.get("$count") == "true":
+            result["@odata.count"] = len(messages)
+        if skip + top < len(messages):
+            next_params = dict(params, **{"$skip": str(skip + top)})
+            path = f"me/mailFolders/{folder_id}/messages" if folder_id else "me/messages"
+            result["@odata.nextLink"] = f"{base_url}/{path}?{urlencode(next_params, quote_via=quote)}"
+        return 200, result, {}
+
+    def get_attachments(self, mailbox: Mailbox, message_id: Optional[str], rest: List[str], params: Dict[str, str]):
+        if message_id not in mailbox.messages:
+            return 404, graph_error("ErrorItemNotFound", "The specified object was not found in the store."), {}
+        attachments = mailbox.attachments.get(message_id, [])
+
+        if not rest:
+            select = params.get("$select")
+            value = [
+                {key: attachment[key] for key in ["id"] + select.split(",") if key in attachment} if select else attachment
+                for attachment in attachments
+            ]
+            return 200, {"value": value}, {}
+
+        attachment = next((a for a in attachments if a["id"] == rest[0]), None)
+        if not attachment:
+            return 404, graph_error("ErrorItemNotFound", "The attachment was not found."), {}
+        if rest[1:] == ["$value"]:
+            return 200, base64.b64decode(attachment["contentBytes"]), {"Content-Type": attachment.get("contentType", "application/octet-stream")}
+        return 200, attachment, {}
+
+    def translate_ids(self, mailbox: Mailbox, body: Dict[str, Any]):
+        """translateExchangeIds giữa restId và restImmutableEntryId, ID không tìm thấy bị bỏ qua"""
+        id_types = ("restId", "restImmutableEntryId")
+        if body.get("sourceIdType") not in id_types or body.get("targetIdType") not in id_types:
+            return 400, graph_error("InvalidRequest", "Unsupported id type"), {}
+        input_ids = body.get("inputIds") or []
+        if len(input_ids) > 1000:
+            return 400, graph_error("InvalidRequest", "Too many input ids"), {}
+
+        value = []
+        for input_id in input_ids:
+            message_id = mailbox.resolve(input_id)
+            if message_id:
+                value.append({
+                    "sourceId": input_id,
+                    "targetId": mailbox.external_id(message_id, body["targetIdType"] == "restImmutableEntryId")
+                })
+        return 200, {"value": value}, {}
+
+    def delta(self, mailbox: Mailbox, folder_id: str, params: Dict[str, str], prefer: Dict[str, str], text_body: bool, immutable: bool, base_url: str):
+        page_size = min(int(prefer.get("odata.maxpagesize", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        select = params.get("$select")
+        delta_url = f"{base_url}/me/mailFolders/{folder_id}/messages/delta"
+        folder_id = resolve_folder_id(folder_id)
+        if not folder_id:
+            return 404, graph_error("ErrorItemNotFound", "The specified folder could not be found in the store."), {}
+
+        if "$skiptoken" in params:
+            # skiptoken = "<offset>.<anchor sequence>.<deltatoken ban đầu hoặc -1>.<filter>"
+            offset, anchor, token, filter_str = params["$skiptoken"].split(".", 3)
+            offset, anchor, token = int(offset), int(anchor), int(token)
+        else:
+            offset, anchor, filter_str = 0, mailbox.sequence, params.get("$filter", "")
+            token = int(params["$deltatoken"]) if "$deltatoken" in params else -1
+
+        if token >= 0 and token < mailbox.min_delta_token:
+            return 410, graph_error("SyncStateNotFound", "The sync state generation is not found."), {}
+
+        if token < 0:
+            matches, _ = compile_filter(filter_str)
+            items = [(message["id"], False) for message in mailbox.sorted_messages(folder_id) if matches(message)]
+        else:
+            # Message đã chuyển sang folder khác được trả về như @removed, message của folder khác bị bỏ qua
+            items = []
+            for message_id, removed in mailbox.changes_since(token):
+                message = mailbox.messages.get(message_id)
+                if removed or message is None or mailbox.folder_of(message) == folder_id:
+                    items.append((message_id, removed))
+                elif mailbox.moves.get(message_id):
+                    items.append((message_id, True))
+
+        page = items[offset:offset + page_size]
+        value = []
+        for message_id, removed in page:
+            message = mailbox.messages.get(message_id)
+            if removed or message is None:
+                value.append({
+                    "@odata.type": "#microsoft.graph.message",
+                    "id": mailbox.external_id(message_id, immutable),
+                    "@removed": {"reason": "deleted"}
+                })
+            else:
+                value.append(dict(project_message(message, select, text_body), id=mailbox.external_id(message_id, immutable)))
+
+        result = {"@odata.context": f"{base_url}/$metadata#Collection(message)", "value": value}
+        if offset + page_size < len(items):
+            skiptoken = f"{offset + page_size}.{anchor}.{token}.{filter_str}"
+            result["@odata.nextLink"] = f"{delta_url}?{urlencode({'$skiptoken': skiptoken}, quote_via=quote)}"
+        else:
+            result["@odata.deltaLink"] = f"{delta_url}?{urlencode({'$deltatoken': str(anchor)})}"
+        return 200, result, {}
+
+
+# ---------------------------------------------------------------------------
+# Change notifications
+# ---------------------------------------------------------------------------
+
+class Subscriptions:
+    """
+    /v1.0/subscriptions: validation handshake khi tạo, gửi change notifications và lifecycle notifications
+    tới notificationUrl của app khi email được thêm / sửa / xóa qua /_control
+    """
+
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.lock = threading.Lock()
+        self.items: Dict[str, Dict[str, Any]] = {}
+        self.tasks = set()
+        self.delivered = 0
+        self.failed = 0
+
+    async def validate(self, url: str) -> bool:
+        token = hashlib.sha1(os.urandom(16)).hexdigest()
+        try:
+            response = await self.client.post(url, params={"validationToken": token}, headers={"Content-Type": "text/plain"})
+        except httpx.HTTPError:
+            return False
+        return response.status_code == 200 and response.text == token
+
+    async def create(self, user: str, body: Dict[str, Any], immutable: bool = False) -> Tuple[int, Dict[str, Any]]:
+        for field in ("changeType", "notificationUrl", "resource", "expirationDateTime"):
+            if not body.get(field):
+                return 400, graph_error("InvalidRequest", f"Missing {field}")
+        urls = {body["notificationUrl"], body.get("lifecycleNotificationUrl") or body["notificationUrl"]}
+        for url in urls:
+            if not await self.validate(url):
+                return 400, graph_error("ValidationError", f"Subscription validation request failed for {url}")
+
+        subscription = {
+            "id": "mock-sub-" + hashlib.sha1(os.urandom(16)).hexdigest()[:16],
+            "resource": body["resource"],
+            "changeType": body["changeType"],
+            "clientState": body.get("clientState"),
+            "notificationUrl": body["notificationUrl"],
+            "lifecycleNotificationUrl": body.get("lifecycleNotificationUrl"),
+            "expirationDateTime": body["expirationDateTime"]
+        }
+        with self.lock:
+            # immutable: resourceData.id dùng immutable ID (Prefer IdType lúc tạo subscription)
+            self.items[subscription["id"]] = dict(subscription, user=user, immutable=immutable)
+        return 201, subscription
+
+    def update(self, user: str, subscription_id: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        with self.lock:
+            subscription = self.items.get(subscription_id)
+            if not subscription or subscription["user"] != user:
+                return 404, graph_error("ResourceNotFound", "The object was not found.")
+            if body.get("expirationDateTime"):
+                subscription["expirationDateTime"] = body["expirationDateTime"]
+            return 200, {key: value for key, value in subscription.items() if key not in ("user", "immutable")}
+
+    def delete(self, user: Optional[str], subscription_id: str) -> bool:
+        with self.lock:
+            subscription = self.items.get(subscription_id)
+            if not subscription or (user is not None and subscription["user"] != user):
+                return False
+            del self.items[subscription_id]
+            return True
+
+    def list(self, user: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [dict(s) for s in self.items.values() if user is None or s["user"] == user]
+
+    def _post(self, url: str, notifications: List[Dict[str, Any]]):
+        async def send():
+            try:
+                response = await self.client.post(url, json={"value": notifications})
+                if response.status_code < 300:
+                    self.delivered += len(notifications)
+                else:
+                    self.failed += len(notifications)
+            except httpx.HTTPError:
+                self.failed += len(notifications)
+
+        # Graph gửi notification bất đồng bộ, không chặn request đã gây ra thay đổi
+        task = asyncio.get_running_loop().create_task(send())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def notify(self, mailbox: "Mailbox", message_ids: List[str], change_type: str):
+        now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        user = mailbox.user
+        for subscription in self.list(user):
+            if change_type not in subscription["changeType"].split(",") or subscription["expirationDateTime"] < now:
+                continue
+            external_ids = [mailbox.external_id(message_id, subscription["immutable"]) for message_id in message_ids]
+            self._post(subscription["notificationUrl"], [
+                {
+                    "subscriptionId": subscription["id"],
+                    "subscriptionExpirationDateTime": subscription["expirationDateTime"],
+                    "changeType": change_type,
+                    "resource": f"Users/{user}/Messages/{message_id}",
+                    "resourceData": {
+                        "@odata.type": "#Microsoft.Graph.Message",
+                        "@odata.id": f"Users/{user}/Messages/{message_id}",
+                        "id": message_id
+                    },
+                    "clientState": subscription["clientState"],
+                    "tenantId": "mock-tenant"
+                }
+                for message_id in external_ids
+            ])
+
+    def lifecycle(self, subscription_id: str, event: str) -> bool:
+        with self.lock:
+            subscription = self.items.get(subscription_id)
+        if not subscription:
+            return False
+        self._post(subscription.get("lifecycleNotificationUrl") or subscription["notificationUrl"], [{
+            "subscriptionId": subscription["id"],
+            "subscriptionExpirationDateTime": subscription["expirationDateTime"],
+            "lifecycleEvent": event,
+            "clientState": subscription["clientState"],
+            "tenantId": "mock-tenant"
+        }])
+        if event == "subscriptionRemoved":
+            self.delete(None, subscription_id)
+        return True
+
+
+# ---------------------------------------------------------------------------
+# Record / replay
+# ---------------------------------------------------------------------------
+
+class Recorder:
+    """
+    Ghi response của Graph thật (--record, proxy tới --upstream) vào file JSON,
+    và phát lại (--replay) theo key method + path + query
+    """
+
+    def __init__(self, path: str, upstream: Optional[str] = None):
+        self.path = path
+        self.upstream = upstream.rstrip("/") if upstream else None
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(method: str, path: str, params: Dict[str, str], body: Any = None) -> str:
+        key = f"{method} /{path.strip('/')}?{urlencode(sorted(params.items()))}"
+        if body is not None:
+            key += " " + json.dumps(body, sort_keys=True)
+        return key
+
+    def lookup(self, key: str, base_url: str) -> Optional[Tuple[int, Any, Dict[str, str]]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        body = json.loads(json.dumps(entry["body"]).replace(RECORD_BASE_PLACEHOLDER, base_url))
+        return entry["status"], body, entry.get("headers", {})
+
+    async def forward(self, client: httpx.AsyncClient, key: str, method: str, path: str,
+                      params: Dict[str, str], headers: Dict[str, str], body: Any, base_url: str):
+        forward_headers = {
+            name: value for name, value in headers.items()
+            if name in ("authorization", "prefer", "content-type")
+        }
+        response = await client.request(
+            method, f"{self.upstream}/{path.strip('/')}", params=params, headers=forward_headers,
+            json=body if body is not None else None
+        )
+        try:
+            data = response.json()
+        except ValueError:
+            return response.status_code, response.content, {"Content-Type": response.headers.get("content-type", "")}
+
+        entry_headers = {name: response.headers[name] for name in ("Retry-After",) if name in response.headers}
+        recorded = json.loads(json.dumps(data).replace(self.upstream, RECORD_BASE_PLACEHOLDER))
+        with self.lock:
+            self.entries[key] = {"status": response.status_code, "headers": entry_headers, "body": recorded}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+
+        return response.status_code, json.loads(json.dumps(recorded).replace(RECORD_BASE_PLACEHOLDER, base_url)), entry_headers
+
+
+# ---------------------------------------------------------------------------
+# FastAPI app
+# ---------------------------------------------------------------------------
+
+def user_from_token(authorization: Optional[str]) -> Optional[str]:
+    if not authorization or not authorization.lower().startswith("bearer "):
+        return None
+    token = authorization[7:].strip()
+    if token.startswith("mock-access-"):
+        return token[len("mock-access-"):]
+    return None
+
+
+def create_app(args) -> FastAPI:
+    app = FastAPI(title="Microsoft Graph stand-in")
+    app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+    faults = FaultConfig(args.latency_ms, args.jitter_ms, args.throttle_rate, args.error_rate, args.retry_after)
+    if args.seed is not None:
+        faults.rng.seed(args.seed)
+    stats = Stats()
+    graph = GraphStandIn(args)
+    recorder = Recorder(args.record or args.replay, args.upstream) if (args.record or args.replay) else None
+    upstream_client = httpx.AsyncClient(timeout=60) if args.record else None
+    subscriptions = Subscriptions(httpx.AsyncClient(timeout=10))
+
+    def json_response(status: int, body: Any, headers: Dict[str, str]) -> Response:
+        if isinstance(body, (bytes, bytearray)):
+            return Response(content=bytes(body), status_code=status, headers=headers)
+        return JSONResponse(body, status_code=status, headers=headers)
+
+    # -- OAuth -------------------------------------------------------------
+
+    @app.get("/{tenant}/oauth2/v2.0/authorize")
+    def authorize(tenant: str, redirect_uri: str, state: str = "", login_hint: str = "user1"):
+        stats.record("authorize")
+        return RedirectResponse(f"{redirect_uri}?{urlencode({'code': login_hint, 'state': state})}")
+
+    @app.post("/{tenant}/oauth2/v2.0/token")
+    async def token(tenant: str, request: Request):
+        form = await request.form()
+        grant_type = form.get("grant_type")
+        fault = faults.pick_fault() if args.token_faults else None
+        stats.record("token", fault[0] if fault else None)
+        if fault:
+            return json_response(*fault)
+
+        if grant_type == "refresh_token":
+            refresh_token = form.get("refresh_token") or ""
+            if "revoked" in refresh_token or not refresh_token.startswith("mock-refresh-"):
+                return JSONResponse({
+                    "error": "invalid_grant",
+                    "error_description": "AADSTS70000: The provided grant has expired due to it being revoked."
+                }, status_code=400)
+            user = refresh_token[len("mock-refresh-"):]
+        elif grant_type == "authorization_code":
+            user = form.get("code") or "user1"
+        else:
+            return JSONResponse({"error": "unsupported_grant_type"}, status_code=400)
+
+        return {
+            "token_type": "Bearer",
+            "scope": form.get("scope") or "offline_access Mail.Read User.Read",
+            "expires_in": args.token_lifetime,
+            "ext_expires_in": args.token_lifetime,
+            "access_token": f"mock-access-{user}",
+            "refresh_token": f"mock-refresh-{user}"
+        }
+
+    # -- Control -----------------------------------------------------------
+
+    @app.get("/_control/stats")
+    def get_stats():
+        return {"stats": stats.to_dict(), "faults": faults.to_dict(), "mailboxes": {
+            user: len(mailbox.messages) for user, mailbox in graph.mailboxes.items()
+        }}
+
+    @app.post("/_control/stats/reset")
+    def reset_stats():
+        stats.reset()
+        return {"stats": stats.to_dict()}
+
+    @app.post("/_control/faults")
+    async def set_faults(request: Request):
+        faults.update(await request.json())
+        return {"faults": faults.to_dict()}
+
+    @app.post("/_control/mailboxes/{user}/messages")
+    async def add_messages(user: str, count: int = 1):
+        """Thêm email mới (xuất hiện trong delta query kế tiếp, gửi notification "created")"""
+        mailbox = graph.get_mailbox(user)
+        ids = []
+        for _ in range(count):
+            message, attachments = graph.generator.build_message(mailbox.rng, user, datetime.utcnow().replace(microsecond=0))
+            mailbox.add(message, attachments)
+            ids.append(message["id"])
+        subscriptions.notify(mailbox, ids, "created")
+        return {"added": ids}
+
+    @app.patch("/_control/mailboxes/{user}/messages/{message_id}")
+    async def update_message(user: str, message_id: str, request: Request):
+        """Cập nhật email (đổi changeKey), vd: {"isRead": true}"""
+        mailbox = graph.get_mailbox(user)
+        message_id = mailbox.resolve(message_id)
+        if not message_id or not mailbox.update(message_id, await request.json()):
+            return JSONResponse(graph_error("ErrorItemNotFound", "Message not found"), status_code=404)
+        subscriptions.notify(mailbox, [message_id], "updated")
+        return {"updated": message_id}
+
+    @app.post("/_control/mailboxes/{user}/messages/{message_id}/move")
+    def move_message(user: str, message_id: str, folder: Optional[str] = None):
+        """Chuyển email sang folder khác (well-known name hoặc folder ID): REST ID đổi, immutable ID giữ nguyên"""
+        mailbox = graph.get_mailbox(user)
+        message_id = mailbox.resolve(message_id)
+        folder_id = resolve_folder_id(folder) if folder else None
+        if folder and not folder_id:
+            return JSONResponse(graph_error("ErrorItemNotFound", "Folder not found"), status_code=404)
+        if not message_id or not mailbox.move(message_id, folder_id):
+            return JSONResponse(graph_error("ErrorItemNotFound", "Message not found"), status_code=404)
+        return {"moved": message_id, "rest_id": mailbox.external_id(message_id, False)}
+
+    @app.delete("/_control/mailboxes/{user}/messages/{message_id}")
+    async def delete_message(user: str, message_id: str):
+        mailbox = graph.get_mailbox(user)
+        message_id = mailbox.resolve(message_id)
+        if not message_id or not mailbox.remove(message_id):
+            return JSONResponse(graph_error("ErrorItemNotFound", "Message not found"), status_code=404)
+        subscriptions.notify(mailbox, [message_id], "deleted")
+        return {"removed": message_id}
+
+    @app.get("/_control/subscriptions")
+    def list_subscriptions():
+        return {
+            "subscriptions": subscriptions.list(),
+            "delivered": subscriptions.delivered,
+            "failed": subscriptions.failed
+        }
+
+    @app.post("/_control/subscriptions/{subscription_id}/lifecycle")
+    async def send_lifecycle(subscription_id: str, event: str = "missed"):
+        """Gửi lifecycle notification: missed, reauthorizationRequired, subscriptionRemoved"""
+        if not subscriptions.lifecycle(subscription_id, event):
+            return JSONResponse(graph_error("ResourceNotFound", "Subscription not found"), status_code=404)
+        return {"sent": event}
+
+    @app.post("/_control/mailboxes/{user}/expire-delta")
+    def expire_delta(user: str):
+        """Làm mọi deltaLink hiện có hết hạn (request kế tiếp nhận 410)"""
+        mailbox = graph.get_mailbox(user)
+        mailbox.min_delta_token = mailbox.sequence + 1
+        return {"min_delta_token": mailbox.min_delta_token}
+
+    # -- Graph -------------------------------------------------------------
+
+    async def dispatch(user: str, method: str, path: str, params: Dict[str, str],
+                       headers: Dict[str, str], body: Any, base_url: str):
+        if recorder:
+            key = Recorder.key(method, path, params, body)
+            if args.record:
+                return await recorder.forward(upstream_client, key, method, path, params, headers, body, base_url)
+            replayed = recorder.lookup(key, base_url)
+            if replayed:
+                return replayed
+        if user is None:
+            return 401, graph_error("InvalidAuthenticationToken", "Access token is empty or invalid."), {}
+        return graph.handle(user, method, path, params, headers, body, base_url)
+
+    def endpoint_name(path: str) -> str:
+        parts = path.strip("/").split("/")
+        if len(parts) >= 3 and parts[:2] == ["me", "messages"]:
+            return "/me/messages/{id}" + ("/attachments" if "attachments" in parts else "")
+        if len(parts) >= 3 and parts[:2] == ["me", "mailFolders"]:
+            return "/me/mailFolders/{id}/" + "/".join(parts[3:]) if len(parts) > 3 else "/me/mailFolders/{id}"
+        return "/" + "/".join(parts)
+
+    @app.post("/v1.0/subscriptions")
+    async def create_subscription(request: Request):
+        user = user_from_token(request.headers.get("authorization"))
+        stats.record("/subscriptions")
+        if user is None:
+            return JSONResponse(graph_error("InvalidAuthenticationToken", "Access token is empty or invalid."), status_code=401)
+        immutable = parse_prefer({"prefer": request.headers.get("prefer")}).get("idtype") == "ImmutableId"
+        status, body = await subscriptions.create(user, await request.json(), immutable)
+        return JSONResponse(body, status_code=status)
+
+    @app.patch("/v1.0/subscriptions/{subscription_id}")
+    async def update_subscription(subscription_id: str, request: Request):
+        user = user_from_token(request.headers.get("authorization"))
+        stats.record("/subscriptions/{id}")
+        status, body = subscriptions.update(user, subscription_id, await request.json())
+        return JSONResponse(body, status_code=status)
+
+    @app.delete("/v1.0/subscriptions/{subscription_id}")
+    def delete_subscription(subscription_id: str, request: Request):
+        user = user_from_token(request.headers.get("authorization"))
+        stats.record("/subscriptions/{id}")
+        if not subscriptions.delete(user, subscription_id):
+            return JSONResponse(graph_error("ResourceNotFound", "The object was not found."), status_code=404)
+        return Response(status_code=204)
+
+    @app.api_route("/v1.0/{path:path}", methods=["GET", "POST"])
+    async def graph_endpoint(path: str, request: Request):
+        base_url = f"{request.url.scheme}://{request.url.netloc}/v1.0"
+        headers = {name.lower(): value for name, value in request.headers.items()}
+        user = user_from_token(headers.get("authorization"))
+        body = await request.json() if request.method == "POST" else None
+
+        delay = faults.delay()
+        if delay:
+            await asyncio.sleep(delay)
+
+        fault = faults.pick_fault()
+        stats.record(endpoint_name(path), fault[0] if fault else None)
+        if fault:
+            return json_response(*fault)
+
+        if path.strip("/") == "$batch" and request.method == "POST":
+            requests = (body or {}).get("requests", [])
+            if len(requests) > MAX_BATCH_REQUESTS:
+                return json_response(400, graph_error("BadRequest", "Batch exceeds the maximum of 20 requests."), {})
+
+            responses = []
+            for sub_request in requests:
+                sub_fault = faults.pick_fault()
+                stats.record("$batch item", sub_fault[0] if sub_fault else None)
+                if sub_fault:
+                    status, sub_body, sub_headers = sub_fault
+                else:
+                    url = urlsplit(sub_request.get("url", ""))
+                    sub_request_headers = {name.lower(): value for name, value in (sub_request.get("headers") or {}).items()}
+                    status, sub_body, sub_headers = await dispatch(
+                        user, sub_request.get("method", "GET").upper(), url.path, dict(parse_qsl(url.query)),
+                        dict(headers, **sub_request_headers), sub_request.get("body"), base_url
+                    )
+                if isinstance(sub_body, (bytes, bytearray)):
+                    sub_body = base64.b64encode(sub_body).decode()
+                responses.append({
+                    "id": sub_request.get("id"),
+                    "status": status,
+                    "headers": dict({"Content-Type": "application/json"}, **sub_headers),
+                    "body": sub_body
+                })
+            # Graph không đảm bảo thứ tự response trong $batch
+            faults.rng.shuffle(responses)
+            return json_response(200, {"responses": responses}, {})
+
+        return json_response(*await dispatch(
+            user, request.method, path, dict(request.query_params), headers, body, base_url
+        ))
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        if upstream_client:
+            await upstream_client.aclose()
+        await subscriptions.client.aclose()
+
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Microsoft Graph stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    # Mailbox
+    parser.add_argument("--messages", type=int, default=500, help="Số email tổng hợp mỗi mailbox")
+    parser.add_argument("--days", type=int, default=90, help="Email được rải đều trong N ngày gần nhất")
+    parser.add_argument("--noise-ratio", type=float, default=0.5, help="Tỉ lệ email không phải Meta receipt")
+    parser.add_argument("--attachment-ratio", type=float, default=0.1)
+    parser.add_argument("--attachment-kb", type=int, default=64)
+    parser.add_argument("--mailbox", help="File JSON chứa messages (list hoặc {\"value\": [...]}) thay cho email tổng hợp")
+    # Record / replay
+    parser.add_argument("--record", help="Ghi response từ --upstream vào file này")
+    parser.add_argument("--upstream", default="https://graph.microsoft.com/v1.0")
+    parser.add_argument("--replay", help="Phát lại response đã ghi, request chưa ghi thì dùng mailbox tổng hợp")
+    # Fault injection
+    parser.add_argument("--latency-ms", type=int, default=0)
+    parser.add_argument("--jitter-ms", type=int, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Tỉ lệ request trả về 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỉ lệ request trả về 5xx")
+    parser.add_argument("--retry-after", type=int, default=1, help="Giá trị Retry-After (giây) khi inject 429/503")
+    parser.add_argument("--token-faults", action="store_true", help="Inject lỗi cả cho OAuth token endpoint")
+    parser.add_argument("--reject-combined-filter", action="store_true",
+                        help="Trả về 400 cho filter kết hợp subject + sender (giống một số tenant)")
+    parser.add_argument("--token-lifetime", type=int, default=3600)
+    parser.add_argument("--seed", type=int, help="Seed cho fault injection (chạy lại cho kết quả giống nhau)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"🚀 Graph stand-in on http://{args.host}:{args.port}")
+    print(f"   GRAPH_API_BASE=http://{args.host}:{args.port}/v1.0")
+    print(f"   AUTHORITY=http://{args.host}:{args.port}/consumers")
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
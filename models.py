@@ -37,6 +37,9 @@ class Account(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_active = Column(Boolean, default=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # Thêm trường user_id
+    uses_immutable_ids = Column(Boolean, default=True)  # message_id đã lưu là immutable ID (account cũ: False tới khi migrate)
+    backfill_cursor = Column(DateTime, nullable=True)  # Progressive initial sync: đã backfill từ mốc này tới hiện tại, NULL = không còn backfill
+    backfill_stop_at = Column(DateTime, nullable=True)  # Mốc dừng backfill (INITIAL_SYNC_DAYS trước lần sync đầu)
     
     # Relationship với auth_tokens
     auth_tokens = relationship("AuthToken", back_populates="account", cascade="all, delete-orphan")
@@ -73,6 +76,7 @@ class Email(Base):
     id = Column(Integer, primary_key=True, index=True)
     account_id = Column(Integer, ForeignKey("accounts.id"), nullable=False)
     message_id = Column(String(500), unique=True, index=True, nullable=False)  # ID từ Microsoft Graph
+    change_key = Column(String(255), nullable=True)  # changeKey từ Graph, đổi mỗi khi message thay đổi
     subject = Column(String(1000), nullable=True)
     from_email = Column(String(255), nullable=True)
     from_name = Column(String(255), nullable=True)
@@ -91,6 +95,7 @@ class Email(Base):
     flag_status = Column(String(50), nullable=True)  # notFlagged, flagged, completed
     categories = Column(JSON, nullable=True)  # Lưu dạng array
     attachments = Column(JSON, nullable=True)  # Lưu dạng array of objects
+    removed_at = Column(DateTime, nullable=True)  # @removed (bị xóa / chuyển khỏi folder): giữ email và meta receipt
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -112,6 +117,7 @@ class EmailAttachment(Base):
     content_location = Column(String(500), nullable=True)
     content_bytes = Column(Text, nullable=True)  # Base64 encoded content
     file_path = Column(String(1000), nullable=True)  # Đường dẫn file đã tải về
+    content_hash = Column(String(64), nullable=True, index=True)  # SHA-256 của nội dung (key trong attachment store)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationship với email
@@ -142,4 +148,87 @@ class MetaReceipt(Base):
     
     # Relationship với account và email
     account = relationship("Account")
-    email = relationship("Email") 
\ No newline at end of file
+    email = relationship("Email")
+
+class DeltaSyncState(Base):
+    """Model cho bảng delta_sync_states - lưu deltaLink của Graph delta query theo account và folder"""
+    __tablename__ = "delta_sync_states"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    account_id = Column(Integer, ForeignKey("accounts.id"), nullable=False, index=True)
+    folder_id = Column(String(255), nullable=False, default="inbox")  # ID hoặc well-known name của mail folder
+    delta_link = Column(Text, nullable=False)  # @odata.deltaLink trả về ở trang cuối
+    last_synced_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Relationship với account
+    account = relationship("Account")
+
+class AccountCircuitBreaker(Base):
+    """Model cho bảng account_circuit_breakers - trạng thái circuit breaker của từng account khi sync"""
+    __tablename__ = "account_circuit_breakers"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    account_id = Column(Integer, ForeignKey("accounts.id"), unique=True, index=True, nullable=False)
+    state = Column(String(20), default="closed")  # closed, open, half_open
+    failure_count = Column(Integer, default=0)  # Số lần lỗi liên tiếp
+    open_count = Column(Integer, default=0)  # Số lần mở liên tiếp (dùng cho backoff của half-open probe)
+    failure_class = Column(String(50), nullable=True)  # invalid_grant, forbidden, unauthorized, throttled, transient
+    last_error = Column(Text, nullable=True)
+    opened_at = Column(DateTime, nullable=True)
+    next_probe_at = Column(DateTime, nullable=True)  # Thời điểm được phép thử lại (half-open)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Relationship với account
+    account = relationship("Account")
+
+class GraphSubscription(Base):
+    """Model cho bảng graph_subscriptions - change notification subscription (webhook) của từng account"""
+    __tablename__ = "graph_subscriptions"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    account_id = Column(Integer, ForeignKey("accounts.id"), unique=True, index=True, nullable=False)
+    subscription_id = Column(String(255), unique=True, index=True, nullable=False)  # ID subscription do Graph trả về
+    resource = Column(String(500), nullable=False)
+    client_state = Column(String(255), nullable=False)  # Secret để xác thực notification
+    expiration_date_time = Column(DateTime, nullable=False)
+    last_notification_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Relationship với account
+    account = relationship("Account")
+
+class GraphRequestUsage(Base):
+    """Model cho bảng graph_request_usage - số Graph requests của từng account theo bucket thời gian"""
+    __tablename__ = "graph_request_usage"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    account_id = Column(Integer, index=True, nullable=False)  # 0: request không gắn với account (vd: đổi code lấy token khi đăng nhập)
+    bucket_start = Column(DateTime, index=True, nullable=False)  # Đầu bucket (REQUEST_BUDGET_BUCKET_SECONDS)
+    requests = Column(Integer, default=0)  # Số HTTP request tới Graph (kể cả retry)
+    cost = Column(Integer, default=0)  # Số request Graph tính vào throttling (mỗi request con trong $batch tính 1)
+    throttled = Column(Integer, default=0)  # Số response 429 / 503
+    token_requests = Column(Integer, default=0)  # Số request tới endpoint OAuth token
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SyncJob(Base):
+    """Model cho bảng sync_jobs - job sync gần nhất theo từng key, để process khác dùng lại kết quả (single-flight)"""
+    __tablename__ = "sync_jobs"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    account_id = Column(Integer, ForeignKey("accounts.id"), index=True, nullable=False)
+    job_key = Column(String(255), unique=True, index=True, nullable=False)  # "<account_id>:<operation>:<window>"
+    status = Column(String(20), default="running")  # running, succeeded, failed
+    result = Column(JSON, nullable=True)
+    error = Column(Text, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Relationship với account
+    account = relationship("Account")
@@ -1,101 +1,73 @@
 """
-Script để refresh tất cả tokens đã hết hạn
+Script để refresh tất cả tokens đã hết hạn (song song, xem app/token_refresher.py)
 """
 import sys
 import os
-from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
+from datetime import datetime
 from sqlalchemy import and_
 
 # Thêm thư mục hiện tại vào path để import các module
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from database import SessionLocal
-from models import Account, AuthToken
-from app.auth import refresh_access_token
+from models import AuthToken
+from app.config import TOKEN_REFRESH_MAX_WORKERS
+from app.token_refresher import refresh_tokens
 
-def refresh_expired_tokens():
+def refresh_expired_tokens(account_ids=None, within_minutes: int = 0, workers: int = TOKEN_REFRESH_MAX_WORKERS):
     """
-    Refresh tất cả tokens đã hết hạn
+    Refresh tất cả tokens đã hết hạn (hoặc hết hạn trong within_minutes phút tới)
     """
     print("🔄 REFRESH EXPIRED TOKENS")
     print("=" * 50)
-    
+
     db = SessionLocal()
     try:
-        current_time = datetime.utcnow()
-        
-        # Lấy tất cả tokens đã hết hạn
-        expired_tokens = db.query(AuthToken).filter(
-            and_(
-                AuthToken.is_active == True,
-                AuthToken.expires_at < current_time
-            )
-        ).all()
-        
-        print(f"📊 Tìm thấy {len(expired_tokens)} tokens đã hết hạn")
-        
-        if not expired_tokens:
+        summary = refresh_tokens(db, account_ids, within_seconds=within_minutes * 60, max_workers=workers)
+
+        print(f"📊 Tìm thấy {summary['total']} tokens cần refresh")
+
+        if not summary["total"]:
             print("✅ Không có token nào cần refresh")
-            return
-        
-        success_count = 0
-        error_count = 0
-        
-        for token in expired_tokens:
-            try:
-                print(f"\n🔄 Đang refresh token cho account {token.account_id}...")
-                
-                # Lấy thông tin account
-                account = db.query(Account).filter(Account.id == token.account_id).first()
-                if not account:
-                    print(f"❌ Không tìm thấy account {token.account_id}")
-                    error_count += 1
-                    continue
-                
-                print(f"📧 Email: {account.email}")
-                print(f"⏰ Token hết hạn: {token.expires_at}")
-                
-                # Refresh token
-                new_access_token = refresh_access_token(db, token.account_id)
-                
-                if new_access_token:
-                    # Lấy token đã được cập nhật
-                    updated_token = db.query(AuthToken).filter(AuthToken.account_id == token.account_id).first()
-                    
-                    print(f"✅ Token đã được refresh thành công")
-                    print(f"⏰ Hết hạn mới: {updated_token.expires_at}")
-                    success_count += 1
-                else:
-                    print(f"❌ Không thể refresh token")
-                    error_count += 1
-                    
-            except Exception as e:
-                print(f"❌ Lỗi khi refresh token cho account {token.account_id}: {str(e)}")
-                error_count += 1
+            return summary
+
+        for result in summary["results"]:
+            if result["status"] == "ok":
                 continue
-        
-        print(f"\n📈 Tổng kết:")
-        print(f"  - Tokens refresh thành công: {success_count}")
-        print(f"  - Tokens lỗi: {error_count}")
-        
+            icon = "⏭️" if result["status"] == "skipped" else "❌"
+            print(f"{icon} Account {result['account_id']}: {result['status']} {result.get('error', '')}")
+
+        print(f"\n📈 Tổng kết ({summary['duration_seconds']}s):")
+        print(f"  - Tokens refresh thành công: {summary['ok']}")
+        print(f"  - Tokens cần đăng nhập lại (invalid_grant): {summary['invalid_grant']}")
+        print(f"  - Tokens lỗi tạm thời (chạy lại script sau): {summary['transient']}")
+        print(f"  - Tokens đã được refresh trước đó: {summary['skipped']}")
+
         # Kiểm tra lại sau khi refresh
         valid_tokens = db.query(AuthToken).filter(
             and_(
                 AuthToken.is_active == True,
-                AuthToken.expires_at > current_time
+                AuthToken.expires_at > datetime.utcnow()
             )
         ).count()
-        
+
         print(f"  - Tokens hợp lệ hiện tại: {valid_tokens}")
-        
+        return summary
+
     except Exception as e:
         print(f"❌ Lỗi chung: {str(e)}")
     finally:
         db.close()
-    
-    print("\n" + "=" * 50)
-    print("✅ Hoàn thành refresh tokens!")
+        print("\n" + "=" * 50)
+        print("✅ Hoàn thành refresh tokens!")
 
 if __name__ == "__main__":
-    refresh_expired_tokens() 
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Refresh tokens đã hết hạn')
+    parser.add_argument('--account-id', type=int, action='append', help='Chỉ refresh account này (có thể lặp lại)')
+    parser.add_argument('--within-minutes', type=int, default=0, help='Refresh cả token sẽ hết hạn trong số phút này')
+    parser.add_argument('--workers', type=int, default=TOKEN_REFRESH_MAX_WORKERS, help='Số request refresh song song')
+
+    args = parser.parse_args()
+    refresh_expired_tokens(args.account_id, args.within_minutes, args.workers)
@@ -0,0 +1,150 @@
+"""
+Fixtures cho test webhook: mock_graph_server.py chạy như Graph (subprocess), app chạy bằng uvicorn trong thread,
+database là file sqlite tạm thay cho Postgres
+"""
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK_PORT = _free_port()
+APP_PORT = _free_port()
+MOCK_URL = f"http://127.0.0.1:{MOCK_PORT}"
+API_URL = f"http://127.0.0.1:{APP_PORT}/api/v1"
+MAILBOX = "a@b.com"
+
+# app.config đọc các biến này lúc import
+os.environ["GRAPH_API_BASE"] = f"{MOCK_URL}/v1.0"
+os.environ["AUTHORITY"] = f"{MOCK_URL}/consumers"
+os.environ["WEBHOOK_NOTIFICATION_URL"] = f"{API_URL}/webhooks/graph"
+sys.path.insert(0, ROOT_DIR)
+
+
+def wait_for(condition, timeout: float = 15, interval: float = 0.2):
+    """Chờ tới khi condition() trả về giá trị truthy, trả về giá trị đó"""
+    deadline = time.monotonic() + timeout
+    while True:
+        value = condition()
+        if value or time.monotonic() > deadline:
+            return value
+        time.sleep(interval)
+
+
+def _wait_for_server(url: str):
+    def ready():
+        try:
+            return requests.get(url, timeout=1).status_code < 500
+        except requests.RequestException:
+            return False
+    assert wait_for(ready), f"Server không khởi động: {url}"
+
+
+@pytest.fixture(scope="session")
+def mock_graph():
+    process = subprocess.Popen(
+        [
+            sys.executable, os.path.join(ROOT_DIR, "mock_graph_server.py"),
+            "--port", str(MOCK_PORT), "--messages", "20", "--days", "2", "--noise-ratio", "0", "--seed", "1"
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        _wait_for_server(f"{MOCK_URL}/_control/stats")
+        yield MOCK_URL
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+@pytest.fixture(scope="session")
+def session_factory(tmp_path_factory):
+    from sqlalchemy import create_engine
+
+    import database
+    import models  # noqa: F401 - đăng ký models với Base
+    from app import sync_registry, token_cache
+
+    # File sqlite (không dùng in-memory): worker của webhook và test mỗi bên một connection
+    engine = create_engine(
+        f"sqlite:///{tmp_path_factory.mktemp('db') / 'test.db'}",
+        connect_args={"check_same_thread": False, "timeout": 30}
+    )
+    database.Base.metadata.create_all(engine)
+    database.SessionLocal.configure(bind=engine)
+
+    # Không dùng advisory lock của Postgres
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(sync_registry, "engine", engine)
+        monkeypatch.setattr(token_cache, "engine", engine)
+        yield database.SessionLocal
+
+
+@pytest.fixture(scope="session")
+def account_id(session_factory, mock_graph):
+    from models import Account, AuthToken
+
+    db = session_factory()
+    try:
+        account = Account(email=MAILBOX, name="Test", is_active=True)
+        db.add(account)
+        db.commit()
+        db.add(AuthToken(
+            account_id=account.id,
+            access_token=f"mock-access-{MAILBOX}",
+            refresh_token=f"mock-refresh-{MAILBOX}",
+            expires_in=3600,
+            expires_at=datetime.utcnow() + timedelta(hours=1),
+            is_active=True
+        ))
+        db.commit()
+        return account.id
+    finally:
+        db.close()
+
+
+@pytest.fixture(scope="session")
+def app_server(session_factory, mock_graph):
+    import uvicorn
+
+    import main
+    from app import webhook_service as webhook_module
+
+    server = uvicorn.Server(uvicorn.Config(
+        main.app, host="127.0.0.1", port=APP_PORT, lifespan="off", log_level="warning"
+    ))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    _wait_for_server(f"{API_URL}/webhooks/subscriptions")
+
+    service = webhook_module.webhook_service
+    service.start()
+    # Không chạy renew_subscriptions trong lúc test
+    service.last_renewal_check = time.monotonic()
+    try:
+        yield API_URL
+    finally:
+        service.stop()
+        server.should_exit = True
+        thread.join(timeout=10)
+
+
+@pytest.fixture(scope="session")
+def subscription(app_server, account_id):
+    response = requests.post(f"{app_server}/webhooks/subscriptions/{account_id}")
+    assert response.status_code == 200, response.text
+    return response.json()
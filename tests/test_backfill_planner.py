@@ -0,0 +1,85 @@
+"""
+BackfillPlanner: chia đôi window dày, không chia nhỏ hơn BACKFILL_MIN_WINDOW_MINUTES, gộp window thưa liền nhau.
+$count được giả lập bằng danh sách thời điểm nhận email (không gọi Graph)
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import backfill_planner
+from app.backfill_planner import BackfillPlanner, format_window_time
+from app.config import BACKFILL_MIN_WINDOW_MINUTES
+
+START = datetime(2024, 1, 1)
+MIN_WINDOW = timedelta(minutes=BACKFILL_MIN_WINDOW_MINUTES)
+
+
+@pytest.fixture
+def mailbox(monkeypatch):
+    """(thời điểm nhận email, các khoảng đã đếm): count_emails_in_graph đếm trên danh sách thời điểm"""
+    times = []
+    calls = []
+
+    def count_emails_in_graph(access_token, account_id, received_from, received_to, folder_ids=None):
+        calls.append((received_from, received_to))
+        return len([t for t in times if received_from <= format_window_time(t) < received_to])
+
+    monkeypatch.setattr(backfill_planner, "count_emails_in_graph", count_emails_in_graph)
+    return times, calls
+
+
+def _spread(count: int, start: datetime, end: datetime):
+    step = (end - start) / count
+    return [start + step * i for i in range(count)]
+
+
+def test_dense_window_is_split(mailbox):
+    times, _ = mailbox
+    times.extend(_spread(2000, START, START + timedelta(days=8)))
+
+    windows = BackfillPlanner("token", 1, target_size=500).plan(START, START + timedelta(days=8))
+
+    assert len(windows) >= 4
+    assert sum(count for _, _, count in windows) == 2000
+    assert all(count <= 500 for _, _, count in windows)
+    # Window liền nhau, theo thời gian, phủ cả khoảng
+    assert windows[0][0] == START and windows[-1][1] == START + timedelta(days=8)
+    assert all(previous[1] == current[0] for previous, current in zip(windows, windows[1:]))
+
+
+def test_window_is_not_split_below_min_minutes(mailbox):
+    times, _ = mailbox
+    # 1000 email trong 10 phút: không thể chia xuống dưới target_size
+    times.extend(_spread(1000, START + timedelta(hours=3), START + timedelta(hours=3, minutes=10)))
+
+    windows = BackfillPlanner("token", 1, target_size=100).plan(START, START + timedelta(days=1))
+
+    assert sum(count for _, _, count in windows) == 1000
+    assert all(window_end - window_start >= MIN_WINDOW for window_start, window_end, _ in windows)
+    dense = [(window_start, window_end) for window_start, window_end, count in windows if count > 100]
+    assert len(dense) == 1
+    assert dense[0][1] - dense[0][0] < MIN_WINDOW * 2
+
+
+def test_empty_halves_are_skipped(mailbox):
+    times, calls = mailbox
+    times.extend(_spread(600, START, START + timedelta(hours=12)))
+
+    planner = BackfillPlanner("token", 1, target_size=500)
+    windows = planner.plan(START, START + timedelta(days=16))
+
+    assert sum(count for _, _, count in windows) == 600
+    assert windows[-1][1] <= START + timedelta(hours=12)
+    # Nửa sau được suy ra từ tổng - nửa đầu, nửa rỗng không bị đếm tiếp
+    assert planner.count_requests == len(calls)
+    assert all(received_from < format_window_time(START + timedelta(hours=12)) for received_from, _ in calls)
+
+
+def test_adjacent_sparse_windows_are_merged():
+    t = [START + timedelta(hours=hour) for hour in range(6)]
+    planner = BackfillPlanner("token", 1, target_size=500)
+
+    # Khoảng trống giữa hai window không có email nên vẫn được gộp, miễn tổng không vượt target_size
+    merged = planner._merge([(t[0], t[1], 100), (t[2], t[3], 150), (t[3], t[4], 300), (t[4], t[5], 250)])
+
+    assert merged == [(t[0], t[3], 250), (t[3], t[4], 300), (t[4], t[5], 250)]
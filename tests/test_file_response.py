@@ -0,0 +1,120 @@
+"""
+parse_range và RangeFileResponse: Range (suffix, open-ended, ngoài file), If-Range, If-None-Match
+"""
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from app.file_response import RangeFileResponse, parse_range
+
+ETAG = '"abc123"'
+CONTENT = b"0123456789"
+
+
+@pytest.mark.parametrize("range_header, file_size, expected", [
+    (None, 10, (None, True)),
+    ("bytes=-3", 10, ((7, 9), True)),
+    ("bytes=-30", 10, ((0, 9), True)),
+    ("bytes=4-", 10, ((4, 9), True)),
+    ("bytes=2-5", 10, ((2, 5), True)),
+    ("bytes=2-50", 10, ((2, 9), True)),
+    ("bytes=10-", 10, (None, False)),
+    ("bytes=12-20", 10, (None, False)),
+    ("bytes=-0", 10, (None, False)),
+    ("bytes=-5", 0, (None, False)),
+    ("bytes=0-", 0, (None, False)),
+    ("bytes=5-2", 10, (None, True)),
+    ("bytes=0-1,4-5", 10, (None, True)),
+    ("items=0-1", 10, (None, True)),
+])
+def test_parse_range(range_header, file_size, expected):
+    assert parse_range(range_header, file_size) == expected
+
+
+def _client(path) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/file")
+    def get_file(request: Request):
+        return RangeFileResponse(str(path), ETAG, request.headers, media_type="text/plain", filename="a b.txt")
+
+    return TestClient(app)
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_bytes(CONTENT)
+    return _client(path)
+
+
+def test_full_file(client):
+    response = client.get("/file")
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    assert response.headers["etag"] == ETAG
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["content-disposition"] == "attachment; filename*=utf-8''a%20b.txt"
+
+
+def test_suffix_range(client):
+    response = client.get("/file", headers={"Range": "bytes=-3"})
+
+    assert response.status_code == 206
+    assert response.content == b"789"
+    assert response.headers["content-range"] == "bytes 7-9/10"
+    assert response.headers["content-length"] == "3"
+
+
+def test_open_ended_range(client):
+    response = client.get("/file", headers={"Range": "bytes=6-"})
+
+    assert response.status_code == 206
+    assert response.content == b"6789"
+    assert response.headers["content-range"] == "bytes 6-9/10"
+
+
+def test_range_past_end_is_not_satisfiable(client):
+    response = client.get("/file", headers={"Range": "bytes=10-"})
+
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */10"
+    assert response.content == b""
+
+
+def test_if_range_mismatch_returns_full_file(client):
+    response = client.get("/file", headers={"Range": "bytes=0-1", "If-Range": '"other"'})
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
+
+
+def test_if_range_match_returns_range(client):
+    response = client.get("/file", headers={"Range": "bytes=0-1", "If-Range": ETAG})
+
+    assert response.status_code == 206
+    assert response.content == b"01"
+
+
+@pytest.mark.parametrize("if_none_match", [ETAG, f"W/{ETAG}", f'"other", {ETAG}', "*"])
+def test_if_none_match_returns_304(client, if_none_match):
+    response = client.get("/file", headers={"If-None-Match": if_none_match})
+
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == ETAG
+
+
+def test_empty_file(tmp_path):
+    path = tmp_path / "empty.txt"
+    path.write_bytes(b"")
+    client = _client(path)
+
+    response = client.get("/file")
+    assert response.status_code == 200
+    assert response.content == b""
+
+    response = client.get("/file", headers={"Range": "bytes=-5"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == "bytes */0"
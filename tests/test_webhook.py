@@ -0,0 +1,159 @@
+"""
+Webhook (Graph change notifications) chạy với mock_graph_server.py:
+validation handshake, clientState, debounce, notification "deleted" và lifecycle events
+"""
+import requests
+
+from app.mail_folders import get_sync_folder_ids
+from conftest import MAILBOX, wait_for
+from models import Email, GraphSubscription, MetaReceipt
+
+
+def _stats(mock_graph) -> dict:
+    return requests.get(f"{mock_graph}/_control/stats").json()["stats"]["requests"]
+
+
+def _metrics(app_server) -> dict:
+    return requests.get(f"{app_server}/webhooks/subscriptions").json()["metrics"]
+
+
+def _subscription_id(session_factory, account_id) -> str:
+    db = session_factory()
+    try:
+        return db.query(GraphSubscription).filter(GraphSubscription.account_id == account_id).one().subscription_id
+    finally:
+        db.close()
+
+
+def _emails(session_factory, account_id, message_ids):
+    db = session_factory()
+    try:
+        return db.query(Email).filter(Email.account_id == account_id, Email.message_id.in_(message_ids)).all()
+    finally:
+        db.close()
+
+
+def _add_messages(mock_graph, count: int = 1) -> list:
+    response = requests.post(f"{mock_graph}/_control/mailboxes/{MAILBOX}/messages", params={"count": count})
+    return response.json()["added"]
+
+
+def test_validation_token_is_echoed(app_server):
+    response = requests.post(f"{app_server}/webhooks/graph", params={"validationToken": "abc 123"})
+
+    assert response.status_code == 200
+    assert response.text == "abc 123"
+    assert response.headers["content-type"].startswith("text/plain")
+
+
+def test_subscription_created_after_validation(mock_graph, subscription):
+    subscription_ids = [s["id"] for s in requests.get(f"{mock_graph}/_control/subscriptions").json()["subscriptions"]]
+
+    assert subscription["subscription"]["subscription_id"] in subscription_ids
+
+
+def test_bad_client_state_is_rejected(app_server, session_factory, account_id, subscription):
+    subscription_id = _subscription_id(session_factory, account_id)
+    before = _metrics(app_server)
+
+    response = requests.post(f"{app_server}/webhooks/graph", json={"value": [
+        {"subscriptionId": subscription_id, "clientState": "wrong", "changeType": "created",
+         "resourceData": {"id": "forged-message"}},
+        {"subscriptionId": "unknown-subscription", "clientState": "wrong", "changeType": "created",
+         "resourceData": {"id": "forged-message"}}
+    ]})
+
+    assert response.status_code == 202
+    assert response.json()["accepted"] == 0
+    assert _metrics(app_server)["rejected"] == before["rejected"] + 2
+
+
+def test_created_notifications_are_debounced(mock_graph, app_server, session_factory, account_id, subscription):
+    # Liệt kê folder cần sync trước (cũng dùng $batch), chỉ đếm $batch lấy message
+    db = session_factory()
+    try:
+        get_sync_folder_ids(db, account_id)
+    finally:
+        db.close()
+    before = _metrics(app_server)
+    batches_before = _stats(mock_graph).get("/$batch", 0)
+
+    # Ba notification riêng lẻ trong cùng cửa sổ debounce
+    added = [message_id for _ in range(3) for message_id in _add_messages(mock_graph)]
+
+    assert wait_for(lambda: len(_emails(session_factory, account_id, added)) == 3)
+    metrics = _metrics(app_server)
+    assert metrics["synced_accounts"] == before["synced_accounts"] + 1
+    assert metrics["synced_emails"] == before["synced_emails"] + 3
+    assert _stats(mock_graph).get("/$batch", 0) == batches_before + 1
+
+
+def test_deleted_notification_marks_email_removed(mock_graph, session_factory, account_id, subscription):
+    message_id = _add_messages(mock_graph)[0]
+    assert wait_for(lambda: _emails(session_factory, account_id, [message_id]))
+    assert wait_for(lambda: _receipt_count(session_factory, account_id, message_id) == 1)
+
+    requests.delete(f"{mock_graph}/_control/mailboxes/{MAILBOX}/messages/{message_id}")
+
+    assert wait_for(lambda: _emails(session_factory, account_id, [message_id])[0].removed_at is not None)
+    # Email và meta receipt được giữ lại
+    assert _receipt_count(session_factory, account_id, message_id) == 1
+
+
+def _receipt_count(session_factory, account_id, message_id) -> int:
+    db = session_factory()
+    try:
+        return db.query(MetaReceipt).filter(
+            MetaReceipt.account_id == account_id, MetaReceipt.message_id == message_id
+        ).count()
+    finally:
+        db.close()
+
+
+def _send_lifecycle(mock_graph, subscription_id: str, event: str):
+    response = requests.post(
+        f"{mock_graph}/_control/subscriptions/{subscription_id}/lifecycle", params={"event": event}
+    )
+    assert response.status_code == 200, response.text
+
+
+def test_lifecycle_reauthorization_required_renews(mock_graph, app_server, session_factory, account_id, subscription):
+    subscription_id = _subscription_id(session_factory, account_id)
+    before = _metrics(app_server)
+    patches_before = _stats(mock_graph).get("/subscriptions/{id}", 0)
+
+    _send_lifecycle(mock_graph, subscription_id, "reauthorizationRequired")
+
+    assert wait_for(lambda: _stats(mock_graph).get("/subscriptions/{id}", 0) > patches_before)
+    assert _metrics(app_server)["lifecycle_events"] == before["lifecycle_events"] + 1
+    assert _subscription_id(session_factory, account_id) == subscription_id
+
+
+def test_lifecycle_subscription_removed_recreates(mock_graph, session_factory, account_id, subscription):
+    subscription_id = _subscription_id(session_factory, account_id)
+
+    _send_lifecycle(mock_graph, subscription_id, "subscriptionRemoved")
+
+    assert wait_for(lambda: _subscription_id(session_factory, account_id) != subscription_id)
+    subscription_ids = [s["id"] for s in requests.get(f"{mock_graph}/_control/subscriptions").json()["subscriptions"]]
+    assert _subscription_id(session_factory, account_id) in subscription_ids
+    assert subscription_id not in subscription_ids
+
+
+def test_lifecycle_missed_runs_full_sync(mock_graph, session_factory, account_id, subscription):
+    missed = _add_messages(mock_graph, 2)
+    assert wait_for(lambda: len(_emails(session_factory, account_id, missed)) == 2)
+
+    # Giả lập notification bị mất: email chưa có trong database
+    db = session_factory()
+    try:
+        email_ids = [email.id for email in db.query(Email).filter(Email.message_id.in_(missed))]
+        db.query(MetaReceipt).filter(MetaReceipt.email_id.in_(email_ids)).delete(synchronize_session=False)
+        db.query(Email).filter(Email.id.in_(email_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+    _send_lifecycle(mock_graph, _subscription_id(session_factory, account_id), "missed")
+
+    assert wait_for(lambda: len(_emails(session_factory, account_id, missed)) == 2)